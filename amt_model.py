@@ -0,0 +1,137 @@
+"""
+Loads the harmonizer checkpoint for inference on any device.
+
+Precisions:
+
+  fp32  the weights as trained
+  bf16  half the memory traffic; fast on GPUs and on CPUs with AVX-512 BF16/AMX
+  int8  CPU only: dynamic int8 quantization of every linear layer (weights
+        stored as int8, activations quantized on the fly per batch)
+
+GPT-2 implements its attention and MLP projections as transformers' Conv1D
+rather than nn.Linear, so they are converted to nn.Linear first for the
+quantizer to pick them up. See compare_precision.py for the speed and
+quality of each mode on a fixed set of prompts.
+
+int8 relies on torch.ao.quantization.quantize_dynamic. It is deprecated
+and due to be removed in torch 2.10 (torchao replaces it), so int8 needs
+torch < 2.10; requirements.txt and environment.yml pin torch 2.6.
+
+A local model directory (such as the one export_model.py writes) is loaded
+without contacting the hub, and its safetensors weights are memory-mapped
+rather than read and copied. torch and transformers are only imported when
+a model is loaded, so scripts can parse arguments and answer from the
+generation cache without paying for them.
+"""
+import os
+
+MODEL_NAME = "donggunkwak/PokemonHarmonizer"
+MODEL_SUBFOLDER = "amt_PKMN_Harmonizer_Small/checkpoint-3000"
+# written by export_model.py; the default model when it exists
+LOCAL_MODEL = "./PokemonHarmonizer-Small"
+# int8 needs torch < 2.10, where quantize_dynamic still exists (see above)
+PRECISIONS = ('fp32', 'bf16', 'int8')
+
+
+def default_model():
+    """(name, subfolder) of the model to load when none is given."""
+    if os.path.isdir(LOCAL_MODEL):
+        return LOCAL_MODEL, ""
+    return MODEL_NAME, MODEL_SUBFOLDER
+
+
+def resolve_device(device='auto'):
+    if device == 'auto':
+        import torch
+        return 'cuda' if torch.cuda.is_available() else 'cpu'
+    return device
+
+
+def check_precision(precision, device):
+    if precision not in PRECISIONS:
+        raise ValueError(f"unknown precision {precision!r}, expected one of {', '.join(PRECISIONS)}")
+    if precision == 'int8' and device != 'cpu':
+        raise ValueError("int8 dynamic quantization only runs on the CPU")
+
+
+def linearize(model):
+    """Replace every transformers Conv1D of a model by the equivalent nn.Linear, in place."""
+    from torch import nn
+    from transformers.pytorch_utils import Conv1D
+
+    for module in list(model.modules()):
+        for child_name, child in list(module.named_children()):
+            if isinstance(child, Conv1D):
+                in_features, out_features = child.weight.shape
+                linear = nn.Linear(in_features, out_features, dtype=child.weight.dtype, device=child.weight.device)
+                linear.weight.data = child.weight.data.t().contiguous()
+                linear.bias.data = child.bias.data
+                setattr(module, child_name, linear)
+    return model
+
+
+def quantize_int8(model):
+    """Dynamically quantize the linear layers (including the LM head) of a CPU model to int8."""
+    import torch
+    from torch import nn
+
+    quantize_dynamic = getattr(torch.ao.quantization, 'quantize_dynamic', None)
+    if quantize_dynamic is None:
+        raise RuntimeError(f"int8 needs torch.ao.quantization.quantize_dynamic, which torch {torch.__version__} "
+                           f"no longer has: install torch < 2.10 (requirements.txt pins 2.6)")
+    return quantize_dynamic(linearize(model), {nn.Linear}, dtype=torch.qint8)
+
+
+def load_model(name=MODEL_NAME, subfolder=MODEL_SUBFOLDER, device='auto', precision='fp32', threads=None):
+    """
+    Load a checkpoint ready for generation.
+
+    Args:
+        name (str): Hub name or local path of the model
+        subfolder (str): Checkpoint folder inside it
+        device (str): torch device, or 'auto' for CUDA when available
+        precision (str): One of PRECISIONS
+        threads (int): CPU threads for torch ops (None keeps torch's default)
+
+    Returns:
+        The model in eval mode
+    """
+    import torch
+    from transformers import AutoModelForCausalLM
+
+    device = resolve_device(device)
+    check_precision(precision, device)
+    if threads:
+        torch.set_num_threads(threads)
+
+    path = os.path.join(name, subfolder) if subfolder else name
+    if os.path.isdir(path):
+        model = AutoModelForCausalLM.from_pretrained(path, local_files_only=True)
+    else:
+        model = AutoModelForCausalLM.from_pretrained(name, subfolder=subfolder)
+    return to_precision(model.eval(), precision).to(device)
+
+
+def to_precision(model, precision):
+    """Convert an fp32 model (on the CPU for int8) to one of PRECISIONS."""
+    if precision == 'bf16':
+        import torch
+        return model.to(torch.bfloat16)
+    if precision == 'int8':
+        return quantize_int8(model)
+    return model
+
+
+def add_model_arguments(parser, precision=True):
+    """Add the --model/--subfolder/--device/--precision/--threads options used by load_model."""
+    name, subfolder = default_model()
+    parser.add_argument('--model', default=name, help='model name or path')
+    parser.add_argument('--subfolder', default=subfolder, help='checkpoint subfolder ("" for none)')
+    parser.add_argument('--device', default='auto', help='torch device (auto picks CUDA when available)')
+    if precision:
+        parser.add_argument('--precision', default='fp32', choices=PRECISIONS, help='inference precision')
+    parser.add_argument('--threads', type=int, default=None, help='CPU threads for torch')
+
+
+def model_from_args(args):
+    return load_model(args.model, args.subfolder, args.device, args.precision, args.threads)
@@ -0,0 +1,391 @@
+"""
+Batched, KV-cached sampling for anticipatory music transformers.
+
+generate_batch runs the same decoding procedure as anticipation.sample.generate
+(prompt padding, anticipated control interleaving, safe/future/instrument
+logit masks and nucleus sampling) for many requests at once. Every request
+is a row of one batch that shares the model's forward passes, and each row
+keeps its attention keys/values cached between tokens instead of re-encoding
+its whole history three times per event.
+
+The one intentional difference is how the history window slides. add_token
+keeps the last 1017 history tokens and re-relativizes their times on every
+call. Here a row's window only moves once it is full, and then by
+window_stride tokens, so the cache stays valid between moves. With
+window_stride=0 the window moves every step and the result matches
+anticipation.sample.generate exactly, at the cost of re-encoding the history
+every step once songs outgrow the context.
+"""
+import copy
+import math
+
+import torch
+import torch.nn.functional as F
+
+from anticipation import ops
+from anticipation.config import *
+from anticipation.vocab import *
+from anticipation.sample import safe_logits, nucleus, future_logits, instr_logits
+
+CONTEXT_WINDOW = 1017  # history tokens visible to the model, as in add_token
+WINDOW_STRIDE = 3*64   # tokens dropped from a full window at once
+MAX_CACHE = 2048       # cache slots (real and padding) before the cache is rebuilt
+MAX_ROLLBACK = 64      # longest new input suffix handled by masking instead of re-encoding
+PAD_TOKEN = 50256
+
+
+class GenerationRow:
+    """State of one request inside a batch."""
+
+    def __init__(self, start_time=0, end_time=DELTA, inputs=None, controls=None, top_p=1.0,
+                 active_instruments=None, seed=None, delta=DELTA*TIME_RESOLUTION):
+        # same setup as anticipation.sample.generate
+        inputs = inputs or []
+        controls = controls or []
+        self.start_time = int(TIME_RESOLUTION*start_time)
+        self.end_time = math.inf if end_time is None else int(TIME_RESOLUTION*end_time)  # None: never stop
+        self.top_p = top_p
+        self.delta = delta
+        self.active_instruments = active_instruments
+        self.seed = seed
+
+        # prompt is events up to start_time, events beyond it are treated as controls
+        prompt = ops.pad(ops.clip(inputs, 0, self.start_time, clip_duration=False, seconds=False), self.start_time)
+        self.future = ops.clip(inputs, self.start_time+1, ops.max_time(inputs, seconds=False),
+                               clip_duration=False, seconds=False)
+        controls = ops.clip(controls, DELTA, ops.max_time(controls, seconds=False), clip_duration=False, seconds=False)
+
+        self.z = [ANTICIPATE] if len(controls) > 0 or len(self.future) > 0 else [AUTOREGRESS]
+        self.tokens, self.pending = ops.anticipate(
+            prompt, ops.sort(controls + [CONTROL_OFFSET+token for token in self.future]))
+        self.current_time = ops.max_time(prompt, seconds=False)
+
+        self.lookback = 0
+        self.offset = 0
+        self.new_token = []
+        self.done = False
+        self.generator = None
+        self.disallowed = None
+
+    def setup(self, device):
+        """Create the per-row random generator and instrument mask on the model device."""
+        if self.seed is not None:
+            self.generator = torch.Generator(device=device).manual_seed(self.seed)
+        if self.active_instruments is not None:
+            self.disallowed = torch.zeros(VOCAB_SIZE, dtype=torch.bool, device=device)
+            self.disallowed[NOTE_OFFSET:NOTE_OFFSET+MAX_NOTE] = True
+            for instr in self.active_instruments:
+                self.disallowed[NOTE_OFFSET+instr*MAX_PITCH:NOTE_OFFSET+(instr+1)*MAX_PITCH] = False
+
+    def anticipate(self):
+        """Interleave every control that is due before the next event."""
+        while self.pending and self.current_time >= self.pending[0] - ATIME_OFFSET - self.delta:
+            self.tokens.extend(self.pending[0:3])
+            self.pending = self.pending[3:]
+
+    def model_input(self, window_stride=WINDOW_STRIDE):
+        """
+        The token sequence the model should see for the next token: the
+        global control, the time-relativized history window and the part of
+        the current event sampled so far. Sets self.offset.
+        """
+        if len(self.tokens) - self.lookback > CONTEXT_WINDOW:
+            self.lookback = max(len(self.tokens) - CONTEXT_WINDOW + window_stride, 0)
+
+        history = self.tokens[self.lookback:]
+        self.offset = ops.min_time(history, seconds=False)
+        history[::3] = [tok - self.offset for tok in history[::3]]
+        return self.z + history + self.new_token
+
+    def distribution(self, logits, idx):
+        """Apply the anticipation logit masks and nucleus filter: the distribution of the next token."""
+        i = len(self.new_token)
+        logits = safe_logits(logits, idx)
+        if i == 0:
+            logits = future_logits(logits, max(self.start_time, self.current_time) - self.offset)
+        elif i == 2:
+            logits = instr_logits(logits, self.tokens)
+            if self.disallowed is not None:
+                logits[self.disallowed] = -float('inf')
+        logits = nucleus(logits, self.top_p)
+        return F.softmax(logits, dim=-1)
+
+    def sample(self, logits, idx):
+        """Draw the next token of the current event."""
+        return int(torch.multinomial(self.distribution(logits, idx), 1, generator=self.generator))
+
+    def copy(self):
+        """A copy to sample ahead with, sharing the random generator."""
+        row = copy.copy(self)
+        row.tokens, row.pending, row.new_token = list(self.tokens), list(self.pending), list(self.new_token)
+        return row
+
+    def push(self, token):
+        """
+        Add a sampled token to the current event.
+
+        Returns:
+            bool: True once the row reached end_time
+        """
+        self.new_token.append(token)
+        if len(self.new_token) == 1 and token + self.offset - TIME_OFFSET >= self.end_time:
+            # the event would start past the end: the rest of it is never used
+            self.new_token = []
+            self.done = True
+        elif len(self.new_token) == 3:
+            self.new_token[0] += self.offset  # revert to full sequence timing
+            self.tokens.extend(self.new_token)
+            self.current_time = self.new_token[0] - TIME_OFFSET
+            self.new_token = []
+        return self.done
+
+    def events(self):
+        events, _ = ops.split(self.tokens)
+        return ops.sort(ops.unpad(events) + self.future)
+
+
+def cache_layers(cache):
+    """The (keys, values) tensors, shaped (batch, heads, length, dim), of each layer of a KV cache."""
+    if hasattr(cache, 'layers'):  # transformers >= 4.56
+        return [(layer.keys, layer.values) for layer in cache.layers]
+    if hasattr(cache, 'key_cache'):
+        return list(zip(cache.key_cache, cache.value_cache))
+    return list(cache)  # legacy tuples
+
+
+def common_prefix(a, b):
+    """Length of the longest common prefix of two lists."""
+    n = min(len(a), len(b))
+    if a[:n] == b[:n]:
+        return n
+    lo, hi = 0, n  # a[:lo] == b[:lo] and a[:hi] != b[:hi]
+    while hi - lo > 1:
+        mid = (lo + hi) // 2
+        if a[:mid] == b[:mid]:
+            lo = mid
+        else:
+            hi = mid
+    return lo
+
+
+class BatchDecoder:
+    """
+    Feeds the model input of several rows through one forward pass per token,
+    keeping a shared key/value cache. Rows are right-padded inside each step
+    and padding is masked out, so rows can be at different lengths.
+
+    When a row's input no longer extends what was cached, the cache slots
+    past the longest common prefix are masked out (rolled back) and the rest
+    of the input is fed as usual, if that rest is at most max_rollback tokens,
+    e.g. when a partly sampled event is dropped. Otherwise (the window moved
+    or the time offset changed) only that row is re-encoded and written over
+    its slots of the cache. The whole cache is rebuilt when rows join, when
+    half of them have finished, or when it grows past max_cache slots.
+    """
+
+    def __init__(self, model, window_stride=WINDOW_STRIDE, max_cache=MAX_CACHE, max_rollback=MAX_ROLLBACK):
+        self.model = model
+        self.window_stride = window_stride
+        self.max_cache = max_cache
+        self.max_rollback = max_rollback
+        self.rows = []
+        self.cache = None
+        self.forward_passes = 0
+        self.prefills = 0
+        self.refills = 0
+        self.rollbacks = 0
+
+    def reset(self, rows):
+        self.rows = list(rows)
+        self.fed = [[] for _ in self.rows]
+        self.slots = [[] for _ in self.rows]  # cache column of each fed token
+        self.positions = [0 for _ in self.rows]
+        self.cache = None
+        self.mask = torch.zeros((len(self.rows), 0), dtype=torch.long, device=self.model.device)
+        self.prefills += 1
+
+    def encode(self, sequences, past_key_values=None):
+        """
+        Run the transformer body on right-padded sequences, continuing the
+        cache. The LM head is left out: it only needs to see the positions
+        that are sampled from.
+        """
+        width = max(len(s) for s in sequences)
+        input_ids = torch.full((len(sequences), width), PAD_TOKEN, dtype=torch.long)
+        block_mask = torch.zeros((len(sequences), width), dtype=torch.long)
+        position_ids = torch.zeros((len(sequences), width), dtype=torch.long)
+        start = self.positions if past_key_values is not None else [0] * len(sequences)
+        for b, tokens in enumerate(sequences):
+            n = len(tokens)
+            input_ids[b, :n] = torch.tensor(tokens, dtype=torch.long)
+            block_mask[b, :n] = 1
+            position_ids[b, :n] = torch.arange(start[b], start[b] + n)
+            position_ids[b, n:] = max(start[b] + n - 1, 0)
+
+        device = self.model.device
+        block_mask = block_mask.to(device)
+        attention_mask = block_mask if past_key_values is None else torch.cat([self.mask, block_mask], dim=1)
+        output = self.model.base_model(input_ids=input_ids.to(device), attention_mask=attention_mask,
+                                       position_ids=position_ids.to(device), past_key_values=past_key_values,
+                                       use_cache=True)
+        self.forward_passes += 1
+        return output, attention_mask
+
+    def refill(self, stale):
+        """Re-encode all but the last input token of the (batch index, input) pairs in stale into their cache slots."""
+        prefixes = [tokens[:-1] for _, tokens in stale]
+        encoded = [(b, prefix) for (b, _), prefix in zip(stale, prefixes) if prefix]
+        if encoded:
+            output, _ = self.encode([prefix for _, prefix in encoded])
+            layers = cache_layers(output.past_key_values)
+            for j, (b, prefix) in enumerate(encoded):
+                n = len(prefix)
+                for (keys, values), (new_keys, new_values) in zip(cache_layers(self.cache), layers):
+                    keys[b, :, :n] = new_keys[j, :, :n]
+                    values[b, :, :n] = new_values[j, :, :n]
+
+        for (b, _), prefix in zip(stale, prefixes):
+            self.mask[b] = 0
+            self.mask[b, :len(prefix)] = 1
+            self.fed[b] = prefix
+            self.slots[b] = list(range(len(prefix)))
+            self.positions[b] = len(prefix)
+        self.refills += len(stale)
+
+    def rollback(self, b, keep):
+        """Forget all but the first keep tokens fed for row b."""
+        self.mask[b, self.slots[b][keep:]] = 0
+        self.fed[b] = self.fed[b][:keep]
+        self.slots[b] = self.slots[b][:keep]
+        self.positions[b] = keep
+        self.rollbacks += 1
+
+    @torch.no_grad()
+    def step(self, active, inputs=None, lengths=None):
+        """
+        Run one forward pass for the active rows.
+
+        Args:
+            inputs (list): Input of each active row (defaults to its model_input)
+            lengths (list): For each active row, the input prefix lengths to
+                predict from (defaults to the whole input only)
+
+        Returns:
+            list: (logits, index of the token they predict from) per active
+                  row, or a list of them per row when lengths are given
+        """
+        if inputs is None:
+            inputs = [row.model_input(self.window_stride) for row in active]
+        wanted = lengths if lengths is not None else [[len(tokens)] for tokens in inputs]
+        lookup = {id(row): b for b, row in enumerate(self.rows)}
+        if (self.cache is None or len(active) <= len(self.rows) // 2 or self.mask.shape[1] > self.max_cache
+                or any(id(row) not in lookup for row in active)):
+            self.reset(active)
+        else:
+            stale = []
+            for row, tokens, prefixes in zip(active, inputs, wanted):
+                b = lookup[id(row)]
+                fed = self.fed[b]
+                need = min(prefixes) - 1  # every wanted position must be fed in this pass
+                if len(fed) <= need and tokens[:len(fed)] == fed:
+                    continue
+                keep = common_prefix(fed, tokens[:need])
+                if len(tokens) - keep <= self.max_rollback:
+                    self.rollback(b, keep)
+                else:
+                    stale.append((b, tokens[:need + 1]))
+            if stale and max(len(tokens) - 1 for _, tokens in stale) > self.mask.shape[1]:
+                self.reset(active)
+            elif stale:
+                self.refill(stale)
+
+        lookup = {id(row): b for b, row in enumerate(self.rows)}
+        pending = {id(row): tokens for row, tokens in zip(active, inputs)}
+        suffixes = []
+        for b, row in enumerate(self.rows):
+            tokens = pending.get(id(row))
+            suffixes.append([] if tokens is None else tokens[len(self.fed[b]):])
+
+        width = self.mask.shape[1]
+        output, self.mask = self.encode(suffixes, self.cache)
+        self.cache = output.past_key_values
+
+        batch_index = [lookup[id(row)] for row in active]
+        picks = [(b, length - 1 - len(self.fed[b])) for b, prefixes in zip(batch_index, wanted) for length in prefixes]
+        hidden = output.last_hidden_state[[b for b, _ in picks], [position for _, position in picks]]
+        logits = self.model.get_output_embeddings()(hidden).float()
+
+        for b, suffix in enumerate(suffixes):
+            self.fed[b].extend(suffix)
+            self.slots[b].extend(range(width, width + len(suffix)))
+            self.positions[b] += len(suffix)
+
+        results, j = [], 0
+        for prefixes in wanted:
+            results.append([(logits[j + k], length - 1) for k, length in enumerate(prefixes)])
+            j += len(prefixes)
+        return results if lengths is not None else [result[0] for result in results]
+
+
+def generate_batch(model, requests, window_stride=WINDOW_STRIDE, on_finish=None, admit=None,
+                   delta=DELTA*TIME_RESOLUTION):
+    """
+    Generate several sequences at once, sharing forward passes.
+
+    Args:
+        model: Causal LM with the anticipation vocabulary
+        requests (list): Keyword dicts for GenerationRow (start_time,
+            end_time, inputs, controls, top_p, active_instruments, seed),
+            with the same meaning as in anticipation.sample.generate
+        window_stride (int): How far a full history window moves at once,
+            0 reproduces anticipation.sample.generate exactly
+        on_finish (callable): Called as on_finish(i, events) as soon as
+            request i is complete
+        admit (callable): Called as admit(running) between tokens; the
+            requests it returns join the batch (numbered after the ones
+            already given), so new work does not wait for the batch to end
+
+    Returns:
+        list: Generated events for each request
+    """
+    rows, results = [], []
+
+    def add(new_requests):
+        for request in new_requests:
+            row = GenerationRow(delta=delta, **request)
+            row.setup(model.device)
+            rows.append(row)
+            results.append(None)
+
+    add(requests)
+    decoder = BatchDecoder(model, window_stride)
+    while True:
+        active = [row for row in rows if not row.done]
+        if admit is not None:
+            added = admit(len(active))
+            if added:
+                add(added)
+                active = [row for row in rows if not row.done]
+        if not active:
+            break
+
+        for row in active:
+            if not row.new_token:
+                row.anticipate()
+
+        for row, (logits, idx) in zip(active, decoder.step(active)):
+            if row.push(row.sample(logits, idx)):
+                i = rows.index(row)
+                results[i] = row.events()
+                if on_finish is not None:
+                    on_finish(i, results[i])
+
+    return results
+
+
+def generate(model, start_time, end_time, inputs=None, controls=None, top_p=1.0,
+             active_instruments=None, seed=None, window_stride=WINDOW_STRIDE):
+    """Single-sequence, KV-cached counterpart of anticipation.sample.generate."""
+    request = dict(start_time=start_time, end_time=end_time, inputs=inputs, controls=controls,
+                   top_p=top_p, active_instruments=active_instruments, seed=seed)
+    return generate_batch(model, [request], window_stride=window_stride)[0]
@@ -0,0 +1,192 @@
+"""
+Arrival-time tokenization of compound sequences, following
+anticipation.tokenize.tokenize but reading compounds through
+compound_format so both the binary and the text format are accepted.
+"""
+import os
+import shutil
+import time
+
+import numpy as np
+from tqdm import tqdm
+
+from anticipation import ops
+from anticipation.config import *
+from anticipation.vocab import *
+from anticipation.tokenize import maybe_tokenize, extract_spans, extract_random, extract_instruments
+
+from compound_format import load_compounds
+
+# discard reasons of maybe_tokenize, by status - 1
+DISCARD_REASONS = ('too short', 'too long', 'too many instruments')
+
+
+def tokenize_compounds(compounds, outfile, augment_factor, idx=0, total=None, records=None, sources=None):
+    """
+    Tokenize (name, compound tokens) pairs and write full training sequences
+    to an open text file, one sequence per line. If sources is an open text
+    file, the name of the compound each sequence ends in is written to it,
+    line by line alongside outfile (see shuffle_tokens.py).
+
+    If records is a list, a record per compound is appended to it with the
+    wall and CPU time spent on it, the sequences written meanwhile and the
+    reason it was discarded, if it was (see instrumentation.py).
+
+    Returns:
+        tuple: (seq_count, rest_count, too_short, too_long, too_manyinstr,
+                discarded_seqs, truncations), as anticipation's tokenize
+    """
+    all_truncations = 0
+    seqcount = rest_count = 0
+    stats = 4*[0] # (short, long, too many instruments, inexpressible)
+    np.random.seed(0)
+
+    concatenated_tokens = []
+    for name, compound in tqdm(compounds, desc=f'#{idx}', position=idx+1, leave=True, total=total):
+        if records is not None:
+            records.append({'file': name, 'sequences': seqcount, 'inexpressible': stats[3],
+                            'wall_s': time.perf_counter(), 'cpu_s': time.process_time()})
+        all_events, truncations, status = maybe_tokenize(compound)
+        if status > 0:
+            stats[status-1] += 1
+            if records is not None:
+                records[-1]['reason'] = DISCARD_REASONS[status-1]
+                _close_record(records[-1], seqcount, stats[3])
+            continue
+
+        instruments = list(ops.get_instruments(all_events).keys())
+        end_time = ops.max_time(all_events, seconds=False)
+
+        # different random augmentations
+        for k in range(augment_factor):
+            if k % 10 == 0:
+                # no augmentation
+                events = all_events.copy()
+                controls = []
+            elif k % 10 == 1:
+                # span augmentation
+                lmbda = .05
+                events, controls = extract_spans(all_events, lmbda)
+            elif k % 10 < 6:
+                # random augmentation
+                r = np.random.randint(1,ANTICIPATION_RATES)
+                events, controls = extract_random(all_events, r)
+            else:
+                if len(instruments) > 1:
+                    # instrument augmentation: at least one, but not all instruments
+                    u = 1+np.random.randint(len(instruments)-1)
+                    subset = np.random.choice(instruments, u, replace=False)
+                    events, controls = extract_instruments(all_events, subset)
+                else:
+                    # no augmentation
+                    events = all_events.copy()
+                    controls = []
+
+            if len(concatenated_tokens) == 0:
+                z = ANTICIPATE if k % 10 != 0 else AUTOREGRESS
+
+            all_truncations += truncations
+            events = ops.pad(events, end_time)
+            rest_count += sum(1 if tok == REST else 0 for tok in events[2::3])
+            tokens, controls = ops.anticipate(events, controls)
+            assert len(controls) == 0 # should have consumed all controls (because of padding)
+            tokens[0:0] = [SEPARATOR, SEPARATOR, SEPARATOR]
+            concatenated_tokens.extend(tokens)
+
+            # write out full sequences to file
+            while len(concatenated_tokens) >= EVENT_SIZE*M:
+                seq = concatenated_tokens[0:EVENT_SIZE*M]
+                concatenated_tokens = concatenated_tokens[EVENT_SIZE*M:]
+
+                # relativize time to the context
+                seq = ops.translate(seq, -ops.min_time(seq, seconds=False), seconds=False)
+                assert ops.min_time(seq, seconds=False) == 0
+                if ops.max_time(seq, seconds=False) >= MAX_TIME:
+                    stats[3] += 1
+                    continue
+
+                # if seq contains SEPARATOR, global controls describe the first sequence
+                seq.insert(0, z)
+
+                outfile.write(' '.join([str(tok) for tok in seq]) + '\n')
+                if sources is not None:
+                    sources.write(name + '\n')
+                seqcount += 1
+
+                # grab the current augmentation controls if we didn't already
+                z = ANTICIPATE if k % 10 != 0 else AUTOREGRESS
+
+        if records is not None:
+            _close_record(records[-1], seqcount, stats[3])
+
+    return (seqcount, rest_count, stats[0], stats[1], stats[2], stats[3], all_truncations)
+
+
+def _close_record(record, seqcount, inexpressible):
+    """Turn the counters and clocks stored at the start of a compound into its totals."""
+    record['wall_s'] = time.perf_counter() - record['wall_s']
+    record['cpu_s'] = time.process_time() - record['cpu_s']
+    record['sequences'] = seqcount - record['sequences']
+    record['inexpressible'] = inexpressible - record['inexpressible']
+
+
+def sources_path(output):
+    """The sidecar naming the source song of every line of a tokenized-events file."""
+    return output + '.sources'
+
+
+def tokenize(datafiles, output, augment_factor, idx=0, debug=False, with_records=False):
+    """
+    Drop-in replacement for anticipation.tokenize.tokenize over text or binary
+    compound files, which also writes the sources_path sidecar of output.
+    With with_records, returns (results, records) where the per-compound
+    records of tokenize_compounds also carry their source 'path'.
+    """
+    sources = {}
+
+    def compounds():
+        for filename in datafiles:
+            for name, compound in load_compounds(filename):
+                sources[name] = filename
+                yield name, compound
+
+    records = [] if with_records else None
+    with open(output, 'w') as outfile, open(sources_path(output), 'w') as sources_file:
+        results = tokenize_compounds(compounds(), outfile, augment_factor, idx, records=records,
+                                     sources=sources_file)
+
+    if debug:
+        seqcount, rest_count, too_short, too_long, too_manyinstr, discarded_seqs, _ = results
+        fmt = 'Processed {} sequences (discarded {} tracks, discarded {} seqs, added {} rest tokens)'
+        print(fmt.format(seqcount, too_short+too_long+too_manyinstr, discarded_seqs, rest_count))
+
+    if with_records:
+        for record in records:
+            record['path'] = sources[record['file']]
+        return results, records
+    return results
+
+
+def shard_files(files, shards):
+    """
+    Deal files out to at most shards lists of similar total size (largest
+    file first, to the lightest shard). The result only depends on the file
+    names and sizes, so the merged output is reproducible.
+    """
+    sizes = {f: os.path.getsize(f) for f in files}
+    buckets = [[] for _ in range(min(shards, len(files)))]
+    loads = [0] * len(buckets)
+    for f in sorted(files, key=lambda f: (-sizes[f], f)):
+        i = loads.index(min(loads))
+        buckets[i].append(f)
+        loads[i] += sizes[f]
+    return [sorted(bucket) for bucket in buckets]
+
+
+def merge_shards(shard_outputs, output):
+    """Concatenate the shard outputs into output, in shard order, and remove them."""
+    with open(output, 'wb') as out:
+        for shard in shard_outputs:
+            with open(shard, 'rb') as f:
+                shutil.copyfileobj(f, out, 1 << 20)
+            os.remove(shard)
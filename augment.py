@@ -0,0 +1,59 @@
+import random
+
+import numpy as np
+
+from anticipation.config import MAX_PITCH, MAX_NOTE
+from anticipation.vocab import NOTE_OFFSET, ANOTE_OFFSET
+
+DRUM_INSTRUMENT = 128
+PITCH_SHIFTS = range(-5, 7)  # one offset per key, centered to stay clear of the range limits
+
+
+def _note_mask(tokens):
+    """Boolean mask of the event and control note tokens in a tokenized sequence."""
+    events = (tokens >= NOTE_OFFSET) & (tokens < NOTE_OFFSET + MAX_NOTE)
+    controls = (tokens >= ANOTE_OFFSET) & (tokens < ANOTE_OFFSET + MAX_NOTE)
+    return events, controls
+
+
+def _pitched(tokens):
+    """
+    Locate the pitched (non-drum) notes in a tokenized sequence.
+
+    Returns:
+        tuple: (indices into tokens, pitches) of every pitched note
+    """
+    events, controls = _note_mask(tokens)
+    notes = np.where(events, tokens - NOTE_OFFSET, tokens - ANOTE_OFFSET)
+    mask = (events | controls) & (notes // MAX_PITCH != DRUM_INSTRUMENT)
+    idx = np.flatnonzero(mask)
+    return idx, notes[idx] % MAX_PITCH
+
+
+def feasible_shifts(pitches, shifts=PITCH_SHIFTS):
+    """Offsets from shifts that keep every pitch inside 0-127."""
+    if len(pitches) == 0:
+        return list(shifts)
+    low, high = int(pitches.min()), int(pitches.max())
+    return [s for s in shifts if low + s >= 0 and high + s < MAX_PITCH]
+
+
+def random_transpose_tokens(tokens, shifts=PITCH_SHIFTS):
+    """
+    Pitch-shift a tokenized (arrival-time) AMT sequence to a random key,
+    restricted to offsets that keep all pitched notes inside the MIDI range.
+
+    Both events and anticipated controls are shifted; drums (instrument 128)
+    and every non-note token (times, durations, REST, special tokens) are left
+    alone.
+
+    Returns:
+        tuple: (shifted sequence, offset used)
+    """
+    tokens = np.array(tokens, dtype=np.int64)
+    idx, pitches = _pitched(tokens)
+    candidates = feasible_shifts(pitches, shifts) or [0]
+    semitones = random.choice(candidates)
+    tokens[idx] += semitones
+    return tokens, semitones
+
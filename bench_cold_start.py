@@ -0,0 +1,87 @@
+"""
+Measure cold start: the time from launching a Python process to its first
+sampled token, as paid by every short job on a fresh worker.
+
+Each run starts a new interpreter that records when it reaches each stage:
+
+  interpreter   Python itself is up and this module starts running
+  imports       torch, transformers and the sampling code are imported
+  model loaded  amt_model.load_model returned
+  first token   the first token of a melody was sampled
+
+Times are reported from the moment the process was launched (median and
+worst over --runs). The first run may also pay for a cold page cache; pass
+--warmup to leave it out.
+
+    python bench_cold_start.py --device cpu
+    python bench_cold_start.py --model ./PokemonHarmonizer-Small --subfolder "" --runs 10 --warmup 1
+"""
+import time
+
+STARTED = time.time()  # the interpreter is up
+
+import json
+import subprocess
+import sys
+from argparse import ArgumentParser
+
+STAGES = ('interpreter', 'imports', 'model loaded', 'first token')
+
+
+def first_token(args):
+    """Run the stages in this process and print the wall-clock time each one was reached."""
+    stamps = {'interpreter': STARTED}
+    import torch
+    import transformers  # load_model would import it too, but count it as an import
+    from amt_model import load_model
+    from amt_sampling import BatchDecoder, GenerationRow
+    stamps['imports'] = time.time()
+
+    model = load_model(args.model, args.subfolder, args.device, args.precision, args.threads)
+    stamps['model loaded'] = time.time()
+
+    row = GenerationRow(start_time=0, end_time=10, top_p=.98, seed=0)
+    row.setup(model.device)
+    row.anticipate()
+    (logits, idx), = BatchDecoder(model).step([row])
+    row.push(row.sample(logits, idx))
+    stamps['first token'] = time.time()
+    print(json.dumps(stamps))
+
+
+def cold_start(args):
+    """
+    Launch one process running first_token.
+
+    Returns:
+        dict: Seconds from launch to each stage
+    """
+    command = [sys.executable, __file__, '--child', '--model', args.model, '--subfolder', args.subfolder,
+               '--device', args.device, '--precision', args.precision]
+    if args.threads:
+        command += ['--threads', str(args.threads)]
+    launched = time.time()
+    output = subprocess.run(command, check=True, capture_output=True, text=True).stdout
+    stamps = json.loads(output.strip().splitlines()[-1])
+    return {stage: stamps[stage] - launched for stage in STAGES}
+
+
+if __name__ == '__main__':
+    from amt_model import add_model_arguments
+
+    parser = ArgumentParser(description='measures the time from process start to the first sampled token')
+    add_model_arguments(parser)
+    parser.add_argument('--runs', type=int, default=5, help='processes to launch')
+    parser.add_argument('--warmup', type=int, default=0, help='runs left out of the figures')
+    parser.add_argument('--child', action='store_true', help='(internal) run one cold start in this process')
+    args = parser.parse_args()
+
+    if args.child:
+        first_token(args)
+        sys.exit()
+
+    runs = [cold_start(args) for _ in range(args.warmup + args.runs)][args.warmup:]
+    print(f'Cold start of {args.model} {args.subfolder} ({args.precision}, {args.device}) over {len(runs)} runs:')
+    for stage in STAGES:
+        times = sorted(run[stage] for run in runs)
+        print(f'  => {stage:<13} median {times[len(times) // 2]:.2f}s, max {times[-1]:.2f}s')
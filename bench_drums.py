@@ -0,0 +1,97 @@
+"""
+Benchmark the array based drum injection (drums.py) against the original
+per-token loop of midi-preprocess.py on long synthetic compound sequences.
+
+The array version is timed both on a Python list (as returned by
+midi_to_compound, so the list <-> array conversion is included) and on an
+int64 array (as read back from a binary compound file).
+
+    python bench_drums.py --minutes 10 30 60
+"""
+import time
+from argparse import ArgumentParser
+
+import numpy as np
+
+from anticipation.config import TIME_RESOLUTION
+
+from drums import add_drum_track
+
+
+def add_drum_loop(tokens):
+    """The original addDrumToCompound loop (fixed 120 bpm 4/4), kept as the baseline."""
+    it = iter(tokens)
+
+    BEAT_LENGTH = TIME_RESOLUTION // 2
+    BAR_LENGTH = BEAT_LENGTH * 4
+
+    newTokens = []
+    nextBeat = 0
+
+    for (time_in_ticks,duration,note,instrument,velocity) in zip(it,it,it,it,it):
+        if time_in_ticks >= nextBeat:
+            if nextBeat % BAR_LENGTH == 0:
+                newTokens.append(nextBeat)
+                newTokens.append(BAR_LENGTH-1)
+                newTokens.append(36)
+                newTokens.append(128)
+                newTokens.append(100)
+            newTokens.append(nextBeat)
+            newTokens.append(BEAT_LENGTH-1)
+            newTokens.append(42)
+            newTokens.append(128)
+            newTokens.append(100)
+            nextBeat += BEAT_LENGTH
+        newTokens.append(time_in_ticks)
+        newTokens.append(duration)
+        newTokens.append(note)
+        newTokens.append(instrument)
+        newTokens.append(velocity)
+
+    return newTokens
+
+
+def synthetic_compound(minutes, notes_per_second=8, seed=0):
+    """
+    Compound tokens with a note at least every beat, so the original loop
+    never falls behind the grid and both implementations must agree.
+    """
+    rng = np.random.default_rng(seed)
+    count = int(minutes * 60 * notes_per_second)
+    step = TIME_RESOLUTION // notes_per_second
+    times = np.arange(count) * step
+    notes = np.stack([
+        times,
+        rng.integers(1, TIME_RESOLUTION, count),
+        rng.integers(36, 96, count),
+        rng.integers(0, 8, count),
+        rng.integers(40, 127, count),
+    ], axis=1)
+    return notes.ravel().tolist()
+
+
+def best_of(fn, tokens, repeat):
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = fn(tokens)
+        best = min(best, time.perf_counter() - start)
+    return best, result
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser(description='benchmarks drum-track injection')
+    parser.add_argument('--minutes', type=float, nargs='+', default=[5, 30, 120], help='synthetic song lengths')
+    parser.add_argument('--repeat', type=int, default=5, help='take the best of this many runs')
+    args = parser.parse_args()
+
+    print(f"{'minutes':>8} {'notes':>8} {'loop (s)':>10} {'list (s)':>10} {'array (s)':>10} {'speedup':>8}")
+    for minutes in args.minutes:
+        tokens = synthetic_compound(minutes)
+        loop_time, expected = best_of(add_drum_loop, tokens, args.repeat)
+        list_time, actual = best_of(add_drum_track, tokens, args.repeat)
+        assert actual == expected, 'array implementation disagrees with the original loop'
+        array_time, actual = best_of(add_drum_track, np.array(tokens, dtype=np.int64), args.repeat)
+        assert actual.tolist() == expected, 'array implementation disagrees with the original loop'
+        print(f'{minutes:>8g} {len(tokens)//5:>8} {loop_time:>10.4f} {list_time:>10.4f} {array_time:>10.4f} '
+              f'{loop_time/array_time:>7.1f}x')
@@ -0,0 +1,209 @@
+"""
+Benchmark the run_amt.py pipeline (generate -> extract_instruments ->
+generate with controls -> ops.combine -> ops.clip -> events_to_midi) on a
+small randomly initialized GPT-2 with the anticipation vocabulary, so it
+runs without network access or a GPU.
+
+A random model samples time tokens uniformly and would end a song after a
+couple of events, so its output layer is biased toward short time steps
+(about TIME_BIAS nats per 10 ms) and away from rests. It then writes roughly
+10 events per second, like real music. The timings measure the sampling
+code and a model of the configured size, not musical quality.
+
+Each case runs in a fresh process so that its peak RSS is its own. For every
+combination of sampler, length, top_p and active_instruments set, it reports:
+
+  tokens/s        sampled tokens per second of generation
+  s per s         seconds of pipeline time per second of music
+  first event     time until the first event of the melody was sampled
+  peak RSS        of the process running the case
+  stages          seconds spent in each pipeline stage
+
+    python bench_generation.py --lengths 10 40 --top-p 0.9 0.98 --instruments all 1,40,41,42,43
+    python bench_generation.py --json today.json --baseline last_release.json
+"""
+import io
+import json
+import platform
+import resource
+import time
+from argparse import ArgumentParser
+from concurrent.futures import ProcessPoolExecutor
+from itertools import product
+
+import torch
+import transformers
+from torch import nn
+from transformers import GPT2Config, GPT2LMHeadModel
+
+from anticipation import ops
+from anticipation.config import *
+from anticipation.vocab import *
+from anticipation.sample import generate as anticipation_generate
+from anticipation.tokenize import extract_instruments
+from anticipation.convert import events_to_midi
+
+import amt_sampling
+
+SAMPLERS = ('anticipation', 'cached')
+TIME_BIAS = 0.1
+
+
+class BiasedHead(nn.Module):
+    """An LM head plus a fixed bias over the vocabulary."""
+
+    def __init__(self, head, bias):
+        super().__init__()
+        self.head = head
+        self.register_buffer('bias', bias)
+
+    def forward(self, hidden):
+        return self.head(hidden) + self.bias.to(hidden.dtype)
+
+
+def build_model(layers=4, width=256, heads=4, seed=0):
+    """A random GPT-2 over the anticipation vocabulary that writes music-like event densities."""
+    torch.manual_seed(seed)
+    config = GPT2Config(vocab_size=VOCAB_SIZE, n_positions=CONTEXT_SIZE, n_embd=width, n_layer=layers, n_head=heads)
+    model = GPT2LMHeadModel(config).eval()
+
+    bias = torch.zeros(VOCAB_SIZE)
+    bias[TIME_OFFSET:TIME_OFFSET+MAX_TIME] = -TIME_BIAS * torch.arange(MAX_TIME, dtype=torch.float)
+    bias[REST] = -1e4
+    model.lm_head = BiasedHead(model.lm_head, bias)
+    return model
+
+
+class TokenClock:
+    """Records when the LM head runs, i.e. when each token is about to be sampled."""
+
+    def __init__(self, model):
+        self.times = []
+        self.handle = model.get_output_embeddings().register_forward_hook(
+            lambda module, args, output: self.times.append(time.perf_counter()))
+
+    def close(self):
+        self.handle.remove()
+
+
+def run_case(case, model_args):
+    """Run the pipeline once and return its measurements."""
+    torch.set_num_threads(model_args['threads'] or torch.get_num_threads())
+    model = build_model(model_args['layers'], model_args['width'], model_args['heads'])
+    length, top_p, instruments = case['length'], case['top_p'], case['instruments']
+
+    if case['sampler'] == 'cached':
+        def generate(**kwargs):
+            return amt_sampling.generate(model, seed=case['seed'], **kwargs)
+    else:
+        def generate(**kwargs):
+            return anticipation_generate(model, **kwargs)
+
+    stages = {}
+
+    def timed(stage, fn, *args, **kwargs):
+        start = time.perf_counter()
+        result = fn(*args, **kwargs)
+        stages[stage] = stages.get(stage, 0) + time.perf_counter() - start
+        return result
+
+    torch.manual_seed(case['seed'])
+    clock = TokenClock(model)
+    start = time.perf_counter()
+    with torch.no_grad():
+        song = timed('generate melody', generate, start_time=0, end_time=length, top_p=top_p)
+        _, melody = timed('extract_instruments', extract_instruments, song, [0])
+        accompaniment = timed('generate accompaniment', generate, start_time=0, end_time=length, controls=melody,
+                              top_p=top_p, active_instruments=instruments)
+    events = timed('ops.combine', ops.combine, accompaniment, melody)
+    events = timed('ops.clip', ops.clip, events, 0, length, clip_duration=True)
+    mid = timed('events_to_midi', events_to_midi, events)
+    timed('save', mid.save, file=io.BytesIO())
+    total = time.perf_counter() - start
+    clock.close()
+
+    generating = stages['generate melody'] + stages['generate accompaniment']
+    first_event = clock.times[2] - start if len(song) >= 3 and len(clock.times) >= 3 else None
+    return {
+        **case,
+        'events': len(song)//3 + len(accompaniment)//3,
+        'tokens': len(clock.times),
+        'tokens_per_s': len(clock.times) / generating,
+        'seconds_per_music_second': total / length,
+        'first_event_s': first_event,
+        'peak_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+        'total_s': total,
+        'stages': stages,
+    }
+
+
+def case_key(result):
+    return (result['sampler'], result['length'], result['top_p'], str(result['instruments']))
+
+
+def parse_instruments(text):
+    return None if text == 'all' else [int(i) for i in text.split(',')]
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser(description='benchmarks the run_amt.py generation pipeline on a random model')
+    parser.add_argument('--samplers', nargs='+', default=list(SAMPLERS), choices=SAMPLERS,
+                        help='anticipation.sample.generate and/or the KV-cached amt_sampling.generate')
+    parser.add_argument('--lengths', type=float, nargs='+', default=[10, 40], help='seconds of music')
+    parser.add_argument('--top-p', type=float, nargs='+', default=[.98], help='nucleus sampling thresholds')
+    parser.add_argument('--instruments', nargs='+', default=['1,40,41,42,43'],
+                        help="active_instruments sets for the accompaniment, comma separated, or 'all'")
+    parser.add_argument('--layers', type=int, default=4, help='GPT-2 layers')
+    parser.add_argument('--width', type=int, default=256, help='GPT-2 embedding size')
+    parser.add_argument('--heads', type=int, default=4, help='GPT-2 attention heads')
+    parser.add_argument('--threads', type=int, default=None, help='CPU threads for torch')
+    parser.add_argument('--seed', type=int, default=0, help='sampling seed')
+    parser.add_argument('--json', help='write the results to this file')
+    parser.add_argument('--baseline', help='earlier --json output to compare tokens/s against')
+    args = parser.parse_args()
+
+    model_args = {'layers': args.layers, 'width': args.width, 'heads': args.heads, 'threads': args.threads}
+    cases = [{'sampler': sampler, 'length': length, 'top_p': top_p, 'instruments': parse_instruments(instruments),
+              'seed': args.seed}
+             for sampler, length, top_p, instruments in product(args.samplers, args.lengths, args.top_p,
+                                                                args.instruments)]
+
+    baseline = {}
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = {case_key(result): result for result in json.load(f)['results']}
+
+    print(f"{'sampler':>12} {'length':>6} {'top_p':>5} {'instruments':>14} {'events':>6} {'tokens/s':>9} "
+          f"{'s per s':>8} {'first (s)':>9} {'RSS (MB)':>8}" + (f" {'vs base':>8}" if baseline else ''))
+    results = []
+    for case in cases:
+        # a fresh process per case, so peak RSS is per case
+        with ProcessPoolExecutor(max_workers=1) as executor:
+            result = executor.submit(run_case, case, model_args).result()
+        results.append(result)
+
+        instruments = 'all' if result['instruments'] is None else ','.join(map(str, result['instruments']))
+        first = '-' if result['first_event_s'] is None else f"{result['first_event_s']:.3f}"
+        line = (f"{result['sampler']:>12} {result['length']:>6g} {result['top_p']:>5g} {instruments:>14} "
+                f"{result['events']:>6} {result['tokens_per_s']:>9.1f} {result['seconds_per_music_second']:>8.3f} "
+                f"{first:>9} {result['peak_rss_mb']:>8.0f}")
+        if baseline:
+            previous = baseline.get(case_key(result))
+            line += f" {result['tokens_per_s']/previous['tokens_per_s']:>7.2f}x" if previous else f" {'-':>8}"
+        print(line)
+        print('    ' + ', '.join(f'{stage} {seconds:.3f}s' for stage, seconds in result['stages'].items()))
+
+    if args.json:
+        report = {
+            'created': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'platform': platform.platform(),
+            'python': platform.python_version(),
+            'torch': torch.__version__,
+            'transformers': transformers.__version__,
+            'threads': args.threads or torch.get_num_threads(),
+            'model': model_args,
+            'results': results,
+        }
+        with open(args.json, 'w') as f:
+            json.dump(report, f, indent=1)
+        print(f'Saved {args.json}')
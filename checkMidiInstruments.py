@@ -1,4 +1,5 @@
 import os
+import sys
 import mido
 
 
@@ -142,6 +143,7 @@ def get_instrument_name(program_num):
         return "Unknown Instrument"
 
 if __name__ == "__main__":
-    # Ask the user for the directory containing MIDI files
-    midi_directory = "C:/Users/dongg/Documents/UROPSP25/PokemonHarmonizer/pokemon_midis/"
+    # Directory (or single file) from the command line; see midi_index.py to
+    # index and query a whole corpus instead
+    midi_directory = sys.argv[1] if len(sys.argv) > 1 else "./pokemon_midis/"
     analyze_midi_files(midi_directory)
\ No newline at end of file
@@ -0,0 +1,132 @@
+"""
+Speed and quality of the inference precisions of amt_model.py on a fixed
+set of prompts: the melody of the first --length seconds of each MIDI file.
+
+  speed    milliseconds per token when decoding each prompt's sequence one
+           token at a time with a KV cache (the same work for every mode), and
+           wall time to harmonize each melody with a fixed seed (the
+           run_amt.py accompaniment settings)
+  quality  teacher forced on each prompt's own event sequence, against fp32:
+           negative log-likelihood per token, KL(fp32 || mode) of the
+           next-token distributions and how often the most likely next token
+           agrees with fp32
+  size     serialized size of the weights
+
+    python compare_precision.py --device cpu --threads 8
+"""
+import copy
+import io
+import time
+from argparse import ArgumentParser
+
+import torch
+
+from anticipation import ops
+from anticipation.config import *
+from anticipation.vocab import *
+from anticipation.tokenize import extract_instruments
+from anticipation.convert import midi_to_events
+
+from amt_model import PRECISIONS, add_model_arguments, check_precision, load_model, resolve_device, to_precision
+from amt_sampling import generate
+from harmonize import ACCOMPANIMENT_INSTRUMENTS
+
+DEFAULT_PROMPTS = [
+    './pokemon_midis/Hearthome-City.mid',
+    './pokemon_midis/Eterna-City.mid',
+    './pokemon_midis/Floaroma-City.mid',
+]
+MELODY_INSTRUMENT = 0
+
+
+def load_prompt(filename, length):
+    """
+    Returns:
+        tuple: (melody controls, teacher forcing sequence) of the first length seconds
+    """
+    events = ops.clip(midi_to_events(filename), 0, length)
+    accompaniment, melody = extract_instruments(events, [MELODY_INSTRUMENT])
+    tokens, _ = ops.anticipate(accompaniment, melody)
+    return melody, [ANTICIPATE] + tokens[:CONTEXT_SIZE-1]
+
+
+def model_size(model):
+    buffer = io.BytesIO()
+    torch.save(model.state_dict(), buffer)
+    return buffer.tell()
+
+
+@torch.no_grad()
+def log_probs(model, sequence):
+    input_ids = torch.tensor([sequence], device=model.device)
+    return model(input_ids).logits[0, :-1].float().log_softmax(-1).cpu()
+
+
+@torch.no_grad()
+def decode_time(model, sequence):
+    """Seconds to feed sequence through the model one token at a time, as sampling does."""
+    start = time.perf_counter()
+    past = None
+    for token in sequence:
+        output = model(torch.tensor([[token]], device=model.device), past_key_values=past, use_cache=True)
+        past = output.past_key_values
+    return time.perf_counter() - start
+
+
+def quality(reference, logp, sequence):
+    """NLL per token, mean KL(reference || logp) and top-1 agreement of next-token log-probabilities."""
+    targets = torch.tensor(sequence[1:])
+    nll = -logp[torch.arange(len(targets)), targets].mean().item()
+    kl = (reference.exp() * (reference - logp)).sum(-1).mean().item()
+    agree = (reference.argmax(-1) == logp.argmax(-1)).float().mean().item()
+    return nll, kl, agree
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser(description='compares speed and quality of the inference precisions')
+    parser.add_argument('prompts', nargs='*', default=DEFAULT_PROMPTS, help='MIDI files to take melodies from')
+    add_model_arguments(parser, precision=False)
+    parser.add_argument('--precisions', nargs='+', default=list(PRECISIONS), choices=PRECISIONS)
+    parser.add_argument('-l', '--length', type=float, default=40, help='seconds of each prompt to harmonize')
+    parser.add_argument('--seed', type=int, default=0, help='sampling seed')
+    args = parser.parse_args()
+
+    device = resolve_device(args.device)
+    base = load_model(args.model, args.subfolder, 'cpu', 'fp32', args.threads)
+    prompts = [load_prompt(filename, args.length) for filename in args.prompts]
+
+    rows, reference = [], None
+    for precision in args.precisions:
+        try:
+            check_precision(precision, device)
+        except ValueError as e:
+            print(f'Skipping {precision}: {e}')
+            continue
+        model = to_precision(copy.deepcopy(base), precision).to(device)
+
+        logps = [log_probs(model, sequence) for _, sequence in prompts]
+        if reference is None:
+            if precision != 'fp32':
+                print(f'Quality is relative to {precision}, the first precision measured')
+            reference = logps
+        scores = [quality(ref, logp, sequence) for ref, logp, (_, sequence) in zip(reference, logps, prompts)]
+
+        per_token = sum(decode_time(model, sequence) for _, sequence in prompts) / sum(len(s) for _, s in prompts)
+        seconds, events = 0, 0
+        for melody, _ in prompts:
+            start = time.perf_counter()
+            accompaniment = generate(model, 0, args.length, controls=melody, top_p=.98,
+                                     active_instruments=ACCOMPANIMENT_INSTRUMENTS, seed=args.seed)
+            seconds += time.perf_counter() - start
+            events += len(accompaniment)//3
+
+        rows.append((precision, 1000*per_token, seconds/len(prompts), events, model_size(model)/2**20,
+                     *[sum(column)/len(scores) for column in zip(*scores)]))
+        del model
+
+    print(f'\n{len(prompts)} prompts of {args.length:g}s on {device} ({torch.get_num_threads()} threads)\n')
+    print('| precision | ms/token | speedup | s/prompt | events | size (MB) | NLL/token | KL vs ref | top-1 agree |')
+    print('|---|---|---|---|---|---|---|---|---|')
+    for precision, ms, per_prompt, events, size, nll, kl, agree in rows:
+        print(f'| {precision} | {ms:.2f} | {rows[0][1]/ms:.2f}x | {per_prompt:.1f} | {events} | {size:.0f} '
+              f'| {nll:.3f} | {kl:.4f} | {100*agree:.1f}% |')
@@ -0,0 +1,180 @@
+"""
+Binary compound token format.
+
+A compound file holds one or more compound token sequences (the
+(time, duration, note, instrument, velocity) lists produced by
+midi_to_compound) as fixed-width little-endian integer arrays:
+
+    header   <4sHHQQ   magic, version, item size, entry count, names size
+    index    <QQ       (offset, length) in tokens, one per entry
+    names    utf-8     JSON list of entry names, padded to 8 bytes
+    data     <i2/<i4   all sequences back to back
+
+The writer uses int16 whenever every token fits (tracks shorter than ~5
+minutes at the default TIME_RESOLUTION) and int32 otherwise.
+
+midi-preprocess.py writes one single-entry file per MIDI; `pack` merges many
+of them into a shard. CompoundShard memory-maps either kind and hands out
+zero-copy numpy views.
+"""
+import json
+import os
+import struct
+from argparse import ArgumentParser
+from glob import glob
+
+import numpy as np
+
+MAGIC = b'AMTC'
+VERSION = 1
+HEADER = struct.Struct('<4sHHQQ')
+INDEX_ENTRY = struct.Struct('<QQ')
+DTYPES = {2: np.dtype('<i2'), 4: np.dtype('<i4')}
+
+TEXT_SUFFIX = '.compound.txt'
+BINARY_SUFFIX = '.compound.bin'
+
+
+def write_shard(path, entries):
+    """
+    Write compound sequences to a binary shard.
+
+    Args:
+        path (str): Output file
+        entries (iterable): (name, tokens) pairs
+    """
+    names, arrays = [], []
+    for name, tokens in entries:
+        names.append(name)
+        arrays.append(np.asarray(tokens, dtype=np.int64))
+
+    small = DTYPES[2]
+    fits = all(len(a) == 0 or (a.min() >= np.iinfo(small).min and a.max() <= np.iinfo(small).max)
+               for a in arrays)
+    dtype = small if fits else DTYPES[4]
+
+    names_blob = json.dumps(names).encode('utf-8')
+    names_blob += b' ' * (-len(names_blob) % 8)
+
+    offsets = np.cumsum([0] + [len(a) for a in arrays])
+    tmp = f'{path}.tmp'
+    with open(tmp, 'wb') as f:
+        f.write(HEADER.pack(MAGIC, VERSION, dtype.itemsize, len(arrays), len(names_blob)))
+        for offset, a in zip(offsets, arrays):
+            f.write(INDEX_ENTRY.pack(int(offset), len(a)))
+        f.write(names_blob)
+        for a in arrays:
+            f.write(a.astype(dtype).tobytes())
+    os.replace(tmp, path)
+
+
+def _entry_name(path, suffix):
+    name = os.path.basename(path)
+    return name[:-len(suffix)] if name.endswith(suffix) else name
+
+
+def write_compound(path, tokens, name=None):
+    """Write a single compound sequence as a one-entry binary file."""
+    write_shard(path, [(name or _entry_name(path, BINARY_SUFFIX), tokens)])
+
+
+def write_text(path, tokens):
+    with open(path, 'w') as f:
+        f.write(' '.join(str(tok) for tok in tokens))
+
+
+class CompoundShard:
+    """Read-only, memory-mapped view of a binary compound file."""
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as f:
+            magic, version, itemsize, count, names_size = HEADER.unpack(f.read(HEADER.size))
+            if magic != MAGIC:
+                raise ValueError(f'{path} is not a binary compound file')
+            if version != VERSION or itemsize not in DTYPES:
+                raise ValueError(f'{path} has unsupported compound format version {version}')
+            index = np.frombuffer(f.read(INDEX_ENTRY.size*count), dtype='<u8').reshape(-1, 2)
+            self.names = json.loads(f.read(names_size).decode('utf-8'))
+
+        self._offsets = index[:, 0].astype(np.int64)
+        self._lengths = index[:, 1].astype(np.int64)
+        data_start = HEADER.size + INDEX_ENTRY.size*count + names_size
+        total = int(self._lengths.sum())
+        if total:
+            self._data = np.memmap(path, dtype=DTYPES[itemsize], mode='r', offset=data_start, shape=(total,))
+        else:
+            self._data = np.zeros(0, dtype=DTYPES[itemsize])
+
+    def __len__(self):
+        return len(self._lengths)
+
+    def __getitem__(self, i):
+        start = self._offsets[i]
+        return self._data[start:start + self._lengths[i]]
+
+    def items(self):
+        for i, name in enumerate(self.names):
+            yield name, self[i]
+
+
+def compound_files(directory, recursive=False):
+    """
+    The compound files of a directory, one per song: where a song has both a
+    binary and a text compound (an older text output left next to a new
+    binary one, or an export), only the binary file is listed.
+    """
+    pattern = os.path.join(directory, '**' if recursive else '', '*')
+    binary = glob(pattern + BINARY_SUFFIX, recursive=recursive)
+    stems = {f[:-len(BINARY_SUFFIX)] for f in binary}
+    text = [f for f in glob(pattern + TEXT_SUFFIX, recursive=recursive) if f[:-len(TEXT_SUFFIX)] not in stems]
+    return sorted(binary + text)
+
+
+def load_compounds(filename):
+    """
+    Yield (name, tokens) for every sequence stored in a compound file,
+    whichever format it is in. Tokens are plain int lists, as expected by
+    anticipation.convert.compound_to_events.
+    """
+    if filename.endswith(TEXT_SUFFIX):
+        with open(filename, 'r') as f:
+            yield _entry_name(filename, TEXT_SUFFIX), [int(token) for token in f.read().split()]
+        return
+
+    for name, tokens in CompoundShard(filename).items():
+        yield name, tokens.tolist()
+
+
+def pack(filenames, output):
+    """Merge compound files (text or binary) into a single binary shard."""
+    write_shard(output, (item for filename in filenames for item in load_compounds(filename)))
+
+
+def export_text(filename, output_dir):
+    """Write every sequence of a binary compound file out as .compound.txt."""
+    os.makedirs(output_dir, exist_ok=True)
+    for name, tokens in CompoundShard(filename).items():
+        write_text(os.path.join(output_dir, f'{name}{TEXT_SUFFIX}'), tokens.tolist())
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser(description='packs and exports binary compound files')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    pack_parser = subparsers.add_parser('pack', help='merge the compound files of a directory into one shard')
+    pack_parser.add_argument('dir', help='directory containing .compound.bin/.compound.txt files')
+    pack_parser.add_argument('output', help='shard to write')
+
+    export_parser = subparsers.add_parser('export', help='export a binary compound file as text')
+    export_parser.add_argument('filename', help='.compound.bin file or shard')
+    export_parser.add_argument('output_dir', help='directory for the .compound.txt files')
+
+    args = parser.parse_args()
+    if args.command == 'pack':
+        filenames = compound_files(args.dir, recursive=True)
+        filenames = [f for f in filenames if os.path.abspath(f) != os.path.abspath(args.output)]
+        pack(filenames, args.output)
+        print(f'Packed {len(filenames)} files into {args.output}')
+    else:
+        export_text(args.filename, args.output_dir)
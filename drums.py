@@ -0,0 +1,195 @@
+"""
+Array based drum-track injection for compound token sequences.
+
+The beat and bar grid is computed for the whole song at once, from the
+tempo and time signature changes of the source MIDI when it is available
+(falling back to 120 bpm in 4/4), and the drum hits of a repeating per-bar
+pattern are merged into the note stream with a single searchsorted/insert.
+"""
+import json
+
+import numpy as np
+
+from anticipation.config import TIME_RESOLUTION
+
+DRUM_INSTRUMENT = 128
+DEFAULT_TEMPO = 500000  # microseconds per beat, the MIDI default
+DEFAULT_SIGNATURE = (4, 4)
+
+# Each entry hits `note` on the listed beats of every bar ('all' for every
+# beat, fractions allowed) and holds it for `length` beats ('bar' for the
+# rest of the bar). The default reproduces the original drum track: a kick
+# on every downbeat and a closed hi-hat on every beat.
+DEFAULT_PATTERN = [
+    {'note': 36, 'velocity': 100, 'beats': [0], 'length': 'bar'},
+    {'note': 42, 'velocity': 100, 'beats': 'all', 'length': 1},
+]
+
+
+def load_pattern(path):
+    """Load a drum pattern (see DEFAULT_PATTERN) from a JSON file."""
+    with open(path) as f:
+        pattern = json.load(f)
+
+    for hit in pattern:
+        missing = {'note', 'beats'} - set(hit)
+        if missing:
+            raise ValueError(f"drum pattern entry {hit} is missing {', '.join(sorted(missing))}")
+        if not 0 <= hit['note'] < 128:
+            raise ValueError(f"drum pattern note {hit['note']} is outside 0-127")
+
+    return pattern
+
+
+def meter_map(midi):
+    """
+    Collect the tempo and time signature changes of a MIDI file.
+
+    Returns:
+        tuple: (tempos, signatures, end_tick) with tempos a list of
+               (tick, tempo) and signatures a list of (tick, numerator, denominator)
+    """
+    tempos = {0: DEFAULT_TEMPO}
+    signatures = {0: DEFAULT_SIGNATURE}
+    end_tick = 0
+    for track in midi.tracks:
+        tick = 0
+        for msg in track:
+            tick += msg.time
+            if msg.type == 'set_tempo':
+                tempos[tick] = msg.tempo
+            elif msg.type == 'time_signature':
+                signatures[tick] = (msg.numerator, msg.denominator)
+        end_tick = max(end_tick, tick)
+
+    return (sorted(tempos.items()),
+            [(tick, num, den) for tick, (num, den) in sorted(signatures.items())],
+            end_tick)
+
+
+def ticks_to_time(ticks, tempos, ticks_per_beat):
+    """Convert absolute MIDI ticks to (fractional) compound time steps."""
+    change_ticks = np.array([tick for tick, _ in tempos], dtype=np.float64)
+    change_tempos = np.array([tempo for _, tempo in tempos], dtype=np.float64)
+    scale = change_tempos / 1e6 / ticks_per_beat  # seconds per tick in each segment
+    segment_start = np.concatenate([[0.], np.cumsum(np.diff(change_ticks) * scale[:-1])])
+
+    idx = np.searchsorted(change_ticks, ticks, side='right') - 1
+    seconds = segment_start[idx] + (ticks - change_ticks[idx]) * scale[idx]
+    return TIME_RESOLUTION * seconds
+
+
+def beat_grid(midi=None, end_time=0):
+    """
+    Compute every beat of a song.
+
+    Args:
+        midi (mido.MidiFile): Source file to read tempo and meter from, or
+            None for a fixed 120 bpm 4/4 grid
+        end_time (int): Last compound time step the grid has to cover
+
+    Returns:
+        tuple: (beat_times, bar_starts) with beat_times the compound time
+               of each beat (plus one trailing beat) and bar_starts the
+               indices of the beats that open a bar
+    """
+    if midi is None:
+        beat_length = TIME_RESOLUTION // 2
+        count = end_time // beat_length + 2
+        beat_times = np.arange(count, dtype=np.float64) * beat_length
+        return beat_times, np.arange(0, count - 1, DEFAULT_SIGNATURE[0])
+
+    tempos, signatures, end_tick = meter_map(midi)
+    tpb = midi.ticks_per_beat
+
+    beat_ticks, bar_starts = [], []
+    count = 0
+    for i, (start, numerator, denominator) in enumerate(signatures):
+        beat_length = tpb * 4 / denominator
+        # the last signature runs one bar past the end of the file
+        stop = signatures[i+1][0] if i + 1 < len(signatures) else end_tick + numerator * beat_length
+        n = max(int(np.ceil((stop - start) / beat_length)), 1)
+        beat_ticks.append(start + np.arange(n) * beat_length)
+        bar_starts.append(count + np.arange(0, n, numerator))
+        count += n
+    beat_ticks.append([beat_ticks[-1][-1] + beat_length])
+
+    beat_times = ticks_to_time(np.concatenate(beat_ticks), tempos, tpb)
+    return beat_times, np.concatenate(bar_starts)
+
+
+def drum_events(beat_times, bar_starts, end_time, pattern=DEFAULT_PATTERN):
+    """
+    Instantiate a drum pattern on a beat grid.
+
+    Returns:
+        np.ndarray: (n, 5) compound rows sorted by time, hits at the same
+                    time kept in pattern order
+    """
+    # beats per bar, the last bar ending with the grid
+    bar_lengths = np.diff(np.append(bar_starts, len(beat_times) - 1))
+    beat_index = np.arange(len(beat_times))
+
+    rows = []
+    for order, hit in enumerate(pattern):
+        if hit['beats'] == 'all':
+            starts = np.arange(len(beat_times) - 1, dtype=np.float64)
+            bars = np.searchsorted(bar_starts, starts, side='right') - 1
+        else:
+            positions = np.asarray(hit['beats'], dtype=np.float64)
+            starts = (bar_starts[:, None] + positions[None, :]).ravel()
+            bars = np.repeat(np.arange(len(bar_starts)), len(positions))
+            keep = np.tile(positions, len(bar_starts)) < np.repeat(bar_lengths, len(positions))
+            starts, bars = starts[keep], bars[keep]
+
+        length = hit.get('length', 1)
+        ends = bar_starts[bars] + bar_lengths[bars] if length == 'bar' else starts + length
+
+        onset = np.round(np.interp(starts, beat_index, beat_times)).astype(np.int64)
+        offset = np.round(np.interp(ends, beat_index, beat_times)).astype(np.int64)
+        within = onset <= end_time
+
+        block = np.empty((within.sum(), 6), dtype=np.int64)
+        block[:, 0] = onset[within]
+        block[:, 1] = np.maximum(offset[within] - onset[within] - 1, 0)
+        block[:, 2] = hit['note']
+        block[:, 3] = DRUM_INSTRUMENT
+        block[:, 4] = hit.get('velocity', 100)
+        block[:, 5] = order
+        rows.append(block)
+
+    events = np.concatenate(rows) if rows else np.empty((0, 6), dtype=np.int64)
+    events = events[np.lexsort((events[:, 5], events[:, 0]))]
+    return events[:, :5]
+
+
+def add_drum_track(tokens, midi=None, pattern=DEFAULT_PATTERN):
+    """
+    Merge a drum track into a compound token sequence.
+
+    Drum hits are placed ahead of any note starting at the same time and the
+    grid stops at the last note onset, as in the original loop.
+
+    Args:
+        tokens (list or np.ndarray): Compound tokens, sorted by time
+        midi (mido.MidiFile): Source file for tempo/time signature changes
+        pattern (list): Drum pattern, see DEFAULT_PATTERN
+
+    Returns:
+        list or np.ndarray: Compound tokens with the drum track merged in,
+                            of the same type as tokens
+    """
+    as_list = not isinstance(tokens, np.ndarray)
+    if as_list:
+        tokens = np.fromiter(tokens, dtype=np.int64, count=len(tokens))
+    notes = tokens.reshape(-1, 5)
+    if len(notes) == 0:
+        return tokens.tolist() if as_list else tokens
+
+    end_time = int(notes[:, 0].max())
+    beat_times, bar_starts = beat_grid(midi, end_time)
+    drums = drum_events(beat_times, bar_starts, end_time, pattern)
+
+    positions = np.searchsorted(notes[:, 0], drums[:, 0], side='left')
+    merged = np.insert(notes, positions, drums.astype(notes.dtype), axis=0).ravel()
+    return merged.tolist() if as_list else merged
@@ -0,0 +1,198 @@
+"""
+Scores training checkpoints on held-out token sequences, without Trainer.
+
+The evaluation sequences come from a tokenized-events file, packed into a
+token store (see token_store.py) on first use, which later runs reuse. By
+default that is the seeded random 20% of the training file that
+finetune_amt_oneFile.py validates on. A held-out file from
+shuffle_tokens.py --valid-ratio can be scored whole with --whole.
+
+Sequences are sorted by length and batched, so padding stays small. They
+run without gradients, in any precision amt_model.py supports. The LM head
+is applied in chunks of positions, so the full vocabulary logits of a batch
+never exist at once. For every checkpoint it reports:
+
+  loss          mean cross-entropy per predicted token (and its perplexity)
+  by type       per token type: time, duration, note, control tokens, ...
+  by instrument per instrument of the note tokens predicted
+  throughput    tokens scored per second
+
+    python evaluate_checkpoints.py amt_PKMN_Harmonizer_Small
+    python evaluate_checkpoints.py ckpt/checkpoint-1000 ckpt/checkpoint-3000 --data valid.txt --whole --precision bf16
+"""
+import json
+import math
+import os
+import re
+import time
+from argparse import ArgumentParser
+
+import numpy as np
+import torch
+import torch.nn.functional as F
+
+from anticipation.config import *
+from anticipation.vocab import *
+
+import token_store
+from amt_model import PRECISIONS, load_model
+from token_stats import TYPE_NAMES, TYPE_STARTS
+
+TOKENIZED_DATA = './tokenized-events-pokemon_midis.txt'
+HEAD_CHUNK = 1024  # positions per LM head call
+
+
+def expand_checkpoints(paths):
+    """Replace every directory holding checkpoint-N subdirectories by those, in step order."""
+    checkpoints = []
+    for path in paths:
+        steps = [(int(m.group(1)), os.path.join(path, d)) for d in sorted(os.listdir(path))
+                 if (m := re.fullmatch(r'checkpoint-(\d+)', d)) and os.path.isdir(os.path.join(path, d))] \
+            if os.path.isdir(path) else []
+        checkpoints.extend([p for _, p in sorted(steps)] or [path])
+    return checkpoints
+
+
+def eval_dataset(data, whole=False, max_length=CONTEXT_SIZE):
+    """The evaluation sequences of a tokenized-events file, via its (cached) token store."""
+    prefix = os.path.splitext(data)[0]
+    if not token_store.store_is_current(prefix, data):
+        meta = token_store.convert(data, prefix)
+        print(f"Packed {meta['sequences']} sequences into {prefix} ({meta['rejected']} rejected)")
+    if whole:
+        return token_store.TokenStoreDataset(prefix, max_length=max_length)
+    return token_store.split_store(prefix, max_length=max_length)[1]
+
+
+def length_batches(dataset, batch_tokens):
+    """Batches of sample indices of similar length, with at most batch_tokens padded tokens each."""
+    lengths = dataset.lengths()
+    order = np.argsort(lengths, kind='stable')[::-1]
+    batches, batch = [], []
+    for i in order:
+        # sorted longest first, so the first sample sets the batch width
+        if batch and (len(batch) + 1) * lengths[batch[0]] > batch_tokens:
+            batches.append(batch)
+            batch = []
+        batch.append(int(i))
+    if batch:
+        batches.append(batch)
+    return batches
+
+
+@torch.no_grad()
+def token_losses(model, input_ids, attention_mask):
+    """
+    Cross-entropy of every next-token prediction of a right-padded batch.
+
+    Returns:
+        tuple: (losses, targets) of the real (unpadded) predictions, flat
+    """
+    hidden = model.base_model(input_ids=input_ids, attention_mask=attention_mask).last_hidden_state[:, :-1]
+    targets = input_ids[:, 1:]
+    real = attention_mask[:, 1:].bool()
+    hidden, targets = hidden[real], targets[real]
+
+    head = model.get_output_embeddings()
+    losses = torch.cat([F.cross_entropy(head(hidden[i:i+HEAD_CHUNK]).float(), targets[i:i+HEAD_CHUNK], reduction='none')
+                        for i in range(0, len(targets), HEAD_CHUNK)])
+    return losses.cpu(), targets.cpu()
+
+
+def evaluate(model, dataset, batch_tokens=8192):
+    """
+    Score a model on every sample of dataset.
+
+    Returns:
+        dict: loss, perplexity, tokens, tokens_per_s and the loss by token
+              type and by instrument
+    """
+    starts = torch.tensor(TYPE_STARTS)
+    # float64 sums and int64 counts stay exact far beyond 2**24 tokens
+    type_loss = torch.zeros(len(TYPE_NAMES), dtype=torch.float64)
+    type_count = torch.zeros(len(TYPE_NAMES), dtype=torch.int64)
+    instr_loss = torch.zeros(MAX_INSTR, dtype=torch.float64)
+    instr_count = torch.zeros(MAX_INSTR, dtype=torch.int64)
+
+    start = time.perf_counter()
+    for batch in length_batches(dataset, batch_tokens):
+        sequences = [dataset.sequence(i)[:dataset.max_length].astype(np.int64) for i in batch]
+        width = len(sequences[0])
+        input_ids = torch.full((len(batch), width), token_store.PAD_TOKEN, dtype=torch.long)
+        attention_mask = torch.zeros((len(batch), width), dtype=torch.long)
+        for row, tokens in enumerate(sequences):
+            input_ids[row, :len(tokens)] = torch.from_numpy(tokens)
+            attention_mask[row, :len(tokens)] = 1
+
+        losses, targets = token_losses(model, input_ids.to(model.device), attention_mask.to(model.device))
+        kinds = (torch.searchsorted(starts, targets, right=True) - 1).clamp(min=0)
+        type_loss.index_add_(0, kinds, losses.double())
+        type_count.index_add_(0, kinds, torch.ones_like(kinds))
+
+        notes = kinds == TYPE_NAMES.index('note')
+        instruments = (targets[notes] - NOTE_OFFSET) // MAX_PITCH
+        instr_loss.index_add_(0, instruments, losses[notes].double())
+        instr_count.index_add_(0, instruments, torch.ones_like(instruments))
+    seconds = time.perf_counter() - start
+
+    tokens = int(type_count.sum())
+    loss = float(type_loss.sum()) / max(tokens, 1)
+    return {
+        'loss': loss,
+        'perplexity': math.exp(loss),
+        'tokens': tokens,
+        'tokens_per_s': tokens / seconds,
+        'by_type': {name: float(type_loss[k]) / int(type_count[k])
+                    for k, name in enumerate(TYPE_NAMES) if type_count[k]},
+        'by_instrument': {i: float(instr_loss[i]) / int(instr_count[i])
+                          for i in range(MAX_INSTR) if instr_count[i]},
+    }
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser(description='scores checkpoints on held-out token sequences')
+    parser.add_argument('checkpoints', nargs='+', help='checkpoint directories, or directories of checkpoint-N')
+    parser.add_argument('--data', default=TOKENIZED_DATA, help='tokenized-events file to evaluate on')
+    parser.add_argument('--whole', action='store_true',
+                        help='score every sequence of --data instead of its validation 20%% (as split for training)')
+    parser.add_argument('--limit', type=int, default=None, help='only score the first N evaluation sequences')
+    parser.add_argument('--batch-tokens', type=int, default=8192, help='padded tokens per batch')
+    parser.add_argument('--device', default='auto', help='torch device (auto picks CUDA when available)')
+    parser.add_argument('--precision', default='fp32', choices=PRECISIONS, help='inference precision')
+    parser.add_argument('--threads', type=int, default=None, help='CPU threads for torch')
+    parser.add_argument('--json', help='also write the results to this file')
+    args = parser.parse_args()
+
+    dataset = eval_dataset(args.data, args.whole)
+    if args.limit is not None:
+        dataset.indices = dataset.indices[:args.limit]
+    print(f'Evaluating on {len(dataset)} sequences of {args.data}')
+
+    results = {}
+    for checkpoint in expand_checkpoints(args.checkpoints):
+        model = load_model(checkpoint, '', args.device, args.precision, args.threads)
+        result = results[checkpoint] = evaluate(model, dataset, args.batch_tokens)
+        del model
+        print(f"{checkpoint}: loss {result['loss']:.4f} (ppl {result['perplexity']:.2f}), "
+              f"{result['tokens_per_s']:.0f} tokens/s")
+
+    instruments = sorted({i for result in results.values() for i in result['by_instrument']})
+    types = [name for name in TYPE_NAMES if any(name in result['by_type'] for result in results.values())]
+    print()
+    print('| checkpoint | loss | ppl | tokens/s | ' + ' | '.join(types) + ' |')
+    print('|---' * (4 + len(types)) + '|')
+    for checkpoint, result in results.items():
+        print(f"| {checkpoint} | {result['loss']:.4f} | {result['perplexity']:.2f} | {result['tokens_per_s']:.0f} | "
+              + ' | '.join(f"{result['by_type'].get(name, float('nan')):.3f}" for name in types) + ' |')
+    print()
+    print('| checkpoint | ' + ' | '.join(f'instr {i}' for i in instruments) + ' |')
+    print('|---' * (1 + len(instruments)) + '|')
+    for checkpoint, result in results.items():
+        print(f'| {checkpoint} | ' + ' | '.join(f"{result['by_instrument'].get(i, float('nan')):.3f}"
+                                                 for i in instruments) + ' |')
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump({'data': args.data, 'sequences': len(dataset), 'precision': args.precision,
+                       'results': results}, f, indent=1)
+        print(f'Saved {args.json}')
@@ -0,0 +1,47 @@
+"""
+Export a checkpoint to a local model directory for fast loading.
+
+The directory holds the config, the generation config and the weights as a
+single model.safetensors file. amt_model.load_model then memory-maps the
+weights instead of unpickling a pytorch_model.bin, and never asks the hub
+for anything. When amt_model.LOCAL_MODEL exists, it is the default model
+of run_amt.py, serve_amt.py and the other scripts.
+
+    python export_model.py                                        # the hub checkpoint -> ./PokemonHarmonizer-Small
+    python export_model.py --model amt_PKMN_Harmonizer_Small --subfolder checkpoint-3000 -o ./harmonizer-3000
+"""
+import os
+import time
+from argparse import ArgumentParser
+
+from amt_model import LOCAL_MODEL, MODEL_NAME, MODEL_SUBFOLDER
+
+
+def export_model(name=MODEL_NAME, subfolder=MODEL_SUBFOLDER, output=LOCAL_MODEL):
+    """
+    Save a checkpoint (hub name or local path) as safetensors in output.
+
+    Returns:
+        int: Size of the weights written, in bytes
+    """
+    from transformers import AutoModelForCausalLM
+
+    model = AutoModelForCausalLM.from_pretrained(name, subfolder=subfolder)
+    # tied embeddings are stored once; the copy is restored when loading
+    model.save_pretrained(output, safe_serialization=True)
+    return sum(os.path.getsize(os.path.join(output, f)) for f in os.listdir(output) if f.endswith('.safetensors'))
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser(description='exports a checkpoint as a local safetensors model directory')
+    parser.add_argument('--model', default=MODEL_NAME, help='model name or path')
+    parser.add_argument('--subfolder', default=MODEL_SUBFOLDER, help='checkpoint subfolder ("" for none)')
+    parser.add_argument('-o', '--output', default=LOCAL_MODEL, help='model directory to write')
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    size = export_model(args.model, args.subfolder, args.output)
+    print(f'Exported {args.model}/{args.subfolder} to {args.output} ({size / 2**20:.1f} MB of weights) '
+          f'in {time.perf_counter() - start:.1f}s')
+    print(f'  => load it with --model {args.output} --subfolder ""' if os.path.abspath(args.output) !=
+          os.path.abspath(LOCAL_MODEL) else '  => it is now the default model')
@@ -1,10 +1,11 @@
+import json
 import os
 import sys
 import random
 # import bitsandbytes as bnb
 from datasets import load_dataset
 from torch.optim import AdamW
-from transformers import AutoModelForCausalLM, AutoTokenizer, TrainingArguments, Trainer, GPT2LMHeadModel
+from transformers import AutoModelForCausalLM, AutoTokenizer, TrainingArguments, Trainer, TrainerCallback, GPT2LMHeadModel
 from torch.utils.data import SequentialSampler, Subset
 from datasets import Dataset, DatasetDict
 from tqdm import tqdm
@@ -13,120 +14,83 @@ from torch.nn.utils.rnn import pad_sequence
 import torch
 import sys
 
-def parse_amt_tokens(token_file):
-    lines = open(token_file).readlines()
+from instrumentation import RunReport, finish
+import token_store
 
-    all_tokens = []
-
-    for l in lines:
-        token_text = l.strip()
-        tokens = [int(t) for t in token_text.split(" ")]
-        # print(len(tokens), tokens[:10])
-
-        all_tokens.append(tokens)
-
-    return all_tokens
-
-def load_tokenized_data(filename, train_ratio=0.8, seed=42, max_length=1024, vocab_size=55028):
-    data = []
-    all_tokens = parse_amt_tokens(filename)
-    for tokens in all_tokens:
-        if len(tokens) > 1 and not any([t >= vocab_size for t in tokens]):
-            # Truncate if too long
-            tokens = tokens[:max_length]
-            
-            # Pad with SEQ token
-            if len(tokens) < max_length:
-                tokens += [50256] * (max_length - len(tokens))
-
-            data.append({"input_ids": tokens, "labels": tokens.copy()})
-    else:
-        print(len(tokens))
-    if not data:
-        raise ValueError("No valid tokenized data found!")
-
-    random.seed(seed)
-    random.shuffle(data)
-    split_idx = int(len(data) * train_ratio)
-
-    ds_train = Dataset.from_list(data[:split_idx])
-    ds_valid = Dataset.from_list(data[split_idx:])
-
-    return DatasetDict({"train": ds_train, "valid": ds_valid})
-
-def debug_collate_fn(features, max_token_id=55028):
+class TokenCollator:
     """
-    A collate function that checks if any token in input_ids or labels
-    exceeds max_token_id, and if so, skips that entire sample.
+    Stacks already padded, already validated samples into a batch. Token
+    validation happens once when the dataset is built (see
+    TokenStoreDataset.validate), not per batch.
     """
-    valid_features = []
-    for i, feature in enumerate(features):
-        input_ids = feature["input_ids"]
-        labels = feature["labels"]
-        
-        # Check input_ids
-        if any(t > max_token_id for t in input_ids):
-            print(f"[WARNING] Found out-of-range token in sample {i} (input_ids): {input_ids}")
-            continue
-        
-        # Check labels
-        if any(t > max_token_id for t in labels):
-            print(f"[WARNING] Found out-of-range token in sample {i} (labels): {labels}")
-            continue
-        
-        valid_features.append(feature)
-    
-    # If every feature in the batch is invalid, raise an error (or you could return an empty batch).
-    if not valid_features:
-        raise ValueError("All samples in this batch contained out-of-range tokens!")
-    else:
-        print("Valid samples:", len(valid_features))
-    
-    # Convert to tensors.
-    batch_input_ids = [torch.tensor(f["input_ids"], dtype=torch.long) for f in valid_features]
-    batch_labels    = [torch.tensor(f["labels"],    dtype=torch.long) for f in valid_features]
-    
-    # Stack into a single batch tensor.
-    input_ids = torch.stack(batch_input_ids, dim=0)
-    labels    = torch.stack(batch_labels, dim=0)
+    def __init__(self, pin_memory=False):
+        self.pin_memory = pin_memory
 
-    return {"input_ids": input_ids, "labels": labels}
+    def __call__(self, features):
+        batch = {key: torch.stack([torch.as_tensor(f[key], dtype=torch.long) for f in features])
+                 for key in features[0]}
+        if self.pin_memory:
+            batch = {key: value.pin_memory() for key, value in batch.items()}
+        return batch
 
 
 GPT2_MODEL_NAME = "stanford-crfm/music-small-800k"
 CKPT_DIR = "amt_PKMN_Harmonizer_Small"
 SEQLEN = 1024
 LR = 1e-5
+# Tokenized songs in their original key; PITCH_SHIFT moves every training
+# sample to a random key on the fly instead of using pokemon_midis_transposed
+TOKENIZED_DATA = './tokenized-events-pokemon_midis.txt'
+PITCH_SHIFT = True
+# Packed copy of TOKENIZED_DATA (see token_store.py), built on first use
+TOKEN_STORE = os.path.splitext(TOKENIZED_DATA)[0]
+# Held-out songs written by shuffle_tokens.py --valid-ratio (TOKENIZED_DATA then
+# being its -train file); None validates on a seeded random 20% of TOKENIZED_DATA
+VALID_DATA = None
+# Concatenate short sequences into full SEQLEN blocks instead of padding each
+# one. Faster, but sequences then attend to the earlier ones in their block
+PACK_SEQUENCES = False
+# Train on the blocks in store order instead of shuffling them (SequentialTrainer)
+SEQUENTIAL = False
+# "jsonl" appends the training logs to LOG_DIR/metrics.jsonl without any
+# service; any other value is passed to report_to ("wandb", "tensorboard", "none")
+REPORT_TO = "jsonl"
+LOG_DIR = "./logs"
+
+# Data parallel training: launch one process per GPU, or per group of cores on
+# CPU-only machines, e.g.
+#   torchrun --nproc_per_node 4 finetune_amt_oneFile.py
+#   torchrun --nnodes 2 --node_rank 0 --master_addr host0 --nproc_per_node 8 finetune_amt_oneFile.py
+# Processes talk over NCCL when CUDA is available and over gloo otherwise. Each
+# one trains on its own share of every batch (Trainer shards the token store
+# samples by rank), and the gradients are averaged.
+WORLD_SIZE = int(os.environ.get("WORLD_SIZE", 1))
+LOCAL_WORLD_SIZE = int(os.environ.get("LOCAL_WORLD_SIZE", 1))
 
 class SequentialTrainer(Trainer):
     """(Shih-Lun) for fair comparison at same training steps, no shuffling"""
-    def _get_train_sampler(self):
+    def _get_train_sampler(self, *args):
+        # with several processes, each consecutive global batch is split between the ranks
         return SequentialSampler(self.train_dataset)
 
-if __name__ == "__main__":
+class JsonlLogger(TrainerCallback):
+    """Offline logging backend: one JSON line per Trainer log call, from the main process only."""
+    def __init__(self, path):
+        self.path = path
 
-    model = AutoModelForCausalLM.from_pretrained(
-        GPT2_MODEL_NAME).to("cuda")
-    
-    embedding_size = model.get_input_embeddings().num_embeddings
-    print("Model embedding size:", embedding_size)
+    def on_log(self, args, state, control, logs=None, **kwargs):
+        if state.is_world_process_zero and logs:
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            with open(self.path, "a") as f:
+                f.write(json.dumps({"step": state.global_step, "epoch": state.epoch, **logs}) + "\n")
 
-    print("total trainable params:", sum(p.numel() for p in model.parameters() if p.requires_grad))
-
-    # ENTER PATH TO TOKENIZED MIDI FILES HERE
-    dataset_dict = load_tokenized_data('./tokenized-events-pokemon_midis_transposed.txt')
-    ds_train = dataset_dict["train"]
-    ds_valid = dataset_dict["valid"]
-
-    for i, sample in enumerate(ds_train):
-      for t in sample["input_ids"]:
-            if t >= embedding_size:
-                print(f"Out-of-range token found in sample {i}, token={t}")
-
-    print(ds_train[0])
-    optimizer = AdamW(model.parameters(), lr=LR)
+if __name__ == "__main__":
+    cuda = torch.cuda.is_available()
+    if not cuda and WORLD_SIZE > 1:
+        # the processes on a machine share its cores instead of each using all of them
+        torch.set_num_threads(max(1, (os.cpu_count() or 1) // LOCAL_WORLD_SIZE))
 
-    # Training arguments
+    # Training arguments (created first: they set up torch.distributed under torchrun)
     training_args = TrainingArguments(
         output_dir=CKPT_DIR,
         learning_rate=LR,
@@ -136,27 +100,92 @@ if __name__ == "__main__":
         lr_scheduler_type="cosine",
         max_steps=3000,
         save_steps=1000,
-        logging_dir="./logs",
+        logging_dir=LOG_DIR,
         eval_steps=2000,
         logging_steps=10,
-        bf16=True,  # Enable mixed precision
-        report_to="wandb",
+        bf16=cuda,  # Enable mixed precision
+        use_cpu=not cuda,
+        ddp_backend="nccl" if cuda else "gloo",
+        ddp_find_unused_parameters=False,  # every GPT-2 parameter gets a gradient
+        report_to="none" if REPORT_TO == "jsonl" else REPORT_TO,
         dataloader_num_workers=4,
+        # pinned host batches are copied to the GPU with non_blocking=True
+        dataloader_pin_memory=cuda,
+        accelerator_config={"non_blocking": True},
         do_eval=True,
         gradient_accumulation_steps=4,
-        save_safetensors=False,
+        save_safetensors=True,  # memory-mapped when loading (see export_model.py)
     )
+    main_process = training_args.process_index == 0
+
+    # Stage timings and data counts go to run-reports/finetune-<timestamp>.json
+    report = RunReport("finetune")
+    report.info["world_size"] = training_args.world_size
+
+    # Trainer moves the model to this process's device
+    with report.timer("load model"), training_args.main_process_first(desc="model download"):
+        model = AutoModelForCausalLM.from_pretrained(
+            GPT2_MODEL_NAME)
+    
+    embedding_size = model.get_input_embeddings().num_embeddings
+    print("Model embedding size:", embedding_size)
+
+    print("total trainable params:", sum(p.numel() for p in model.parameters() if p.requires_grad))
+
+    # ENTER PATH TO TOKENIZED MIDI FILES HERE
+    # (the first process of the whole run packs the token stores while the
+    # others wait for it: they are shared by every node)
+    with report.timer("token store"), training_args.main_process_first(local=False, desc="token store"):
+        stores = {TOKEN_STORE: TOKENIZED_DATA}
+        if VALID_DATA:
+            stores[os.path.splitext(VALID_DATA)[0]] = VALID_DATA
+        for store, data in stores.items():
+            if not token_store.store_is_current(store, data):
+                meta = token_store.convert(data, store)
+                print(f"Packed {meta['sequences']} sequences into {store} ({meta['rejected']} rejected)")
+                report.count("bytes_read", os.path.getsize(data))
+                report.discard("too short or out-of-vocabulary tokens", meta['rejected'])
+        if VALID_DATA:
+            ds_train = token_store.TokenStoreDataset(TOKEN_STORE, max_length=SEQLEN, pitch_shift=PITCH_SHIFT)
+            ds_valid = token_store.TokenStoreDataset(os.path.splitext(VALID_DATA)[0], max_length=SEQLEN)
+        else:
+            ds_train, ds_valid = token_store.split_store(TOKEN_STORE, max_length=SEQLEN, pitch_shift=PITCH_SHIFT)
+
+    with report.timer("validate"):
+        for name, ds in (("train", ds_train), ("valid", ds_valid)):
+            validation = ds.validate(embedding_size)
+            print(f"Validated {validation['checked']} {name} sequences: rejected {validation['rejected']} "
+                  f"with tokens >= {embedding_size} {validation['rejected_ids'][:10]}")
+            report.count(f"{name}_sequences", validation['checked'] - validation['rejected'])
+            report.discard(f"token >= {embedding_size}", validation['rejected'])
+
+    if PACK_SEQUENCES:
+        with report.timer("pack"):
+            padded = ds_train.padding_efficiency()
+            ds_train, ds_valid = token_store.PackedTokenDataset(ds_train), token_store.PackedTokenDataset(ds_valid)
+        print(f"Packed {len(ds_train.base)} training sequences into {len(ds_train)} blocks: "
+              f"{100*ds_train.efficiency():.1f}% real tokens (vs {100*padded:.1f}% when padding)")
+        report.count("train_blocks", len(ds_train))
+
+    if main_process:
+        print(ds_train[0])
+    optimizer = AdamW(model.parameters(), lr=LR)
 
     # Trainer
-    trainer = Trainer(
+    trainer = (SequentialTrainer if SEQUENTIAL else Trainer)(
         model=model,
         args=training_args,
         train_dataset=ds_train,
         eval_dataset=ds_valid,
         optimizers=(optimizer, None),
-        data_collator=debug_collate_fn,  # Add this
+        data_collator=TokenCollator(),
+        callbacks=[JsonlLogger(os.path.join(LOG_DIR, "metrics.jsonl"))] if REPORT_TO == "jsonl" else None,
     )
 
 
     # Train
-    trainer.train()
\ No newline at end of file
+    with report.timer("train"):
+        metrics = trainer.train().metrics
+    report.info.update(metrics)
+    if main_process:
+        finish(report, None)
\ No newline at end of file
@@ -0,0 +1,243 @@
+"""
+A content-addressed, size-bounded cache of generation results on disk.
+
+A result is keyed by the hash of the checkpoint's weights (and the precision
+it runs in), the hash of the input melody, the sampling parameters and the
+seed, so an identical request is answered without decoding. Only seeded
+requests are cached: without a seed, sampling again is the point.
+
+Each entry is an events file (<key>.json) and its MIDI rendering
+(<key>.mid), written to a temporary name and renamed into place. A SQLite
+index next to them records their size and last use and the hit/miss
+counters, so several processes (run_amt.py runs, serve_amt.py) can share
+one cache directory. Once the entries outgrow max_bytes, the least
+recently used ones are deleted.
+
+    python run_amt.py --melody ./pokemon_midis/Hearthome-City.mid --seed 0   # a second run is a cache hit
+    python generation_cache.py stats
+    python generation_cache.py trim --max-mb 200
+"""
+import hashlib
+import json
+import os
+import sqlite3
+import tempfile
+import time
+from argparse import ArgumentParser
+from contextlib import contextmanager
+
+from midi_index import hash_file
+
+CACHE_DIR = '.generation-cache'
+MAX_BYTES = 1 << 30
+# files of a checkpoint that determine its outputs (not the optimizer state)
+WEIGHT_FILES = ('config.json', 'model.safetensors', 'pytorch_model.bin')
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS entries (
+    key TEXT PRIMARY KEY,
+    bytes INTEGER, created REAL, last_used REAL, hits INTEGER DEFAULT 0
+);
+CREATE INDEX IF NOT EXISTS entries_by_use ON entries(last_used);
+CREATE TABLE IF NOT EXISTS stats (name TEXT PRIMARY KEY, value INTEGER);
+CREATE TABLE IF NOT EXISTS checkpoint_files (
+    path TEXT PRIMARY KEY,
+    size INTEGER, mtime REAL, hash TEXT
+);
+"""
+COUNTERS = ('hits', 'misses', 'stores', 'evictions')
+
+
+def checkpoint_dir(name, subfolder=''):
+    """Local directory of a checkpoint given as load_model takes it (downloaded from the hub if needed)."""
+    path = os.path.join(name, subfolder) if subfolder else name
+    if os.path.isdir(path):
+        return path
+    from huggingface_hub import snapshot_download
+    return os.path.join(snapshot_download(name, allow_patterns=[f'{subfolder}/*' if subfolder else '*']), subfolder)
+
+
+class GenerationCache:
+    """
+    Args:
+        root (str): Cache directory
+        max_bytes (int): Size of the entries above which the least recently
+                         used ones are evicted
+    """
+
+    def __init__(self, root=CACHE_DIR, max_bytes=MAX_BYTES):
+        self.root = root
+        self.max_bytes = max_bytes
+        os.makedirs(os.path.join(root, 'entries'), exist_ok=True)
+        with self.connect() as conn:
+            conn.executescript(SCHEMA)
+
+    @contextmanager
+    def connect(self):
+        """A connection running one transaction, committed on exit."""
+        # one connection per operation: connections cannot be shared between
+        # threads, and short transactions keep other processes waiting little
+        conn = sqlite3.connect(os.path.join(self.root, 'index.sqlite'), timeout=60)
+        try:
+            with conn:
+                yield conn
+        finally:
+            conn.close()
+
+    def path(self, key, suffix):
+        return os.path.join(self.root, 'entries', key + suffix)
+
+    def checkpoint_hash(self, directory, precision='fp32'):
+        """
+        Hash of the weights and config of a checkpoint directory, and the
+        precision it runs in. Files are only hashed again when their size or
+        mtime changed.
+        """
+        h = hashlib.sha1(precision.encode())
+        with self.connect() as conn:
+            for name in WEIGHT_FILES:
+                filename = os.path.abspath(os.path.join(directory, name))
+                if not os.path.exists(filename):
+                    continue
+                stat = os.stat(filename)
+                row = conn.execute('SELECT size, mtime, hash FROM checkpoint_files WHERE path = ?',
+                                   (filename,)).fetchone()
+                if row is None or row[:2] != (stat.st_size, stat.st_mtime):
+                    row = (stat.st_size, stat.st_mtime, hash_file(filename))
+                    conn.execute('INSERT OR REPLACE INTO checkpoint_files VALUES (?, ?, ?, ?)', (filename, *row))
+                h.update(f'{name}:{row[2]}'.encode())
+        return h.hexdigest()
+
+    @staticmethod
+    def key(checkpoint, melody, seed, **params):
+        """
+        Key of a request.
+
+        Args:
+            checkpoint (str): checkpoint_hash of the model
+            melody (list): Input tokens (None when generating from scratch)
+            seed (int): Sampling seed
+            params: Every other option that changes the result (task,
+                    length, top_p, active_instruments, ...)
+        """
+        melody_hash = None if melody is None else hashlib.sha1(json.dumps(list(melody)).encode()).hexdigest()
+        request = {'checkpoint': checkpoint, 'melody': melody_hash, 'seed': seed, 'params': params}
+        return hashlib.sha1(json.dumps(request, sort_keys=True).encode()).hexdigest()
+
+    def _count(self, conn, name, n=1):
+        conn.execute('INSERT INTO stats VALUES (?, ?) ON CONFLICT(name) DO UPDATE SET value = value + ?',
+                     (name, n, n))
+
+    def get(self, key):
+        """
+        The cached events of a request, or None on a miss. The MIDI file of
+        a hit is at path(key, '.mid').
+        """
+        try:
+            with open(self.path(key, '.json')) as f:
+                events = json.load(f)['events']
+        except (FileNotFoundError, json.JSONDecodeError, KeyError):
+            events = None
+
+        with self.connect() as conn:
+            if events is not None and conn.execute('UPDATE entries SET last_used = ?, hits = hits + 1 WHERE key = ?',
+                                                   (time.time(), key)).rowcount:
+                self._count(conn, 'hits')
+                return events
+            self._count(conn, 'misses')
+        return None
+
+    def _write(self, key, suffix, write):
+        fd, tmp = tempfile.mkstemp(dir=os.path.join(self.root, 'entries'), suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                write(f)
+            os.replace(tmp, self.path(key, suffix))
+        except BaseException:
+            os.remove(tmp)
+            raise
+        return os.path.getsize(self.path(key, suffix))
+
+    def put(self, key, events, midi=None, request=None):
+        """
+        Store the events of a request, and its MIDI rendering (a mido.MidiFile)
+        when given. request is kept alongside the events for inspection.
+        """
+        data = json.dumps({'request': request, 'events': events}).encode()
+        with self.connect() as conn:
+            conn.execute('BEGIN IMMEDIATE')  # the files and their row change together
+            size = self._write(key, '.json', lambda f: f.write(data))
+            if midi is not None:
+                size += self._write(key, '.mid', lambda f: midi.save(file=f))
+            now = time.time()
+            conn.execute('INSERT OR REPLACE INTO entries (key, bytes, created, last_used) VALUES (?, ?, ?, ?)',
+                         (key, size, now, now))
+            self._count(conn, 'stores')
+        self.trim()
+
+    def trim(self, max_bytes=None):
+        """
+        Evict least recently used entries until the cache holds at most max_bytes.
+
+        Returns:
+            int: Number of entries evicted
+        """
+        max_bytes = self.max_bytes if max_bytes is None else max_bytes
+        with self.connect() as conn:
+            conn.execute('BEGIN IMMEDIATE')  # one process evicts at a time
+            total = conn.execute('SELECT COALESCE(SUM(bytes), 0) FROM entries').fetchone()[0]
+            evicted = []
+            for key, size in conn.execute('SELECT key, bytes FROM entries ORDER BY last_used').fetchall():
+                if total <= max_bytes:
+                    break
+                evicted.append(key)
+                total -= size
+            conn.executemany('DELETE FROM entries WHERE key = ?', [(key,) for key in evicted])
+            self._count(conn, 'evictions', len(evicted))
+            # inside the transaction, so a concurrent put of the same key waits
+            for key in evicted:
+                for suffix in ('.json', '.mid'):
+                    try:
+                        os.remove(self.path(key, suffix))
+                    except FileNotFoundError:
+                        pass
+        return len(evicted)
+
+    def stats(self):
+        """Counters shared by every user of the cache, with the number and size of the entries."""
+        with self.connect() as conn:
+            counters = dict(conn.execute('SELECT name, value FROM stats'))
+            entries, size = conn.execute('SELECT COUNT(*), COALESCE(SUM(bytes), 0) FROM entries').fetchone()
+        stats = {name: counters.get(name, 0) for name in COUNTERS}
+        stats.update(entries=entries, bytes=size,
+                     hit_rate=stats['hits'] / max(stats['hits'] + stats['misses'], 1))
+        return stats
+
+
+def add_cache_arguments(parser):
+    """Add the --cache-dir/--cache-mb/--no-cache options."""
+    parser.add_argument('--cache-dir', default=CACHE_DIR, help='generation cache directory')
+    parser.add_argument('--cache-mb', type=float, default=MAX_BYTES / 2**20, help='size of the generation cache')
+    parser.add_argument('--no-cache', action='store_true', help='neither read nor write the generation cache')
+
+
+def cache_from_args(args):
+    return None if args.no_cache else GenerationCache(args.cache_dir, int(args.cache_mb * 2**20))
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser(description='inspects and trims the generation cache')
+    parser.add_argument('command', choices=('stats', 'trim', 'clear'))
+    parser.add_argument('--cache-dir', default=CACHE_DIR, help='generation cache directory')
+    parser.add_argument('--max-mb', type=float, default=MAX_BYTES / 2**20, help='size to trim the cache to')
+    args = parser.parse_args()
+
+    cache = GenerationCache(args.cache_dir)
+    if args.command == 'stats':
+        stats = cache.stats()
+        print(f"{args.cache_dir}: {stats['entries']} entries, {stats['bytes'] / 2**20:.1f} MB")
+        print(f"  => {stats['hits']} hits, {stats['misses']} misses ({stats['hit_rate']:.0%} hit rate)")
+        print(f"  => {stats['stores']} stored, {stats['evictions']} evicted")
+    else:
+        evicted = cache.trim(0 if args.command == 'clear' else int(args.max_mb * 2**20))
+        print(f'Evicted {evicted} entries')
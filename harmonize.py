@@ -0,0 +1,105 @@
+"""
+Harmonization of full-length melodies in overlapping windows.
+
+The model only represents times up to MAX_TIME_IN_SECONDS, so a 2-3 minute
+song has to be generated in several windows, and generating them one after
+the other takes one window of wall-clock time each. Here the song is cut into segments of `segment` seconds and every
+window is generated in local time (starting at 0), in two batched passes:
+
+  1. Even segments (0, 2, 4, ...) are generated together, each conditioned on
+     the melody of its segment only.
+  2. Odd segments are generated together. Each one is a window that starts
+     `context` seconds early, with the end of the accompaniment of the
+     previous segment as its prompt and the start of the next segment's
+     accompaniment as anticipated future events. Both of its seams are
+     therefore generated knowing the music on the other side.
+
+Each pass is one amt_sampling.generate_batch call, so a song takes about two
+windows of wall-clock time however long it is. The segments are then
+translated back to song time and joined; run_amt.py adds the melody back with
+ops.combine and trims the result with ops.clip.
+
+    python run_amt.py --melody ./pokemon_midis/Hearthome-City.mid -o Hearthome-harmonized.mid
+"""
+from anticipation import ops
+from anticipation.config import *
+from anticipation.vocab import *
+
+ACCOMPANIMENT_INSTRUMENTS = [1, 40, 41, 42, 43]
+SEGMENT = 30  # seconds generated by each window
+CONTEXT = 5   # seconds of neighbouring accompaniment an odd window sees on each side
+
+
+def plan_segments(length, segment=SEGMENT):
+    """(start, end) of every segment of a song, in time steps."""
+    length, segment = int(TIME_RESOLUTION*length), int(TIME_RESOLUTION*segment)
+    return [(start, min(start + segment, length)) for start in range(0, length, segment)]
+
+
+def window(tokens, start, end):
+    """The tokens with onsets in [start, end) time steps, moved so that start is time 0."""
+    if end <= start:
+        return []
+    return ops.translate(ops.clip(tokens, start, end - 1, clip_duration=False, seconds=False), -start)
+
+
+def harmonize_melody(model, melody, length=None, segment=SEGMENT, context=CONTEXT, top_p=.98,
+                     active_instruments=ACCOMPANIMENT_INSTRUMENTS, seed=None, window_stride=None):
+    """
+    Generate an accompaniment for a melody of any length.
+
+    Args:
+        model: Causal LM with the anticipation vocabulary
+        melody (list): Melody as anticipation controls, in song time
+        length (float): Seconds to harmonize (defaults to the end of the last melody note)
+        segment (float): Seconds generated by each window
+        context (float): Seconds of neighbouring accompaniment around odd windows
+        seed (int): Sampling seed; segment k uses seed + k
+        window_stride (int): See amt_sampling.generate_batch (None for its default)
+
+    Returns:
+        list: Accompaniment events, in song time
+    """
+    from amt_sampling import generate_batch, WINDOW_STRIDE  # imports torch
+
+    window_stride = WINDOW_STRIDE if window_stride is None else window_stride
+    if segment + 2*context > MAX_TIME_IN_SECONDS:
+        raise ValueError(f'windows of {segment + 2*context:g}s do not fit in {MAX_TIME_IN_SECONDS}s of model time')
+    if length is None:
+        length = max((time - ATIME_OFFSET + dur - ADUR_OFFSET for time, dur in zip(melody[0::3], melody[1::3])),
+                     default=0) / TIME_RESOLUTION
+    segments = plan_segments(length, segment)
+    ctx = int(TIME_RESOLUTION*context)
+    accompaniment = [None] * len(segments)
+
+    def request(k, **kwargs):
+        return dict(top_p=top_p, active_instruments=active_instruments,
+                    seed=None if seed is None else seed + k, **kwargs)
+
+    # pass 1: even segments, from the melody alone
+    even = list(range(0, len(segments), 2))
+    requests = []
+    for k in even:
+        start, end = segments[k]
+        requests.append(request(k, start_time=0, end_time=(end - start)/TIME_RESOLUTION,
+                                controls=window(melody, start, end + ctx)))
+    for k, events in zip(even, generate_batch(model, requests, window_stride=window_stride)):
+        start, end = segments[k]
+        accompaniment[k] = window(events, 0, end - start)
+
+    # pass 2: odd segments, between the accompaniment of their neighbours
+    odd = list(range(1, len(segments), 2))
+    requests = []
+    for k in odd:
+        start, end = segments[k]
+        previous = segments[k-1][0]
+        before = window(accompaniment[k-1], start - ctx - previous, start - previous)
+        after = ops.translate(window(accompaniment[k+1], 0, ctx), end - start + ctx) if k + 1 < len(segments) else []
+        requests.append(request(k, start_time=context, end_time=context + (end - start)/TIME_RESOLUTION,
+                                inputs=ops.sort(before + after), controls=window(melody, start - ctx, end + ctx)))
+    for k, events in zip(odd, generate_batch(model, requests, window_stride=window_stride)):
+        start, end = segments[k]
+        accompaniment[k] = window(events, ctx, ctx + end - start)
+
+    return ops.sort([token for k, (start, _) in enumerate(segments)
+                     for token in ops.translate(accompaniment[k], start)])
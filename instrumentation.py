@@ -0,0 +1,221 @@
+"""
+Run reports for the data pipeline scripts (transpose.py, midi-preprocess.py,
+tokenize-custom.py and finetune_amt_oneFile.py).
+
+Workers wrap each unit of work (a MIDI file, a compound file) in timed_call.
+It returns a small record with the wall and CPU time of the call and the
+bytes the process read and wrote meanwhile. The script collects these
+records in a RunReport together with stage timings, counters and discard
+reasons, prints a summary and writes everything as JSON:
+
+    run-reports/<stage>-<timestamp>.json
+      {"stage", "argv", "started", "finished", "stages": {name: {"wall_s", "cpu_s"}},
+       "counters", "discards": {reason: count}, "totals", "slowest", "items", "info"}
+
+Comparing the reports of successive runs shows throughput regressions, and
+"slowest" names the files that dominate a run. With --profile-slowest N the
+N slowest files are processed again after the run, in the main process. By
+default this runs under cProfile and writes one .prof per file (for pstats
+or snakeviz). With --profile-mode serial the files run plainly, one after
+the other, so py-spy can attach to the process (py-spy record --pid <pid>).
+"""
+import cProfile
+import json
+import os
+import resource
+import sys
+import time
+from collections import Counter
+from contextlib import contextmanager
+
+REPORT_DIR = 'run-reports'
+PROFILE_MODES = ('cprofile', 'serial')
+
+
+def io_counters():
+    """(bytes read, bytes written) by this process so far, or None where /proc/self/io is unavailable."""
+    try:
+        with open('/proc/self/io') as f:
+            fields = dict(line.split(':', 1) for line in f)
+        return int(fields['rchar']), int(fields['wchar'])
+    except (OSError, KeyError, ValueError):
+        return None
+
+
+def cpu_time(children=False):
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    total = usage.ru_utime + usage.ru_stime
+    if children:
+        usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+        total += usage.ru_utime + usage.ru_stime
+    return total
+
+
+def timed_call(fn, *args, **kwargs):
+    """
+    Call fn and measure it.
+
+    Returns:
+        tuple: (result of fn, record) with record holding wall_s, cpu_s,
+               bytes_read and bytes_written (None when not measurable)
+    """
+    io_start = io_counters()
+    cpu_start = time.process_time()
+    start = time.perf_counter()
+    result = fn(*args, **kwargs)
+    record = {'wall_s': time.perf_counter() - start, 'cpu_s': time.process_time() - cpu_start,
+              'bytes_read': None, 'bytes_written': None}
+    io_end = io_counters()
+    if io_start is not None and io_end is not None:
+        record['bytes_read'] = io_end[0] - io_start[0]
+        record['bytes_written'] = io_end[1] - io_start[1]
+    return result, record
+
+
+class RunReport:
+    """
+    Collects the measurements of one run of a pipeline stage.
+
+    Items are per-file records (see timed_call) with at least a 'file' key,
+    optionally 'status', 'reason' (why the file was discarded) and
+    'sequences' (sequences it produced).
+    """
+
+    def __init__(self, stage, path=None):
+        self.stage = stage
+        self.started = time.strftime('%Y-%m-%dT%H:%M:%S')
+        self.path = path or os.path.join(REPORT_DIR, f"{stage}-{time.strftime('%Y%m%d-%H%M%S')}.json")
+        self.stages = {}
+        self.counters = Counter()
+        self.discards = Counter()
+        self.items = []
+        self.info = {}  # anything else worth keeping, e.g. trainer metrics
+
+    @contextmanager
+    def timer(self, name):
+        """Time a stage of the run, including the CPU time of worker processes reaped inside it."""
+        cpu_start = cpu_time(children=True)
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            entry = self.stages.setdefault(name, {'wall_s': 0., 'cpu_s': 0.})
+            entry['wall_s'] += time.perf_counter() - start
+            entry['cpu_s'] += cpu_time(children=True) - cpu_start
+
+    def add(self, record):
+        self.items.append(record)
+        self.counters['files'] += 1
+        if 'sequences' in record:
+            self.counters['sequences'] += record['sequences']
+        if record.get('reason'):
+            self.discards[record['reason']] += 1
+
+    def count(self, name, n=1):
+        self.counters[name] += n
+
+    def discard(self, reason, n=1):
+        if n:
+            self.discards[reason] += n
+
+    def slowest(self, n=10):
+        return sorted(self.items, key=lambda item: item['wall_s'], reverse=True)[:n]
+
+    def totals(self):
+        def total(key):
+            values = [item[key] for item in self.items if item.get(key) is not None]
+            return sum(values) if values else None
+
+        totals = {key: total(key) for key in ('wall_s', 'cpu_s', 'bytes_read', 'bytes_written')}
+        for key in ('bytes_read', 'bytes_written'):
+            if totals[key] is None and key in self.counters:  # counted per run rather than per file
+                totals[key] = self.counters[key]
+        wall = sum(stage['wall_s'] for stage in self.stages.values())
+        if wall:
+            totals['files_per_s'] = self.counters['files'] / wall
+            totals['sequences_per_s'] = self.counters['sequences'] / wall
+        return totals
+
+    def summary(self, n=5):
+        """Printable lines: stage times, totals, discard reasons and the n slowest files."""
+        totals = self.totals()
+        lines = [f"{name}: {stage['wall_s']:.2f}s wall, {stage['cpu_s']:.2f}s CPU" for name, stage in self.stages.items()]
+        counters = ', '.join(f'{count} {name}' for name, count in self.counters.items())
+        if counters:
+            lines.append(counters)
+        io = [f'{verb} {totals[key]/2**20:.1f} MB' for verb, key in (('read', 'bytes_read'), ('wrote', 'bytes_written'))
+              if totals[key] is not None]
+        if io:
+            lines.append(', '.join(io))
+        for reason, count in self.discards.most_common():
+            lines.append(f'discarded {count}: {reason}')
+        for item in self.slowest(n):
+            lines.append(f"slow: {item['file']} {item['wall_s']:.3f}s")
+        return lines
+
+    def write(self):
+        report = {
+            'stage': self.stage,
+            'argv': sys.argv,
+            'started': self.started,
+            'finished': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'stages': self.stages,
+            'counters': dict(self.counters),
+            'discards': dict(self.discards),
+            'totals': self.totals(),
+            'slowest': self.slowest(20),
+            'items': self.items,
+            'info': self.info,
+        }
+        os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+        tmp = f'{self.path}.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(report, f, indent=1)
+        os.replace(tmp, self.path)
+        return self.path
+
+
+def profile_items(fn, items, out_dir, mode='cprofile'):
+    """
+    Process report items again with fn(item) in this process, for profiling.
+
+    Returns:
+        list: The .prof files written (empty in serial mode)
+    """
+    print(f'Profiling {len(items)} files in process {os.getpid()} ({mode})')
+    written = []
+    for item in items:
+        if mode == 'serial':
+            fn(item)
+            continue
+        os.makedirs(out_dir, exist_ok=True)
+        profile = cProfile.Profile()
+        profile.runcall(fn, item)
+        out = os.path.join(out_dir, item['file'].replace(os.sep, '_') + '.prof')
+        profile.dump_stats(out)
+        written.append(out)
+    return written
+
+
+def add_report_arguments(parser):
+    parser.add_argument('--report', help=f'run report path (defaults to {REPORT_DIR}/<stage>-<timestamp>.json)')
+    parser.add_argument('--profile-slowest', type=int, default=0, metavar='N',
+                        help='after the run, process the N slowest files again for profiling')
+    parser.add_argument('--profile-mode', choices=PROFILE_MODES, default='cprofile',
+                        help='cprofile: one .prof per file; serial: plain re-run for py-spy')
+
+
+def finish(report, args, profile_fn=None):
+    """
+    Print the summary, write the report and run the requested profiling:
+    profile_fn(item) processes the file of a report item again.
+    """
+    path = report.write()
+    for line in report.summary():
+        print(f'  => {line}')
+    print(f'Run report: {path}')
+
+    if getattr(args, 'profile_slowest', 0) and profile_fn is not None:
+        out_dir = os.path.splitext(path)[0] + '-profiles'
+        for out in profile_items(profile_fn, report.slowest(args.profile_slowest), out_dir, args.profile_mode):
+            print(f'  wrote {out}')
@@ -1,78 +1,174 @@
+import hashlib
+import json
+import os
 import traceback
 from argparse import ArgumentParser
 from concurrent.futures import ProcessPoolExecutor
 from functools import partial
 from glob import glob
 
+import mido
 from tqdm import tqdm
 
 from anticipation.convert import midi_to_compound
 from anticipation.config import PREPROC_WORKERS, TIME_RESOLUTION
 
-def addDrumToCompound(tokens):
-    it = iter(tokens)
-
-    BEAT_LENGTH = TIME_RESOLUTION // 2
-    BAR_LENGTH = BEAT_LENGTH * 4
-
-    newTokens = []
-    nextBeat = 0
-
-    for (time_in_ticks,duration,note,instrument,velocity) in zip(it,it,it,it,it):
-        if time_in_ticks >= nextBeat:
-            if nextBeat % BAR_LENGTH == 0:
-                newTokens.append(nextBeat)
-                newTokens.append(BAR_LENGTH-1)
-                newTokens.append(36)
-                newTokens.append(128)
-                newTokens.append(100)
-            newTokens.append(nextBeat)
-            newTokens.append(BEAT_LENGTH-1)
-            newTokens.append(42)
-            newTokens.append(128)
-            newTokens.append(100)
-            nextBeat += BEAT_LENGTH
-        newTokens.append(time_in_ticks)
-        newTokens.append(duration)
-        newTokens.append(note)
-        newTokens.append(instrument)
-        newTokens.append(velocity)
-
-    return newTokens
-
-def convert_midi(filename, addDrum=False, debug=False):
+from compound_format import BINARY_SUFFIX, TEXT_SUFFIX, write_compound, write_text
+from drums import DEFAULT_PATTERN, add_drum_track, load_pattern
+from instrumentation import RunReport, add_report_arguments, finish, timed_call
+
+MANIFEST_NAME = '.compound-manifest.json'
+
+def addDrumToCompound(tokens, midi=None, pattern=DEFAULT_PATTERN):
+    """
+    Add a drum track underneath compound tokens. The beat grid follows the
+    tempo and time signature changes of midi when given (120 bpm 4/4
+    otherwise); see drums.py for the pattern format.
+    """
+    return add_drum_track(tokens, midi=midi, pattern=pattern)
+
+def output_path(filename, fmt='binary'):
+    return filename + (BINARY_SUFFIX if fmt == 'binary' else TEXT_SUFFIX)
+
+
+def convert_midi(filename, addDrum=False, fmt='binary', pattern=DEFAULT_PATTERN, debug=False):
+    """
+    Write the compound tokens of a MIDI file next to it.
+
+    Returns:
+        tuple: (status, reason) with status 0 on success and 1 if the file
+               was discarded, reason saying why (None on success)
+    """
+    step = 'unreadable MIDI'
     try:
-        tokens = midi_to_compound(filename, debug=debug)
+        midi = mido.MidiFile(filename)
+        step = 'compound conversion'
+        tokens = midi_to_compound(midi, debug=debug)
         if addDrum:
-            tokens = addDrumToCompound(tokens)
-    except Exception:
+            step = 'drum track'
+            tokens = addDrumToCompound(tokens, midi=midi, pattern=pattern)
+    except Exception as e:
         if debug:
             print('Failed to process: ', filename)
             print(traceback.format_exc())
 
-        return 1
+        return 1, f'{step} ({type(e).__name__})'
+
+    if fmt == 'binary':
+        write_compound(output_path(filename, fmt), tokens, name=os.path.basename(filename))
+    else:
+        write_text(output_path(filename, fmt), tokens)
 
-    with open(f"{filename}.compound.txt", 'w') as f:
-        f.write(' '.join(str(tok) for tok in tokens))
+    return 0, None
 
-    return 0
+
+def hash_file(filename):
+    h = hashlib.sha1()
+    with open(filename, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def load_manifest(path):
+    """
+    The manifest maps each source file (relative to the dataset directory) to
+    the content hash and preprocessing options its output was built from.
+    """
+    if not os.path.exists(path):
+        return {}
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        print(f'Ignoring unreadable manifest {path}')
+        return {}
+
+
+def save_manifest(path, manifest):
+    tmp = f'{path}.tmp'
+    with open(tmp, 'w') as f:
+        json.dump(manifest, f, indent=1, sort_keys=True)
+    os.replace(tmp, path)
 
 
 def main(args):
+    report = RunReport('preprocess', args.report)
     filenames = glob(args.dir + '/**/*.mid', recursive=True) \
             + glob(args.dir + '/**/*.midi', recursive=True)
-    
-    convert_midi_partial = partial(convert_midi, addDrum=args.add_drum)
-
-    print(f'Preprocessing {len(filenames)} files with {PREPROC_WORKERS} workers')
-    with ProcessPoolExecutor(max_workers=PREPROC_WORKERS) as executor:
-        results = list(tqdm(executor.map(convert_midi_partial, filenames), desc='Preprocess', total=len(filenames)))
 
-    discards = round(100*sum(results)/float(len(filenames)),2)
-    print(f'Successfully processed {len(filenames) - sum(results)} files (discarded {discards}%)')
+    pattern = load_pattern(args.drum_pattern) if args.drum_pattern else DEFAULT_PATTERN
+    options = {'add_drum': args.add_drum, 'time_resolution': TIME_RESOLUTION, 'format': args.format}
+    if args.add_drum:
+        options['drum_pattern'] = pattern
+    manifest_path = os.path.join(args.dir, MANIFEST_NAME)
+    manifest = {} if args.force else load_manifest(manifest_path)
+
+    # Outputs whose source disappeared are stale
+    keys = {os.path.relpath(f, args.dir): f for f in filenames}
+    for key in set(manifest) - set(keys):
+        stale = os.path.join(args.dir, manifest.pop(key)['output'])
+        if os.path.exists(stale):
+            os.remove(stale)
+
+    # Only re-hash files whose size or mtime changed since the last run
+    stats = {key: os.stat(f) for key, f in keys.items()}
+    rehash = [key for key in keys
+              if key not in manifest
+              or manifest[key]['size'] != stats[key].st_size
+              or manifest[key]['mtime'] != stats[key].st_mtime]
+
+    with report.timer('preprocess'), ProcessPoolExecutor(max_workers=PREPROC_WORKERS) as executor:
+        hashes = {key: entry['hash'] for key, entry in manifest.items()}
+        hashes.update(zip(rehash, executor.map(hash_file, [keys[k] for k in rehash])))
+
+        hits, misses = [], []
+        for key, filename in keys.items():
+            entry = manifest.get(key)
+            if entry is not None and entry['hash'] == hashes[key] and entry['options'] == options \
+                    and (entry['status'] != 0 or os.path.exists(os.path.join(args.dir, entry['output']))):
+                hits.append(key)
+            else:
+                misses.append(key)
+                # Never leave an output built from an older version of the source around
+                for fmt in ('binary', 'text'):
+                    if os.path.exists(output_path(filename, fmt)):
+                        os.remove(output_path(filename, fmt))
+
+        print(f'Cache: {len(hits)} hits, {len(misses)} misses')
+        report.count('cached', len(hits))
+
+        convert_midi_partial = partial(convert_midi, addDrum=args.add_drum, fmt=args.format, pattern=pattern)
+
+        print(f'Preprocessing {len(misses)} files with {PREPROC_WORKERS} workers')
+        results = list(tqdm(executor.map(timed_call, [convert_midi_partial] * len(misses), [keys[k] for k in misses]),
+                            desc='Preprocess', total=len(misses)))
+
+    for key, ((status, reason), record) in zip(misses, results):
+        report.add({'file': key, 'path': keys[key], 'status': status, 'reason': reason,
+                    'sequences': 1 - status, **record})
+        manifest[key] = {
+            'hash': hashes[key],
+            'size': stats[key].st_size,
+            'mtime': stats[key].st_mtime,
+            'options': options,
+            'output': os.path.relpath(output_path(keys[key], args.format), args.dir),
+            'status': status,
+        }
+    save_manifest(manifest_path, manifest)
+
+    failed = sum(manifest[key]['status'] for key in keys)
+    discards = round(100*failed/float(len(filenames)),2) if filenames else 0.0
+    print(f'Successfully processed {len(filenames) - failed} files (discarded {discards}%)')
+    finish(report, args, lambda item: convert_midi_partial(item['path']))
 
 if __name__ == '__main__':
     parser = ArgumentParser(description='prepares a MIDI dataset')
     parser.add_argument('dir', help='directory containing .mid files for training')
     parser.add_argument('--add-drum', help='Add a drum track underneath the files', action="store_true")
+    parser.add_argument('--drum-pattern', help='JSON drum pattern for --add-drum (see drums.py)')
+    parser.add_argument('--format', choices=['binary', 'text'], default='binary',
+                        help='Write binary .compound.bin files (default) or space-separated .compound.txt')
+    parser.add_argument('--force', help='Ignore the cache manifest and rebuild every file', action="store_true")
+    add_report_arguments(parser)
     main(parser.parse_args())
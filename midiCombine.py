@@ -1,85 +1,189 @@
 #!/usr/bin/env python3
+"""
+Combine the per-instrument stems of a song (e.g. Musescore part exports)
+into one MIDI file.
+
+Stems with different resolutions are rescaled to a common ticks_per_beat
+(the least common multiple of theirs, or the largest when that would not fit
+in a MIDI header). The tempo, time and key signature events that every
+stem repeats are kept once, in a single conductor track. With --type0
+everything is heap-merged by absolute time into a single track.
+
+    python midiCombine.py stems/Twinleaf_Town -o Twinleaf-Town.mid
+    python midiCombine.py --bulk UncombinedMidis -o pokemon_midis --type0
+
+--bulk treats every subdirectory of the given directory as the stems of one
+song and combines the songs in parallel, writing <subdirectory>.mid files.
+"""
 import mido
 import os
 import argparse
-from pathlib import Path
+import heapq
+from concurrent.futures import ProcessPoolExecutor
+from math import lcm
+
+# Meta messages describing the whole song rather than one stem
+CONDUCTOR_META = {'set_tempo', 'time_signature', 'key_signature', 'smpte_offset'}
+MAX_TICKS_PER_BEAT = 0x7FFF
+
+
+def common_resolution(resolutions):
+    """The smallest ticks_per_beat all resolutions divide, or the largest one if that does not fit."""
+    common = lcm(*resolutions)
+    return common if common <= MAX_TICKS_PER_BEAT else max(resolutions)
+
+
+def absolute_messages(track, scale=1):
+    """
+    Messages of a track with absolute times rescaled by scale.
 
-def combine_midi_files(input_files, output_file):
+    Returns:
+        tuple: (list of (tick, message) without end_of_track, end tick)
+    """
+    messages, tick = [], 0
+    for msg in track:
+        tick += msg.time
+        if msg.type != 'end_of_track':
+            messages.append((round(tick * scale), msg))
+    return messages, round(tick * scale)
+
+
+def to_track(messages, end, name=None):
+    """Build a track from (tick, message) pairs sorted by tick."""
+    track = mido.MidiTrack()
+    if name is not None:
+        track.append(mido.MetaMessage('track_name', name=name, time=0))
+    last = 0
+    for tick, msg in messages:
+        track.append(msg.copy(time=tick - last))
+        last = tick
+    track.append(mido.MetaMessage('end_of_track', time=max(end - last, 0)))
+    return track
+
+
+def combine_midi_files(input_files, output_file, ticks_per_beat=None, type0=False):
     """
     Combine multiple MIDI files into a single file, preserving track structure.
-    
+
     Args:
         input_files (list): List of paths to input MIDI files
         output_file (str): Path to save the combined output file
+        ticks_per_beat (int): Resolution of the output (defaults to common_resolution of the inputs)
+        type0 (bool): Merge every track into one (MIDI type 0)
+
+    Returns:
+        int: Number of tracks written
     """
-    # Create a new MIDI file to store the combined tracks
-    combined = mido.MidiFile()
-    
-    # Store the first file's ticks_per_beat to use for all files
-    reference_ticks = None
-    
-    # Process each input file
+    stems = []
     for file_path in input_files:
         print(f"Processing: {file_path}")
         try:
             midi_file = mido.MidiFile(file_path)
-            
-            # Set reference ticks_per_beat from the first file
-            if reference_ticks is None:
-                reference_ticks = midi_file.ticks_per_beat
-                combined.ticks_per_beat = reference_ticks
-            
-            # Add each track from the file to the combined file
-            for i, track in enumerate(midi_file.tracks):
-                # Create a new track with the original file name as prefix
-                file_name = os.path.basename(file_path)
-                track_name = f"{file_name} - Track {i+1}"
-                
-                # Create a new track for the combined file
-                new_track = mido.MidiTrack()
-                
-                # Add a track name meta message at the beginning
-                new_track.append(mido.MetaMessage('track_name', name=track_name, time=0))
-                
-                # Add all messages from the original track
-                for msg in track:
-                    new_track.append(msg)
-                
-                # Add the new track to the combined file
-                combined.tracks.append(new_track)
-                
+            if midi_file.type == 2:
+                raise ValueError("type 2 (asynchronous) files cannot be combined")
+            stems.append((file_path, midi_file))
         except Exception as e:
             print(f"Error processing {file_path}: {e}")
-    
+
+    if not stems:
+        print(f"No readable stems for {output_file}")
+        return 0
+
+    ticks_per_beat = ticks_per_beat or common_resolution([midi_file.ticks_per_beat for _, midi_file in stems])
+
+    # Conductor events are deduplicated on (tick, event); everything else
+    # stays in its own track, named after the stem it comes from
+    conductor, tracks, end = {}, [], 0
+    for file_path, midi_file in stems:
+        scale = ticks_per_beat / midi_file.ticks_per_beat
+        for i, track in enumerate(midi_file.tracks):
+            messages, track_end = absolute_messages(track, scale)
+            end = max(end, track_end)
+            kept = []
+            for tick, msg in messages:
+                if msg.type in CONDUCTOR_META:
+                    conductor.setdefault((tick, str(msg.copy(time=0))), (tick, msg))
+                elif msg.type != 'track_name':
+                    kept.append((tick, msg))
+            if kept:
+                tracks.append((f"{os.path.basename(file_path)} - Track {i+1}", kept))
+
+    conductor = sorted(conductor.values(), key=lambda item: item[0])
+    combined = mido.MidiFile(type=0 if type0 else 1, ticks_per_beat=ticks_per_beat)
+    if type0:
+        # every list is sorted by tick, so a heap merge keeps playback order
+        merged = heapq.merge(conductor, *(messages for _, messages in tracks), key=lambda item: item[0])
+        combined.tracks.append(to_track(merged, end))
+    else:
+        combined.tracks.append(to_track(conductor, end, name='Conductor'))
+        for name, messages in tracks:
+            combined.tracks.append(to_track(messages, end, name=name))
+
     # Save the combined file
     combined.save(output_file)
     print(f"Combined MIDI file saved to: {output_file}")
+    return len(tracks)
+
+
+def midi_files_in(directory):
+    return sorted(os.path.join(root, file) for root, _, files in os.walk(directory)
+                  for file in files if file.lower().endswith(('.mid', '.midi')))
+
+
+def combine_directories(root, output_dir, ticks_per_beat=None, type0=False, workers=None):
+    """
+    Combine the stems in every subdirectory of root into output_dir/<subdirectory>.mid, in parallel.
+
+    Returns:
+        list: (song, number of tracks written) pairs
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    songs = sorted(d for d in os.listdir(root) if os.path.isdir(os.path.join(root, d)))
+    inputs = [midi_files_in(os.path.join(root, song)) for song in songs]
+    outputs = [os.path.join(output_dir, f"{song}.mid") for song in songs]
+    with ProcessPoolExecutor(max_workers=workers or os.cpu_count()) as executor:
+        tracks = executor.map(combine_midi_files, inputs, outputs,
+                              [ticks_per_beat] * len(songs), [type0] * len(songs))
+        return list(zip(songs, tracks))
+
 
 def main():
     # Parse command line arguments
     parser = argparse.ArgumentParser(description='Combine multiple MIDI files into one file.')
-    # parser.add_argument('input_files', nargs='+', help='Input Midi to combine')
-    parser.add_argument('-o', '--output', default='combined.mid', help='Output MIDI file path')
-    
+    parser.add_argument('inputs', nargs='*', help='stem MIDI files, or a directory of them')
+    parser.add_argument('-o', '--output', default='combined.mid',
+                        help='Output MIDI file path (output directory with --bulk)')
+    parser.add_argument('--bulk', metavar='DIR', help='combine every subdirectory of DIR as one song, in parallel')
+    parser.add_argument('--type0', action='store_true', help='merge everything into a single track (MIDI type 0)')
+    parser.add_argument('--ticks-per-beat', type=int, default=None,
+                        help='output resolution (defaults to a common multiple of the stems\' resolutions)')
+    parser.add_argument('-w', '--workers', type=int, default=None, help='number of worker processes for --bulk')
+
     args = parser.parse_args()
-    
+
+    if args.bulk:
+        results = combine_directories(args.bulk, args.output, args.ticks_per_beat, args.type0, args.workers)
+        failed = [song for song, tracks in results if not tracks]
+        print(f"Combined {len(results) - len(failed)} songs into {args.output}"
+              + (f" ({len(failed)} without readable stems: {', '.join(failed)})" if failed else ""))
+        return
+
     # Validate input files
-    input_file_directory = "C:/Users/dongg/Documents/UROPSP25/Pokemon Musescores/UncombinedMidis/Twinleaf_Town"
     valid_files = []
-    for root, _, files, in os.walk(input_file_directory):
-        for file in files:
-            file_path = os.path.join(input_file_directory,file)
-            if not os.path.exists(file_path):
-                print(f"Warning: File not found: {file_path}")
-            else:
-                valid_files.append(file_path)
-    
+    for path in args.inputs:
+        if os.path.isdir(path):
+            valid_files.extend(midi_files_in(path))
+        elif not os.path.exists(path):
+            print(f"Warning: File not found: {path}")
+        else:
+            valid_files.append(path)
+
     if not valid_files:
         print("No valid input files provided. Exiting.")
         return
-    
+
     # Combine the files
-    combine_midi_files(valid_files, args.output)
+    combine_midi_files(valid_files, args.output, args.ticks_per_beat, args.type0)
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
@@ -0,0 +1,242 @@
+"""
+A persistent SQLite index of a MIDI corpus: the instruments, note counts,
+pitch range, duration and tempo of every file. It is built by a parallel
+scanner and updated incrementally, so selecting training material does not
+mean re-reading thousands of MIDI files.
+
+    python midi_index.py scan ./pokemon_midis
+    python midi_index.py query ./pokemon_midis --program 41 --min-duration 30
+    python midi_index.py query ./pokemon_midis --program 0 --without-program 128 --paths
+
+Files are scanned again only when their size or mtime changed and their
+content hash differs from the indexed one. Files that disappeared are
+dropped from the index.
+
+Instruments follow anticipation's numbering: the 0-based General MIDI
+program, with 128 for the drums (channel 10). An instrument is only
+recorded if it plays notes, under the program in effect when it plays them.
+checkMidiInstruments.py prints GM names for them.
+"""
+import hashlib
+import os
+import sqlite3
+from argparse import ArgumentParser
+from concurrent.futures import ProcessPoolExecutor
+from glob import glob
+
+import mido
+from tqdm import tqdm
+
+INDEX_NAME = '.midi-index.sqlite'
+DRUM_CHANNEL = 9
+DRUM_INSTRUMENT = 128
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS files (
+    path TEXT PRIMARY KEY,
+    size INTEGER, mtime REAL, hash TEXT,
+    error TEXT,
+    type INTEGER, ticks_per_beat INTEGER, tracks INTEGER,
+    duration_s REAL, tempo_bpm REAL, tempo_changes INTEGER,
+    note_count INTEGER, pitch_min INTEGER, pitch_max INTEGER
+);
+CREATE TABLE IF NOT EXISTS instruments (
+    path TEXT REFERENCES files(path) ON DELETE CASCADE,
+    channel INTEGER, instrument INTEGER, notes INTEGER,
+    PRIMARY KEY (path, channel, instrument)
+);
+CREATE INDEX IF NOT EXISTS instruments_by_instrument ON instruments(instrument);
+"""
+FILE_COLUMNS = ('size', 'mtime', 'hash', 'error', 'type', 'ticks_per_beat', 'tracks', 'duration_s', 'tempo_bpm',
+                'tempo_changes', 'note_count', 'pitch_min', 'pitch_max')
+
+
+def hash_file(filename):
+    h = hashlib.sha1()
+    with open(filename, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def scan_midi_file(file_path):
+    """
+    Read the metadata of a MIDI file in a single pass over its messages.
+
+    Returns:
+        tuple: (file row as a dict of FILE_COLUMNS, {(channel, instrument): notes}).
+               Unreadable files get a row with only 'error' set.
+    """
+    stat = os.stat(file_path)
+    row = dict.fromkeys(FILE_COLUMNS)
+    row.update(size=stat.st_size, mtime=stat.st_mtime, hash=hash_file(file_path))
+    instruments = {}
+
+    try:
+        mid = mido.MidiFile(file_path)
+        programs = [0] * 16
+        tempos = []
+        pitches = []
+        duration = 0.
+        # iterating a MidiFile merges its tracks and gives times in seconds
+        for msg in mid:
+            duration += msg.time
+            if msg.type == 'set_tempo':
+                tempos.append(msg.tempo)
+            elif msg.type == 'program_change':
+                programs[msg.channel] = msg.program
+            elif msg.type == 'note_on' and msg.velocity > 0:
+                instrument = DRUM_INSTRUMENT if msg.channel == DRUM_CHANNEL else programs[msg.channel]
+                instruments[msg.channel, instrument] = instruments.get((msg.channel, instrument), 0) + 1
+                pitches.append(msg.note)
+    except Exception as e:
+        row['error'] = f'{type(e).__name__}: {e}'
+        return row, {}
+
+    row.update(type=mid.type, ticks_per_beat=mid.ticks_per_beat, tracks=len(mid.tracks), duration_s=duration,
+               tempo_bpm=mido.tempo2bpm(tempos[0]) if tempos else 120., tempo_changes=max(len(tempos) - 1, 0),
+               note_count=len(pitches), pitch_min=min(pitches, default=None), pitch_max=max(pitches, default=None))
+    return row, instruments
+
+
+def connect(directory, db=None):
+    conn = sqlite3.connect(db or os.path.join(directory, INDEX_NAME))
+    conn.execute('PRAGMA foreign_keys = ON')
+    conn.executescript(SCHEMA)
+    return conn
+
+
+def store(conn, path, row, instruments):
+    conn.execute('DELETE FROM instruments WHERE path = ?', (path,))
+    conn.execute(f"INSERT OR REPLACE INTO files (path, {', '.join(FILE_COLUMNS)}) "
+                 f"VALUES (?{', ?' * len(FILE_COLUMNS)})", (path, *(row[c] for c in FILE_COLUMNS)))
+    conn.executemany('INSERT INTO instruments VALUES (?, ?, ?, ?)',
+                     [(path, channel, instrument, notes) for (channel, instrument), notes in instruments.items()])
+
+
+def update_index(directory, db=None, workers=None, force=False):
+    """
+    Bring the index of every .mid/.midi file under directory up to date.
+
+    Returns:
+        dict: Counts of 'scanned', 'unchanged', 'removed' and 'errors'
+    """
+    filenames = glob(directory + '/**/*.mid', recursive=True) + glob(directory + '/**/*.midi', recursive=True)
+    keys = {os.path.relpath(f, directory): f for f in filenames}
+    conn = connect(directory, db)
+    indexed = {path: (size, mtime, digest) for path, size, mtime, digest
+               in conn.execute('SELECT path, size, mtime, hash FROM files')}
+
+    removed = set(indexed) - set(keys)
+    conn.executemany('DELETE FROM files WHERE path = ?', [(path,) for path in removed])
+
+    # Only files whose size or mtime changed are hashed again; a touched but
+    # identical file just gets its new mtime
+    scan, touched = [], []
+    for key, filename in keys.items():
+        stat = os.stat(filename)
+        if force or key not in indexed:
+            scan.append(key)
+        elif indexed[key][:2] != (stat.st_size, stat.st_mtime):
+            if hash_file(filename) == indexed[key][2]:
+                touched.append((stat.st_size, stat.st_mtime, key))
+            else:
+                scan.append(key)
+    conn.executemany('UPDATE files SET size = ?, mtime = ? WHERE path = ?', touched)
+
+    errors = 0
+    workers = workers or os.cpu_count()
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        results = executor.map(scan_midi_file, [keys[k] for k in scan], chunksize=16)
+        for key, (row, instruments) in tqdm(zip(scan, results), desc='Scan', total=len(scan)):
+            store(conn, key, row, instruments)
+            errors += row['error'] is not None
+    conn.commit()
+    conn.close()
+
+    return {'scanned': len(scan), 'unchanged': len(keys) - len(scan), 'removed': len(removed), 'errors': errors}
+
+
+def query_files(directory, db=None, programs=(), without_programs=(), min_duration=None, max_duration=None,
+                min_notes=None, max_instruments=None):
+    """
+    Select indexed files by instrument and length.
+
+    Args:
+        programs (iterable): Instruments that must all be played
+        without_programs (iterable): Instruments that must not be played
+        min_duration, max_duration (float): Bounds on the length in seconds
+        min_notes (int): Lower bound on the number of notes
+        max_instruments (int): Upper bound on the number of distinct instruments
+
+    Returns:
+        list: The matching file rows as dicts (with 'path' relative to
+              directory and 'instruments', a sorted list)
+    """
+    conditions, params = ['error IS NULL'], []
+    for program in programs:
+        conditions.append('path IN (SELECT path FROM instruments WHERE instrument = ?)')
+        params.append(program)
+    for program in without_programs:
+        conditions.append('path NOT IN (SELECT path FROM instruments WHERE instrument = ?)')
+        params.append(program)
+    for column, op, value in (('duration_s', '>=', min_duration), ('duration_s', '<=', max_duration),
+                              ('note_count', '>=', min_notes)):
+        if value is not None:
+            conditions.append(f'{column} {op} ?')
+            params.append(value)
+    if max_instruments is not None:
+        conditions.append('(SELECT COUNT(DISTINCT instrument) FROM instruments i WHERE i.path = files.path) <= ?')
+        params.append(max_instruments)
+
+    conn = connect(directory, db)
+    conn.row_factory = sqlite3.Row
+    rows = [dict(row) for row in conn.execute(f"SELECT * FROM files WHERE {' AND '.join(conditions)} ORDER BY path",
+                                              params)]
+    for row in rows:
+        row['instruments'] = [instrument for instrument, in conn.execute(
+            'SELECT DISTINCT instrument FROM instruments WHERE path = ? ORDER BY instrument', (row['path'],))]
+    conn.close()
+    return rows
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser(description='indexes the instruments and length of a MIDI corpus and queries the index')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    scan = commands.add_parser('scan', help='add new and changed files to the index')
+    scan.add_argument('dir', help='directory containing .mid files')
+    scan.add_argument('--db', help=f'index file (defaults to {INDEX_NAME} inside dir)')
+    scan.add_argument('-w', '--workers', type=int, default=None, help='number of worker processes')
+    scan.add_argument('--force', action='store_true', help='rescan every file')
+
+    query = commands.add_parser('query', help='list the files matching all the given conditions')
+    query.add_argument('dir', help='indexed directory')
+    query.add_argument('--db', help=f'index file (defaults to {INDEX_NAME} inside dir)')
+    query.add_argument('--program', type=int, action='append', default=[],
+                       help='instrument the file must play (0-based GM program, 128 for drums), repeatable')
+    query.add_argument('--without-program', type=int, action='append', default=[],
+                       help='instrument the file must not play, repeatable')
+    query.add_argument('--min-duration', type=float, help='minimum length in seconds')
+    query.add_argument('--max-duration', type=float, help='maximum length in seconds')
+    query.add_argument('--min-notes', type=int, help='minimum number of notes')
+    query.add_argument('--max-instruments', type=int, help='maximum number of instruments')
+    query.add_argument('--paths', action='store_true', help='only print the matching paths (one per line)')
+    args = parser.parse_args()
+
+    if args.command == 'scan':
+        counts = update_index(args.dir, args.db, args.workers, args.force)
+        print(f"Indexed {args.dir}: {counts['scanned']} scanned ({counts['errors']} unreadable), "
+              f"{counts['unchanged']} unchanged, {counts['removed']} removed")
+    else:
+        rows = query_files(args.dir, args.db, args.program, args.without_program, args.min_duration,
+                           args.max_duration, args.min_notes, args.max_instruments)
+        for row in rows:
+            if args.paths:
+                print(os.path.join(args.dir, row['path']))
+                continue
+            print(f"{row['path']}: {row['duration_s']:.1f}s, {row['note_count']} notes, "
+                  f"pitch {row['pitch_min']}-{row['pitch_max']}, {row['tempo_bpm']:.0f} bpm, "
+                  f"instruments {','.join(map(str, row['instruments']))}")
+        if not args.paths:
+            print(f'{len(rows)} files')
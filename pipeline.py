@@ -0,0 +1,210 @@
+"""
+Raw MIDI to training tokens in one pass, without intermediate files.
+
+Doing the same with the separate scripts writes the corpus to disk three
+times (transpose.py, then midi-preprocess.py, then tokenize-custom.py).
+Here every worker takes a shard of the source MIDI files and chains the
+stages as generators, all in memory:
+
+    read MIDI -> transpose_midi_bytes -> midi_to_compound -> [add_drum_track] -> tokenize_compounds
+
+The tokenizer pulls one compound at a time, so a stage only runs when the
+next one needs input. A worker therefore holds one source file and its
+transpositions at most, however large the corpus. Each worker writes one
+token shard and its .sources sidecar, and the shards are concatenated in a
+fixed order, as in tokenize-custom.py.
+Transpositions are named <song>+<semitones>.mid as transpose.py would name
+them (with the song's subdirectory under the input directory, if any), so
+shuffle_tokens.py keeps them on the same side of a split.
+
+Only the original key (+0) is written by default: finetune_amt_oneFile.py
+pitch-shifts every sample on the fly (PITCH_SHIFT). --transpositions 0 1 ... 11
+materializes all 12 keys instead, for training with PITCH_SHIFT = False.
+
+    python pipeline.py ./pokemon_midis -o tokenized-events-pokemon_midis.txt
+    python pipeline.py ./pokemon_midis --add-drum -w 8
+    python pipeline.py ./pokemon_midis --transpositions 0 1 2 3 4 5 6 7 8 9 10 11 -o tokenized-events-pokemon_midis_transposed.txt
+    python pipeline.py ./pokemon_midis --keep-intermediate debug/   # also write the transposed MIDIs and compounds
+"""
+import io
+import os
+import sys
+import time
+from argparse import ArgumentParser
+from collections import Counter
+from functools import partial
+from glob import glob
+from multiprocessing import Pool, RLock
+
+import mido
+from tqdm import tqdm
+
+from anticipation.config import *
+from anticipation.convert import midi_to_compound
+
+from amt_tokenize import merge_shards, shard_files, sources_path, tokenize_compounds
+from compound_format import BINARY_SUFFIX, write_compound
+from drums import DEFAULT_PATTERN, add_drum_track, load_pattern
+from instrumentation import RunReport, add_report_arguments, finish
+from transpose import TRANSPOSITIONS, transpose_midi_bytes
+
+
+def source_compounds(path, offsets=TRANSPOSITIONS, add_drum=False, pattern=DEFAULT_PATTERN, failures=None,
+                     debug_dir=None, root=None):
+    """
+    Yield (name, compound tokens) for every transposition of a MIDI file.
+
+    Names are relative to root when given (so songs with the same file name
+    in different subdirectories stay apart), the file name otherwise. Files
+    and transpositions that cannot be converted are skipped and counted in
+    failures (a Counter of reasons) when given. With debug_dir, the
+    transposed MIDI files and their compounds are written there too.
+    """
+    failures = Counter() if failures is None else failures
+    stem, ext = os.path.splitext(os.path.relpath(path, root) if root else os.path.basename(path))
+    try:
+        with open(path, 'rb') as f:
+            transposed = transpose_midi_bytes(f.read(), offsets)
+    except Exception as e:
+        failures[f'unreadable MIDI ({type(e).__name__})'] += len(offsets)
+        return
+
+    for offset, data in transposed.items():
+        name = f'{stem}+{offset}{ext}'
+        step = 'unreadable MIDI'
+        try:
+            midi = mido.MidiFile(file=io.BytesIO(data))
+            step = 'compound conversion'
+            tokens = midi_to_compound(midi)
+            if add_drum:
+                step = 'drum track'
+                tokens = add_drum_track(tokens, midi=midi, pattern=pattern)
+        except Exception as e:
+            failures[f'{step} ({type(e).__name__})'] += 1
+            continue
+
+        if debug_dir:
+            os.makedirs(os.path.dirname(os.path.join(debug_dir, name)), exist_ok=True)
+            with open(os.path.join(debug_dir, name), 'wb') as f:
+                f.write(data)
+            write_compound(os.path.join(debug_dir, name + BINARY_SUFFIX), tokens, name=name)
+        yield name, tokens
+
+
+def run_shard(files, output, idx, options):
+    """
+    Stream a shard of source MIDI files into output (and its sources sidecar).
+
+    Returns:
+        tuple: (tokenize_compounds results, per-compound records, Counter of
+                conversion failures)
+    """
+    failures = Counter()
+    paths, converting = {}, {}  # per compound: source file, (wall, CPU) seconds to produce it
+
+    def compounds():
+        for path in files:
+            stream = source_compounds(path, options['offsets'], options['add_drum'], options['pattern'],
+                                      failures, options['debug_dir'], options['root'])
+            while True:
+                start, cpu_start = time.perf_counter(), time.process_time()
+                item = next(stream, None)
+                if item is None:
+                    break
+                paths[item[0]] = path
+                converting[item[0]] = (time.perf_counter() - start, time.process_time() - cpu_start)
+                yield item
+
+    records = []
+    with open(output, 'w') as outfile, open(sources_path(output), 'w') as sources:
+        results = tokenize_compounds(compounds(), outfile, options['augment'], idx, records=records, sources=sources)
+    for record in records:
+        record['path'] = paths[record['file']]
+        # the time spent on a compound includes transposing and converting it
+        record['convert_s'], convert_cpu = converting[record['file']]
+        record['wall_s'] += record['convert_s']
+        record['cpu_s'] += convert_cpu
+    return results, records, failures
+
+
+def rerun(item, options):
+    """Run the pipeline again on the source file of a report item, discarding the output (for profiling)."""
+    with open(os.devnull, 'w') as outfile:
+        tokenize_compounds(source_compounds(item['path'], options['offsets'], options['add_drum'],
+                                            options['pattern'], root=options['root']), outfile, options['augment'])
+
+
+def main(args):
+    report = RunReport('pipeline', args.report)
+    filenames = sorted(glob(args.dir + '/**/*.mid', recursive=True) + glob(args.dir + '/**/*.midi', recursive=True))
+    if not filenames:
+        sys.exit(f'No MIDI files found in {args.dir}')
+    output = args.output or f'tokenized-events-{os.path.basename(os.path.normpath(args.dir))}.txt'
+    options = {
+        'offsets': args.transpositions,
+        'augment': args.augment,
+        'add_drum': args.add_drum,
+        'pattern': load_pattern(args.drum_pattern) if args.drum_pattern else DEFAULT_PATTERN,
+        'debug_dir': args.keep_intermediate,
+        'root': args.dir,
+    }
+    if args.keep_intermediate:
+        os.makedirs(args.keep_intermediate, exist_ok=True)
+
+    workers = args.workers or PREPROC_WORKERS
+    shards = shard_files(filenames, args.shards or workers)
+    outputs = [f'{output}.shard{k}' for k in range(len(shards))]
+    print(f'Streaming {len(filenames)} MIDI files x {len(args.transpositions)} transpositions '
+          f'through {len(shards)} shards on {workers} workers')
+
+    with report.timer('pipeline'), Pool(processes=workers, initargs=(RLock(),), initializer=tqdm.set_lock) as pool:
+        shard_results = pool.starmap(partial(run_shard, options=options),
+                                     [(files, out, k) for k, (files, out) in enumerate(zip(shards, outputs))])
+    with report.timer('merge'):
+        merge_shards(outputs, output)
+        merge_shards([sources_path(out) for out in outputs], sources_path(output))
+
+    failures = Counter()
+    for _, records, shard_failures in shard_results:
+        failures.update(shard_failures)
+        for record in records:
+            report.add(record)
+            report.discard('inexpressible sequence', record['inexpressible'])
+    for reason, count in failures.items():
+        report.discard(reason, count)
+    report.count('bytes_read', sum(os.path.getsize(f) for f in filenames))
+    report.count('bytes_written', os.path.getsize(output))
+
+    seq_count, rest_count, too_short, too_long, too_manyinstr, discarded_seqs, truncations \
+            = (sum(x) for x in zip(*(results for results, _, _ in shard_results)))
+    print('Pipeline complete.')
+    print(f'  => Processed {seq_count} sequences into {output}')
+    print(f'  => Failed to convert {sum(failures.values())} transposed files')
+    for reason, count in failures.most_common():
+        print(f'      - {count} {reason}')
+    print(f'  => Inserted {rest_count} REST tokens')
+    print(f'  => Discarded {too_short+too_long+too_manyinstr} tracks for being out of bounds '
+          f'({too_short} too short, {too_long} too long, {too_manyinstr} too many instruments)')
+    print(f'  => Discarded {discarded_seqs} sequences for other reasons')
+    print(f'  => Truncated {truncations} durations')
+    print('Remember to shuffle the training split! (shuffle_tokens.py)')
+    finish(report, args, partial(rerun, options=options))
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser(description='transposes, converts and tokenizes a MIDI directory in one streaming pass')
+    parser.add_argument('dir', help='directory containing the source .mid files')
+    parser.add_argument('-o', '--output', help='tokenized output (defaults to tokenized-events-<dir>.txt)')
+    parser.add_argument('--transpositions', type=int, nargs='+', default=[0],
+                        help='semitone offsets to generate (defaults to the original key only, as fine-tuning '
+                             'pitch-shifts on the fly; pass 0 1 ... 11 for all keys with PITCH_SHIFT = False)')
+    parser.add_argument('-k', '--augment', type=int, default=1, help='Dataset augmentation factor (multiple of 10)')
+    parser.add_argument('--add-drum', action='store_true', help='Add a drum track underneath the files')
+    parser.add_argument('--drum-pattern', help='JSON drum pattern for --add-drum (see drums.py)')
+    parser.add_argument('-w', '--workers', type=int, default=None,
+                        help=f'Worker processes (defaults to PREPROC_WORKERS = {PREPROC_WORKERS})')
+    parser.add_argument('--shards', type=int, default=None, help='output shards (defaults to the number of workers)')
+    parser.add_argument('--keep-intermediate', metavar='DIR',
+                        help='also write the transposed MIDI files and their compounds to DIR, for debugging')
+    add_report_arguments(parser)
+    main(parser.parse_args())
@@ -1,34 +1,69 @@
-from transformers import AutoModelForCausalLM
-
-import math
-
-import torch
-import torch.nn.functional as F
-
-from tqdm import tqdm
+import shutil
+import time
+from argparse import ArgumentParser
 
 from anticipation import ops
 from anticipation.config import *
 from anticipation.vocab import *
-from anticipation.sample import generate
 from anticipation.tokenize import extract_instruments
 from anticipation.convert import events_to_midi,midi_to_events
 
+from amt_model import add_model_arguments, model_from_args, resolve_device
+from generation_cache import add_cache_arguments, cache_from_args, checkpoint_dir
+from harmonize import CONTEXT, SEGMENT, harmonize_melody
+
+
+parser = ArgumentParser(description='generates a melody and an accompaniment for it')
+add_model_arguments(parser)
+parser.add_argument('-o', '--output', default='generated.mid', help='output MIDI file')
+parser.add_argument('--melody', help='harmonize the melody of this MIDI file, whatever its length, '
+                                     'instead of generating one (see harmonize.py)')
+parser.add_argument('--instrument', type=int, default=0, help='melody instrument in --melody')
+parser.add_argument('--segment', type=float, default=SEGMENT, help='seconds generated by each window')
+parser.add_argument('--context', type=float, default=CONTEXT, help='seconds of overlap between windows')
+parser.add_argument('--seed', type=int, default=None, help='sampling seed (seeded runs are cached)')
+add_cache_arguments(parser)
+args = parser.parse_args()
+
+melody = None
+if args.melody:
+    _, melody = extract_instruments(midi_to_events(args.melody), [args.instrument])
+
+# the same request with the same seed gives the same song: reuse it
+cache = cache_from_args(args) if args.seed is not None else None
+if cache is not None:
+    checkpoint = cache.checkpoint_hash(checkpoint_dir(args.model, args.subfolder), args.precision)
+    request = dict(task='harmonize', segment=args.segment, context=args.context) if args.melody else dict(task='full')
+    request.update(top_p=.98, seed=args.seed, device=resolve_device(args.device))
+    key = cache.key(checkpoint, melody, **request)
+    if cache.get(key) is not None:
+        shutil.copyfile(cache.path(key, '.mid'), args.output)
+        print(f'Cache hit: copied {cache.path(key, ".mid")} to {args.output}')
+        raise SystemExit
+
+# e.g. --device cpu --precision int8 --threads 8 on machines without a GPU
+# (torch and transformers are first imported here, see bench_cold_start.py)
+model = model_from_args(args)
 
-model = AutoModelForCausalLM.from_pretrained(
-    "donggunkwak/PokemonHarmonizer",
-    subfolder="amt_PKMN_Harmonizer_Small/checkpoint-3000"
-).cuda()
+if args.melody:
+    start = time.perf_counter()
+    accompaniment = harmonize_melody(model, melody, segment=args.segment, context=args.context, top_p=.98,
+                                     seed=args.seed)
+    length = ops.max_time(melody)
+    print(f'Harmonized {length:.0f}s of melody in {time.perf_counter() - start:.1f}s')
+    events = ops.combine(accompaniment, melody)
+else:
+    from amt_sampling import generate
 
-length = 40 # time in seconds
-# _, segment = extract_instruments(ops.clip(midi_to_events('./pokemon_midis/Hearthome-City.mid'),
-#                    0,40), [0])
+    length = 40 # time in seconds
 
-events1, melody =extract_instruments(generate(model, start_time=0, end_time=length, top_p=.98),[0])
+    events1, melody =extract_instruments(generate(model, start_time=0, end_time=length, top_p=.98, seed=args.seed),[0])
 
-accompaniment = generate(model, start_time=0, end_time=length, controls=melody, top_p=.98, active_instruments=[1,40,41,42,43])
+    accompaniment = generate(model, start_time=0, end_time=length, controls=melody, top_p=.98, active_instruments=[1,40,41,42,43], seed=args.seed)
 
-events = ops.clip(ops.combine(accompaniment, melody), 0, 20, clip_duration=True)
+    events = ops.clip(ops.combine(accompaniment, melody), 0, 20, clip_duration=True)
 
 mid = events_to_midi(events)
-mid.save('generated.mid')
\ No newline at end of file
+mid.save(args.output)
+if cache is not None:
+    cache.put(key, events, mid, request)
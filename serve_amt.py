@@ -0,0 +1,394 @@
+"""
+Long-running generation service for the harmonizer model.
+
+The model is loaded once and every job is split into independent rows (one
+per variation) that a single scheduler thread decodes together with
+amt_sampling.generate_batch, so concurrent jobs share forward passes. Rows
+that arrive while a batch is running join it between tokens.
+
+Jobs are JSON objects:
+
+    {"id": "a", "task": "melody", "variations": 8, "length": 40, "top_p": 0.98, "seed": 0}
+    {"id": "b", "task": "harmonize", "midi": "<base64 .mid>", "variations": 16}
+    {"id": "c", "task": "harmonize", "path": "./pokemon_midis/Hearthome-City.mid"}
+    {"id": "d", "task": "full", "variations": 4}
+
+  melody     generate a melody (the melody_instrument part of a free generation)
+  harmonize  accompany the melody_instrument part of the given MIDI
+  full       generate a melody, then harmonize it, as run_amt.py does
+
+Optional fields: variations (at most MAX_VARIATIONS), length (seconds),
+top_p, seed (variation i uses seed + i), melody_instrument,
+active_instruments (accompaniment instruments) and output (a path pattern
+such as "out/{id}-{variation}.mid" to save to instead of returning the MIDI
+inline).
+
+For every finished variation one JSON line is written back, as soon as it
+is ready: {"id", "variation", "seed", "events", "midi" (base64) or "path"},
+followed by {"id", "done": true}. Errors are reported as {"id", "error"}.
+Seeded variations are kept in the generation cache (see generation_cache.py),
+so a repeated job is answered without decoding.
+
+    python serve_amt.py --stdin < jobs.jsonl
+    python serve_amt.py --port 8765
+    curl -N -d '{"task": "melody", "variations": 4}' localhost:8765/generate
+"""
+import base64
+import io
+import json
+import os
+import queue
+import sys
+import threading
+import time
+from argparse import ArgumentParser
+from concurrent.futures import Future, ThreadPoolExecutor, as_completed
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import mido
+
+from anticipation import ops
+from anticipation.config import *
+from anticipation.vocab import *
+from anticipation.tokenize import extract_instruments
+from anticipation.convert import events_to_midi, midi_to_events
+
+from amt_model import add_model_arguments, model_from_args
+from amt_sampling import generate_batch, WINDOW_STRIDE
+from generation_cache import add_cache_arguments, cache_from_args, checkpoint_dir
+from harmonize import ACCOMPANIMENT_INSTRUMENTS
+
+MELODY_INSTRUMENT = 0
+TASKS = ('melody', 'harmonize', 'full')
+MAX_VARIATIONS = 64  # rows one job may queue
+DEFAULTS = {
+    'task': 'full',
+    'variations': 1,
+    'length': 40,
+    'top_p': .98,
+    'seed': None,
+    'melody_instrument': MELODY_INSTRUMENT,
+    'active_instruments': ACCOMPANIMENT_INSTRUMENTS,
+}
+
+
+class BatchScheduler(threading.Thread):
+    """
+    Owns the model and decodes every submitted row in shared batches.
+
+    The first row that arrives on an idle scheduler waits batch_wait seconds
+    for company, then decoding starts with up to max_batch rows; rows
+    submitted later are admitted into the running batch as slots free up.
+    """
+
+    def __init__(self, model, max_batch=32, batch_wait=0.05, window_stride=WINDOW_STRIDE, cache=None,
+                 checkpoint=None):
+        super().__init__(daemon=True)
+        self.model = model
+        self.cache = cache            # GenerationCache shared with other processes, or None
+        self.checkpoint = checkpoint  # its checkpoint_hash for the model
+        self.max_batch = max_batch
+        self.batch_wait = batch_wait
+        self.window_stride = window_stride
+        self.queue = queue.Queue()
+        # cache writes (SQLite, files, MIDI rendering) run here, never on the decoding thread
+        self.io = ThreadPoolExecutor(max_workers=2, thread_name_prefix='cache-writer')
+
+    def submit(self, request):
+        """Queue one generation row (keyword arguments of GenerationRow) and return a Future of its events."""
+        future = Future()
+        self.queue.put((request, future))
+        return future
+
+    def _drain(self, limit):
+        items = []
+        while len(items) < limit:
+            try:
+                items.append(self.queue.get_nowait())
+            except queue.Empty:
+                break
+        return items
+
+    def run(self):
+        while True:
+            items = [self.queue.get()]
+            time.sleep(self.batch_wait)
+            items += self._drain(self.max_batch - 1)
+            futures = [future for _, future in items]
+
+            def admit(running):
+                new = self._drain(self.max_batch - running)
+                futures.extend(future for _, future in new)
+                return [request for request, _ in new]
+
+            def finish(i, events):
+                futures[i].set_result(events)
+
+            try:
+                generate_batch(self.model, [request for request, _ in items], window_stride=self.window_stride,
+                               on_finish=finish, admit=admit)
+            except Exception as e:
+                for future in futures:
+                    if not future.done():
+                        future.set_exception(e)
+
+
+def then(future, fn, executor=None):
+    """
+    A Future of fn(result of future); fn may itself return a Future.
+
+    fn runs in the thread that completes future (the scheduler's, for rows),
+    so slow work goes to executor instead.
+    """
+    chained = Future()
+
+    def forward(f):
+        if f.exception() is not None:
+            chained.set_exception(f.exception())
+        else:
+            chained.set_result(f.result())
+
+    def done(f):
+        try:
+            value = fn(f.result())
+        except Exception as e:
+            chained.set_exception(e)
+            return
+        if isinstance(value, Future):
+            value.add_done_callback(forward)
+        else:
+            chained.set_result(value)
+
+    if executor is None:
+        future.add_done_callback(done)
+    else:
+        future.add_done_callback(lambda f: executor.submit(done, f))
+    return chained
+
+
+def controls_to_events(controls):
+    return [token - CONTROL_OFFSET for token in controls]
+
+
+def load_melody(job, length):
+    """The melody of a harmonize job as anticipation controls."""
+    if 'midi' in job:
+        midi = mido.MidiFile(file=io.BytesIO(base64.b64decode(job['midi'])))
+    elif 'path' in job:
+        midi = mido.MidiFile(job['path'])
+    else:
+        raise ValueError("harmonize jobs need a 'midi' (base64) or 'path' field")
+
+    events = ops.clip(midi_to_events(midi), 0, length)
+    _, melody = extract_instruments(events, [job['melody_instrument']])
+    if not melody:
+        raise ValueError(f"no notes for instrument {job['melody_instrument']} in the first {length} seconds")
+    return melody
+
+
+def start_job(scheduler, job):
+    """
+    Submit every variation of a job. Seeded variations are answered from the
+    scheduler's generation cache when they were generated before.
+
+    Returns:
+        list: A Future of the final events of each variation
+    """
+    length, top_p = job['length'], job['top_p']
+
+    def row(i, **kwargs):
+        seed = None if job['seed'] is None else job['seed'] + i
+        return dict(start_time=0, end_time=length, top_p=top_p, seed=seed, **kwargs)
+
+    def accompany(i, melody):
+        accompaniment = scheduler.submit(row(i, controls=melody, active_instruments=job['active_instruments']))
+        return then(accompaniment, lambda events: ops.clip(ops.combine(events, melody), 0, length,
+                                                           clip_duration=True))
+
+    def melody_of(events):
+        return extract_instruments(events, [job['melody_instrument']])[1]
+
+    def variation(i):
+        if job['task'] == 'harmonize':
+            return accompany(i, melody)
+        generated = then(scheduler.submit(row(i)), melody_of)
+        if job['task'] == 'melody':
+            return then(generated, lambda m: ops.clip(controls_to_events(m), 0, length, clip_duration=True))
+        return then(generated, lambda m: accompany(i, m))
+
+    melody = load_melody(job, length) if job['task'] == 'harmonize' else None
+    results = []
+    for i in range(job['variations']):
+        key = cache_key(scheduler, job, i, melody)
+        events = scheduler.cache.get(key) if key else None
+        if events is not None:
+            result = Future()
+            result.set_result(events)
+        else:
+            result = variation(i)
+            if key:
+                # stored before the result is reported, so it survives the process ending right after
+                result = then(result, lambda events, key=key: store_result(scheduler.cache, key, events),
+                              executor=scheduler.io)
+        results.append(result)
+    return results
+
+
+def cache_key(scheduler, job, i, melody):
+    """Generation cache key of a seeded variation, None when it is not cached."""
+    if scheduler.cache is None or job['seed'] is None:
+        return None
+    params = {name: job[name] for name in ('task', 'length', 'top_p', 'melody_instrument', 'active_instruments')}
+    return scheduler.cache.key(scheduler.checkpoint, melody, job['seed'] + i, **params)
+
+
+def store_result(cache, key, events):
+    cache.put(key, events, events_to_midi(events))
+    return events
+
+
+def encode_result(job, i, events):
+    result = {'id': job.get('id'), 'variation': i, 'events': len(events)//3,
+              'seed': None if job['seed'] is None else job['seed'] + i}
+    mid = events_to_midi(events)
+    if job.get('output'):
+        path = job['output'].format(id=job.get('id'), variation=i)
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        mid.save(path)
+        result['path'] = path
+    else:
+        buffer = io.BytesIO()
+        mid.save(file=buffer)
+        result['midi'] = base64.b64encode(buffer.getvalue()).decode('ascii')
+    return result
+
+
+def parse_job(job):
+    if not isinstance(job, dict):
+        raise ValueError(f'a job is a JSON object, got {type(job).__name__}')
+    job = {**DEFAULTS, **job}
+    if job['task'] not in TASKS:
+        raise ValueError(f"unknown task {job['task']!r}, expected one of {', '.join(TASKS)}")
+    if not 0 < job['top_p'] <= 1:
+        raise ValueError(f"top_p must be in (0, 1], got {job['top_p']}")
+    if not 0 < job['length'] <= MAX_TIME_IN_SECONDS:
+        raise ValueError(f"length must be in (0, {MAX_TIME_IN_SECONDS}] seconds, got {job['length']}")
+    if type(job['variations']) is not int or not 1 <= job['variations'] <= MAX_VARIATIONS:
+        raise ValueError(f"variations must be an integer in [1, {MAX_VARIATIONS}], got {job['variations']!r}")
+    return job
+
+
+def run_job(scheduler, job):
+    """Run a job and yield its output lines (dicts) as variations finish."""
+    job_id = job.get('id') if isinstance(job, dict) else None
+    try:
+        job = parse_job(job)
+        results = start_job(scheduler, job)
+    except Exception as e:
+        yield {'id': job_id, 'error': str(e)}
+        return
+
+    index = {future: i for i, future in enumerate(results)}
+    for future in as_completed(results):
+        try:
+            yield encode_result(job, index[future], future.result())
+        except Exception as e:
+            yield {'id': job.get('id'), 'variation': index[future], 'error': str(e)}
+    yield {'id': job.get('id'), 'done': True}
+
+
+def serve_stdin(scheduler):
+    """Read one job per line from stdin; jobs run concurrently and share batches."""
+    lock = threading.Lock()
+
+    def handle(line):
+        try:
+            job = json.loads(line)
+        except json.JSONDecodeError as e:
+            lines = [{'error': f'invalid JSON: {e}'}]
+        else:
+            lines = run_job(scheduler, job)
+        for out in lines:
+            with lock:
+                print(json.dumps(out), flush=True)
+
+    workers = []
+    for line in sys.stdin:
+        if line.strip():
+            worker = threading.Thread(target=handle, args=(line,))
+            worker.start()
+            workers.append(worker)
+    for worker in workers:
+        worker.join()
+
+
+def make_handler(scheduler):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.0'  # the streamed response ends when the connection closes
+
+        def send_json(self, code, body):
+            data = json.dumps(body).encode()
+            self.send_response(code)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def do_GET(self):
+            if self.path != '/health':
+                return self.send_json(404, {'error': f'unknown path {self.path}'})
+            self.send_json(200, {'status': 'ok', 'queued': scheduler.queue.qsize()})
+
+        def do_POST(self):
+            if self.path != '/generate':
+                return self.send_json(404, {'error': f'unknown path {self.path}'})
+            try:
+                job = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))))
+            except (ValueError, json.JSONDecodeError) as e:
+                return self.send_json(400, {'error': f'invalid JSON: {e}'})
+
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/x-ndjson')
+            self.end_headers()
+            for out in run_job(scheduler, job):
+                self.wfile.write(json.dumps(out).encode() + b'\n')
+                self.wfile.flush()
+
+        def log_message(self, format, *args):
+            print(f'{self.address_string()} {format % args}', file=sys.stderr)
+
+    return Handler
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser(description='serves batched melody/harmony generation over stdin or HTTP')
+    parser.add_argument('--stdin', action='store_true', help='read JSONL jobs from stdin instead of serving HTTP')
+    parser.add_argument('--host', default='127.0.0.1', help='HTTP bind address')
+    parser.add_argument('--port', type=int, default=8765, help='HTTP port')
+    add_model_arguments(parser)
+    parser.add_argument('--max-batch', type=int, default=32, help='rows decoded together')
+    parser.add_argument('--batch-wait', type=float, default=0.05,
+                        help='seconds an idle scheduler waits for more rows before starting')
+    parser.add_argument('--window-stride', type=int, default=WINDOW_STRIDE,
+                        help='tokens a full history window moves at once (0 = exact anticipation.sample.generate)')
+    add_cache_arguments(parser)
+    args = parser.parse_args()
+
+    model = model_from_args(args)
+    print(f'Loaded {args.model} ({args.precision}) on {model.device}', file=sys.stderr)
+
+    cache = cache_from_args(args)
+    checkpoint = None
+    if cache is not None:
+        checkpoint = cache.checkpoint_hash(checkpoint_dir(args.model, args.subfolder), args.precision)
+        checkpoint += f'-{model.device.type}-stride{args.window_stride}'
+    scheduler = BatchScheduler(model, max_batch=args.max_batch, batch_wait=args.batch_wait,
+                               window_stride=args.window_stride, cache=cache, checkpoint=checkpoint)
+    scheduler.start()
+
+    if args.stdin:
+        serve_stdin(scheduler)
+    else:
+        server = ThreadingHTTPServer((args.host, args.port), make_handler(scheduler))
+        print(f'Serving on http://{args.host}:{args.port}/generate', file=sys.stderr)
+        server.serve_forever()
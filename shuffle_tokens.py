@@ -0,0 +1,167 @@
+"""
+Seeded external shuffle of a tokenized-events file, in bounded memory.
+
+The file is read twice, sequentially. The first pass records where every
+line starts. A seeded permutation then gives each line its rank in the
+output. The second pass appends every line to the bucket file holding its
+rank range, and each bucket (about --bucket-mb of text) is finally put in
+rank order in memory and appended to the output. Memory use is a few int64
+per line plus one bucket.
+
+With --valid-ratio the sequences are also split into train and valid files.
+The split is made per song, using the .sources sidecar written by
+tokenize-custom.py (the song each line comes from). Transpositions of a song
+(transpose.py names them <song>+<semitones>.mid) count as the same song, so
+no song ends up on both sides of the split.
+
+    python shuffle_tokens.py tokenized-events-pokemon_midis.txt
+    python shuffle_tokens.py tokenized-events-pokemon_midis_transposed.txt --valid-ratio 0.1 --seed 1
+"""
+import os
+import re
+import tempfile
+from argparse import ArgumentParser
+
+import numpy as np
+
+from amt_tokenize import sources_path
+
+BUCKET_BYTES = 256 << 20
+# <song>+<semitones>.mid, as written by transpose.py
+TRANSPOSITION = r'\+\d+(?=\.midi?$)'
+
+
+def line_offsets(path):
+    """Byte offset of the start of every line, plus the file size."""
+    offsets = [0]
+    with open(path, 'rb') as f:
+        for line in f:
+            offsets.append(offsets[-1] + len(line))
+    return np.array(offsets, dtype=np.int64)
+
+
+def read_sources(path):
+    """The source of every line of a tokenized-events file, or None without a sidecar."""
+    if not os.path.exists(sources_path(path)):
+        return None
+    with open(sources_path(path)) as f:
+        return [line.rstrip('\n') for line in f]
+
+
+def split_by_song(songs, valid_ratio, seed=0):
+    """
+    Pick whole songs for validation, in seeded random order, until they hold
+    valid_ratio of the lines.
+
+    Returns:
+        np.ndarray: Boolean mask of the validation lines
+    """
+    names, song_ids = np.unique(np.array(songs, dtype=object), return_inverse=True)
+    counts = np.bincount(song_ids, minlength=len(names))
+    order = np.random.default_rng(seed).permutation(len(names))
+    valid = np.zeros(len(names), dtype=bool)
+    target, taken = valid_ratio * len(songs), 0
+    for song in order:
+        if taken >= target:
+            break
+        valid[song] = True
+        taken += counts[song]
+    return valid[song_ids]
+
+
+def external_shuffle(path, offsets, lines, output, seed=0, bucket_bytes=BUCKET_BYTES, sources=None):
+    """
+    Write the given lines of path to output in seeded random order.
+
+    Args:
+        offsets (np.ndarray): line_offsets of path
+        lines (np.ndarray): Indices of the lines to write, increasing
+        sources (list): Source of every line of path; also written to the
+                        sidecar of output when given
+    """
+    n = len(lines)
+    size = int((offsets[lines + 1] - offsets[lines]).sum())
+    buckets = max(1, -(-size // bucket_bytes))
+    per_bucket = max(1, -(-n // buckets))
+    rank = np.empty(n, dtype=np.int64)
+    rank[np.random.default_rng(seed).permutation(n)] = np.arange(n)
+    bucket_of = rank // per_bucket
+
+    keep = np.zeros(len(offsets) - 1, dtype=bool)
+    keep[lines] = True
+    with tempfile.TemporaryDirectory(dir=os.path.dirname(os.path.abspath(output))) as tmp:
+        files = [open(os.path.join(tmp, f'{b}.txt'), 'wb') for b in range(buckets)]
+        try:
+            j = 0
+            with open(path, 'rb') as f:
+                for i, line in enumerate(f):
+                    if keep[i]:
+                        files[bucket_of[j]].write(line if line.endswith(b'\n') else line + b'\n')
+                        j += 1
+        finally:
+            for file in files:
+                file.close()
+
+        # lines reach each bucket in input order; sort them there by rank
+        members = np.argsort(bucket_of, kind='stable')
+        starts = np.searchsorted(bucket_of[members], np.arange(buckets + 1))
+        with open(output + '.tmp', 'wb') as out:
+            out_sources = open(sources_path(output), 'w') if sources is not None else None
+            for b in range(buckets):
+                in_bucket = members[starts[b]:starts[b+1]]
+                with open(os.path.join(tmp, f'{b}.txt'), 'rb') as f:
+                    bucket = f.readlines()
+                order = np.argsort(rank[in_bucket])
+                out.writelines(bucket[k] for k in order)
+                if out_sources is not None:
+                    out_sources.writelines(sources[lines[in_bucket[k]]] + '\n' for k in order)
+            if out_sources is not None:
+                out_sources.close()
+        os.replace(output + '.tmp', output)
+
+
+def shuffle_file(path, output=None, seed=0, valid_ratio=0., bucket_bytes=BUCKET_BYTES, pattern=TRANSPOSITION):
+    """
+    Shuffle a tokenized-events file, optionally holding out whole songs.
+
+    Returns:
+        dict: Output path of each split and its number of lines
+    """
+    base, ext = os.path.splitext(output or path)
+    offsets = line_offsets(path)
+    n = len(offsets) - 1
+    sources = read_sources(path)
+    if sources is not None and len(sources) != n:
+        raise ValueError(f"{sources_path(path)} has {len(sources)} lines for {n} sequences")
+
+    if valid_ratio > 0:
+        if sources is None:
+            print(f'No {sources_path(path)}: splitting by sequence rather than by song')
+            valid = np.random.default_rng(seed).random(n) < valid_ratio
+        else:
+            # transpositions of a song are the same song
+            valid = split_by_song([re.sub(pattern, '', source) for source in sources], valid_ratio, seed)
+        splits = {f'{base}-train{ext}': np.flatnonzero(~valid), f'{base}-valid{ext}': np.flatnonzero(valid)}
+    else:
+        splits = {output or f'{base}-shuffled{ext}': np.arange(n)}
+
+    for i, (split_output, lines) in enumerate(splits.items()):
+        external_shuffle(path, offsets, lines, split_output, seed + i, bucket_bytes, sources)
+    return {split_output: len(lines) for split_output, lines in splits.items()}
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser(description='shuffles a tokenized-events file on disk, optionally splitting it by song')
+    parser.add_argument('token_file', help='tokenized-events-*.txt file')
+    parser.add_argument('-o', '--output', help='output file (defaults to <input>-shuffled.txt, or '
+                                                '<output>-train/-valid.txt with --valid-ratio)')
+    parser.add_argument('--seed', type=int, default=0, help='shuffle seed')
+    parser.add_argument('--valid-ratio', type=float, default=0., help='share of the sequences held out, by song')
+    parser.add_argument('--bucket-mb', type=float, default=BUCKET_BYTES / 2**20, help='memory for one bucket')
+    parser.add_argument('--song-pattern', default=TRANSPOSITION,
+                        help='regex removed from source names to group songs (default: transposition suffix)')
+    args = parser.parse_args()
+
+    for split_output, count in shuffle_file(args.token_file, args.output, args.seed, args.valid_ratio,
+                                            int(args.bucket_mb * 2**20), args.song_pattern).items():
+        print(f'Wrote {count} shuffled sequences to {split_output}')
@@ -0,0 +1,217 @@
+"""
+Speculative decoding for anticipatory generation with a small draft model.
+
+Every round, a draft model (the same recipe as the harmonizer, with far
+fewer layers) samples up to k tokens ahead on a copy of the generation row,
+so control interleaving and the time/duration/note masks apply as in normal
+generation. The main model then scores all of those positions in one forward
+pass. Each draft token x is accepted with probability min(1, p(x)/q(x)),
+where q and p are the draft and main distributions after the anticipation
+masks and the top_p filter. At the first rejection, a token is drawn from
+max(0, p - q) instead and the round ends. If every token is accepted, the main
+model's prediction after them gives one more token for free. The output follows
+the main model's top_p distribution exactly. It is not the same sample as
+amt_sampling.generate for a given seed, since the draws differ.
+
+Both models keep their KV cache between rounds (amt_sampling.BatchDecoder),
+and rejected tokens are rolled back out of it.
+
+A draft model is made from the main checkpoint by keeping its first few
+layers, then fine-tuned with finetune_amt_oneFile.py (GPT2_MODEL_NAME = the
+draft directory) on the same tokenized data:
+
+    python speculative.py --init-draft amt_draft --draft-layers 2
+    python speculative.py ./pokemon_midis/Hearthome-City.mid --draft amt_draft_finetuned/checkpoint-3000 -k 4
+
+The command line harmonizes the melody of a MIDI file with and without the
+draft model, and reports the acceptance rate and the speedup.
+"""
+import time
+from argparse import ArgumentParser
+
+import torch
+
+from anticipation import ops
+from anticipation.config import *
+from anticipation.vocab import *
+from anticipation.tokenize import extract_instruments
+from anticipation.convert import events_to_midi, midi_to_events
+
+from amt_model import add_model_arguments, load_model, model_from_args
+from amt_sampling import BatchDecoder, GenerationRow, WINDOW_STRIDE, generate
+from harmonize import ACCOMPANIMENT_INSTRUMENTS
+
+DRAFT_TOKENS = 4
+
+
+class SpeculativeDecoder:
+    """
+    Generates one row at a time with a main model, drafting k tokens ahead
+    with a smaller model.
+
+    Attributes:
+        rounds (int): Main model forward passes
+        proposed, accepted (int): Draft tokens proposed and accepted
+        generated (int): Tokens added to rows
+    """
+
+    def __init__(self, model, draft, k=DRAFT_TOKENS, window_stride=WINDOW_STRIDE):
+        self.model = model
+        self.main = BatchDecoder(model, window_stride)
+        self.draft = BatchDecoder(draft, window_stride)
+        self.k = k
+        self.window_stride = window_stride
+        self.rounds = 0
+        self.proposed = 0
+        self.accepted = 0
+        self.generated = 0
+
+    def propose(self, row):
+        """
+        Sample up to k tokens with the draft model on a copy of row.
+
+        Returns:
+            tuple: (steps, bonus). steps lists (state, input, q, token) per
+                   draft token, state being the row copy the token was sampled
+                   in. bonus is (state, input) for the position after the last
+                   token, or None when it does not extend the same input.
+        """
+        ahead = row.copy()
+        steps = []
+        for _ in range(self.k + 1):
+            if not ahead.new_token:
+                ahead.anticipate()
+            tokens = ahead.model_input(self.window_stride)
+            if steps:
+                _, previous, _, token = steps[-1]
+                if tokens[:len(previous) + 1] != previous + [token]:
+                    # the history window moved: the main model cannot score this in the same pass
+                    return steps, None
+            if len(steps) == self.k:
+                return steps, (ahead.copy(), tokens)
+
+            # the real row identifies the draft's cache; its input is the copy's
+            (logits, idx), = self.draft.step([row], [tokens])
+            state = ahead.copy()
+            q = state.distribution(logits, idx)
+            token = int(torch.multinomial(q, 1, generator=row.generator))
+            steps.append((state, tokens, q, token))
+            if ahead.push(token):
+                return steps, None
+
+    def advance(self, row):
+        """Add at least one token to row, as distributed under the main model."""
+        steps, bonus = self.propose(row)
+        inputs = bonus[1] if bonus else steps[-1][1]
+        lengths = [len(tokens) for _, tokens, _, _ in steps] + ([len(bonus[1])] if bonus else [])
+        scored = self.main.step([row], [inputs], [lengths])[0]
+        self.rounds += 1
+        self.proposed += len(steps)
+
+        def add(state, token):
+            if not row.new_token:
+                row.anticipate()
+            row.lookback, row.offset = state.lookback, state.offset
+            self.generated += 1
+            return row.push(token)
+
+        for (state, _, q, token), (logits, idx) in zip(steps, scored):
+            p = state.distribution(logits, idx)
+            if torch.rand(1, generator=row.generator, device=p.device) * q[token] < p[token]:
+                self.accepted += 1
+                if add(state, token):
+                    return
+                continue
+            residual = torch.clamp(p - q, min=0)
+            residual = residual if residual.sum() > 0 else p
+            add(state, int(torch.multinomial(residual / residual.sum(), 1, generator=row.generator)))
+            return
+
+        if bonus:
+            state, _ = bonus
+            logits, idx = scored[-1]
+            add(state, int(torch.multinomial(state.distribution(logits, idx), 1, generator=row.generator)))
+
+    @torch.no_grad()
+    def generate(self, **request):
+        """
+        Generate one sequence.
+
+        Args:
+            request: Keyword arguments of amt_sampling.GenerationRow
+
+        Returns:
+            list: The generated events
+        """
+        row = GenerationRow(**request)
+        row.setup(self.model.device)
+        while not row.done:
+            self.advance(row)
+        return row.events()
+
+    def acceptance_rate(self):
+        return self.accepted / max(self.proposed, 1)
+
+
+def init_draft(model, layers):
+    """A GPT-2 draft model keeping the embeddings and the first layers of model."""
+    from transformers import AutoModelForCausalLM
+
+    config = model.config.__class__.from_dict({**model.config.to_dict(), 'n_layer': layers})
+    draft = AutoModelForCausalLM.from_config(config)
+    own = draft.state_dict()
+    draft.load_state_dict({name: value for name, value in model.state_dict().items() if name in own}, strict=False)
+    return draft
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser(description='harmonizes a melody with speculative decoding and reports the speedup')
+    parser.add_argument('melody', nargs='?', help='MIDI file whose melody instrument is harmonized')
+    add_model_arguments(parser)
+    parser.add_argument('--draft', help='draft model directory')
+    parser.add_argument('--draft-subfolder', default='', help='checkpoint subfolder of the draft model')
+    parser.add_argument('-k', type=int, default=DRAFT_TOKENS, help='tokens drafted per main model pass')
+    parser.add_argument('-l', '--length', type=float, default=20, help='seconds to harmonize')
+    parser.add_argument('--instrument', type=int, default=0, help='melody instrument in the file')
+    parser.add_argument('--top-p', type=float, default=.98, help='nucleus sampling threshold')
+    parser.add_argument('--seed', type=int, default=0, help='sampling seed')
+    parser.add_argument('-o', '--output', help='also save the speculative harmonization to this MIDI file')
+    parser.add_argument('--init-draft', metavar='DIR', help='write a draft model made from the first layers of --model')
+    parser.add_argument('--draft-layers', type=int, default=2, help='layers kept by --init-draft')
+    args = parser.parse_args()
+
+    model = model_from_args(args)
+    if args.init_draft:
+        init_draft(model, args.draft_layers).save_pretrained(args.init_draft)
+        print(f'Saved a {args.draft_layers}-layer draft model to {args.init_draft}; '
+              f'fine-tune it with finetune_amt_oneFile.py before use')
+        raise SystemExit
+    if not args.melody or not args.draft:
+        parser.error('a melody and --draft are needed (or --init-draft)')
+
+    draft = load_model(args.draft, args.draft_subfolder, args.device, args.precision, args.threads)
+    _, controls = extract_instruments(ops.clip(midi_to_events(args.melody), 0, args.length), [args.instrument])
+    request = dict(start_time=0, end_time=args.length, controls=controls, top_p=args.top_p,
+                   active_instruments=ACCOMPANIMENT_INSTRUMENTS, seed=args.seed)
+
+    start = time.perf_counter()
+    baseline = generate(model, **request)
+    baseline_s = time.perf_counter() - start
+
+    decoder = SpeculativeDecoder(model, draft, args.k)
+    start = time.perf_counter()
+    events = decoder.generate(**request)
+    speculative_s = time.perf_counter() - start
+
+    print(f'Harmonized {args.length:g}s of {args.melody} ({len(controls)//3} melody notes), k = {args.k}')
+    print(f'  => main model alone: {len(baseline)//3} events in {baseline_s:.2f}s')
+    print(f'  => speculative:      {len(events)//3} events in {speculative_s:.2f}s '
+          f'({decoder.generated} tokens in {decoder.rounds} main model passes)')
+    print(f'  => acceptance rate {decoder.acceptance_rate():.1%}, '
+          f'{decoder.generated / max(decoder.rounds, 1):.2f} tokens per main model pass')
+    # the two runs sample different songs, so compare time per event
+    per_event = (baseline_s / max(len(baseline)//3, 1)) / (speculative_s / max(len(events)//3, 1))
+    print(f'  => speedup {per_event:.2f}x per generated event')
+    if args.output:
+        events_to_midi(ops.clip(ops.combine(events, controls), 0, args.length, clip_duration=True)).save(args.output)
+        print(f'Saved {args.output}')
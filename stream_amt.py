@@ -0,0 +1,206 @@
+"""
+Real-time harmonization of a melody that arrives as a stream of notes.
+
+StreamingHarmonizer keeps one generation row and its KV cache alive for the
+whole performance. Melody notes are added as anticipation controls when
+they arrive, and advance(t) samples accompaniment events up to time t, so
+every call only pays for the tokens that are new since the last one.
+
+The model is trained to see each melody note DELTA (5) seconds before it
+sounds. A live melody can only be seen once it is played, so notes that
+arrive late are inserted as soon as they arrive. --melody-ahead replays the
+melody that many seconds early (a score-following setup), which restores the
+trained behaviour when it is at least DELTA.
+
+When a sampled event lies beyond the requested time it is held, not
+discarded, and is emitted by a later call. It is only resampled if melody
+notes arrive that the model should have seen before it.
+
+The command line replays the melody of a MIDI file as the event stream. It
+reports the compute latency of each accompaniment event and how far ahead of
+playback the event was emitted:
+
+    python stream_amt.py ./pokemon_midis/Hearthome-City.mid --lookahead 1 --length 40
+    python stream_amt.py melody.mid --realtime --device cpu --precision int8
+"""
+import time
+from argparse import ArgumentParser
+
+import numpy as np
+
+from anticipation import ops
+from anticipation.config import *
+from anticipation.vocab import *
+from anticipation.tokenize import extract_instruments
+from anticipation.convert import events_to_midi, midi_to_events
+
+from amt_model import add_model_arguments, model_from_args
+from amt_sampling import BatchDecoder, GenerationRow, WINDOW_STRIDE
+from harmonize import ACCOMPANIMENT_INSTRUMENTS
+
+MELODY_INSTRUMENT = 0
+
+
+class StreamingHarmonizer:
+    """
+    Incrementally generates an accompaniment for a melody given note by note.
+
+    Args:
+        model: Causal LM with the anticipation vocabulary
+        top_p (float): Nucleus sampling threshold
+        active_instruments (list): Instruments the accompaniment may use
+        seed (int): Sampling seed, None for torch's global generator
+    """
+
+    def __init__(self, model, top_p=.98, active_instruments=ACCOMPANIMENT_INSTRUMENTS, seed=None,
+                 window_stride=WINDOW_STRIDE, delta=DELTA*TIME_RESOLUTION):
+        self.row = GenerationRow(start_time=0, end_time=None, top_p=top_p,
+                                 active_instruments=active_instruments, seed=seed, delta=delta)
+        self.row.z = [ANTICIPATE]  # melody controls are coming even if none has arrived yet
+        self.row.setup(model.device)
+        self.decoder = BatchDecoder(model, window_stride)
+        self.latencies = []  # compute seconds spent on each emitted event
+        self._compute = 0.
+
+    def add_melody(self, events):
+        """
+        Add melody notes (anticipation event tokens with absolute times) as
+        controls. A held event is resampled if any of them is already due.
+        """
+        row = self.row
+        controls = [CONTROL_OFFSET + token for token in events]
+        row.pending = ops.sort(row.pending + controls)
+        if row.new_token and any(row.current_time >= atime - ATIME_OFFSET - row.delta for atime in controls[0::3]):
+            row.new_token = []
+
+    def held_time(self):
+        """Onset (in time steps) of the event waiting for a later advance call, or None."""
+        row = self.row
+        return row.new_token[0] + row.offset - TIME_OFFSET if row.new_token else None
+
+    def _sample(self):
+        start = time.perf_counter()
+        (logits, idx), = self.decoder.step([self.row])
+        self.row.push(self.row.sample(logits, idx))
+        self._compute += time.perf_counter() - start
+
+    def advance(self, until, now=None):
+        """
+        Generate every accompaniment event starting before until (seconds).
+        New events never start before now (the playback position), since
+        they could no longer be played.
+
+        Returns:
+            list: The new events, as anticipation event tokens
+        """
+        until = int(TIME_RESOLUTION*until)
+        row = self.row
+        if now is not None:
+            row.start_time = max(row.start_time, int(TIME_RESOLUTION*now))
+        events = []
+        while True:
+            if not row.new_token:
+                row.anticipate()
+                self._sample()  # time of the next event
+            if self.held_time() >= until:
+                return events
+
+            self._sample()
+            self._sample()
+            events.extend(row.tokens[-3:])
+            self.latencies.append(self._compute)
+            self._compute = 0.
+
+    def accompaniment(self):
+        events, _ = ops.split(self.row.tokens)
+        return ops.unpad(events)
+
+
+def replay(harmonizer, melody, length, lookahead, step=.1, melody_ahead=0., realtime=False):
+    """
+    Feed a melody to a harmonizer as if it were played live.
+
+    Every step seconds of playback, the notes that have started (melody_ahead
+    seconds early) are added and the accompaniment is generated lookahead
+    seconds past the playback position. Without realtime, playback waits for
+    generation; with it, playback follows the wall clock and generation can
+    fall behind.
+
+    Returns:
+        tuple: (accompaniment events, seconds each event was emitted ahead
+               of playback, compute seconds of each step)
+    """
+    notes = list(zip(melody[0::3], melody[1::3], melody[2::3]))
+    notes.sort(key=lambda note: note[0])
+    next_note = 0
+    margins, steps = [], []
+    started = time.perf_counter()
+    playback = 0.
+    while playback < length:
+        arrived = []
+        while next_note < len(notes) and notes[next_note][0] - TIME_OFFSET <= TIME_RESOLUTION*(playback + melody_ahead):
+            arrived.extend(notes[next_note])
+            next_note += 1
+        if arrived:
+            harmonizer.add_melody(arrived)
+
+        now = time.perf_counter() - started if realtime else playback
+        start = time.perf_counter()
+        events = harmonizer.advance(min(now + lookahead, length), now)
+        steps.append(time.perf_counter() - start)
+
+        now = time.perf_counter() - started if realtime else playback
+        margins.extend((onset - TIME_OFFSET)/TIME_RESOLUTION - now for onset in events[0::3])
+
+        if realtime:
+            playback = max(playback + step, time.perf_counter() - started)
+            time.sleep(max(0., playback - (time.perf_counter() - started)))
+        else:
+            playback += step
+
+    return harmonizer.accompaniment(), margins, steps
+
+
+def summarize(name, values, unit='ms', scale=1000):
+    if not values:
+        return f'{name}: none'
+    values = scale * np.asarray(values)
+    return (f'{name}: mean {values.mean():.1f}{unit}, p50 {np.percentile(values, 50):.1f}{unit}, '
+            f'p95 {np.percentile(values, 95):.1f}{unit}, max {values.max():.1f}{unit}')
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser(description='harmonizes a replayed melody incrementally, as for live input')
+    parser.add_argument('melody', help='MIDI file whose melody instrument is replayed as the live stream')
+    add_model_arguments(parser)
+    parser.add_argument('-o', '--output', default='streamed.mid', help='output MIDI file (melody and accompaniment)')
+    parser.add_argument('-l', '--length', type=float, default=40, help='seconds to play')
+    parser.add_argument('--lookahead', type=float, default=1., help='seconds of accompaniment kept ahead of playback')
+    parser.add_argument('--step', type=float, default=.1, help='seconds of playback between updates')
+    parser.add_argument('--melody-ahead', type=float, default=0.,
+                        help='seconds in advance melody notes are known (0 for live playing)')
+    parser.add_argument('--realtime', action='store_true', help='follow the wall clock instead of waiting for the model')
+    parser.add_argument('--instrument', type=int, default=MELODY_INSTRUMENT, help='melody instrument in the file')
+    parser.add_argument('--top-p', type=float, default=.98, help='nucleus sampling threshold')
+    parser.add_argument('--seed', type=int, default=None, help='sampling seed')
+    args = parser.parse_args()
+
+    model = model_from_args(args)
+    _, controls = extract_instruments(ops.clip(midi_to_events(args.melody), 0, args.length), [args.instrument])
+    melody = [token - CONTROL_OFFSET for token in controls]
+
+    harmonizer = StreamingHarmonizer(model, top_p=args.top_p, seed=args.seed)
+    accompaniment, margins, steps = replay(harmonizer, melody, args.length, args.lookahead, args.step,
+                                           args.melody_ahead, args.realtime)
+
+    events_to_midi(ops.clip(ops.combine(accompaniment, controls), 0, args.length, clip_duration=True)).save(args.output)
+    decoder = harmonizer.decoder
+    print(f'Generated {len(accompaniment)//3} events for {len(melody)//3} melody notes in {args.length:g}s '
+          f'({decoder.forward_passes} forward passes, {decoder.refills} window re-encodes, '
+          f'{decoder.rollbacks} rollbacks)')
+    print('  => ' + summarize('compute per event', harmonizer.latencies))
+    print('  => ' + summarize(f'compute per {args.step:g}s step', steps))
+    print('  => ' + summarize('emitted ahead of playback', margins, unit='s', scale=1))
+    late = sum(margin < 0 for margin in margins)
+    print(f'  => {late} of {len(margins)} events emitted after their onset')
+    print(f'Saved {args.output}')
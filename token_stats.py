@@ -0,0 +1,203 @@
+"""
+One-pass statistics over tokenized training data, in bounded memory.
+
+Accepts tokenized-events-*.txt files and token stores (see token_store.py,
+given by prefix or by any of their files). Text files are cut into byte
+ranges on line boundaries and token stores into ranges of sequences. Every
+range is read and counted with numpy by a worker process, and the counts
+are summed, so memory stays at about one chunk per worker whatever the file
+size.
+
+Reported, for events and anticipated controls separately where it applies:
+
+  token types     time, duration, note, REST, the control variants and the
+                  special tokens (SEPARATOR, AUTOREGRESS, ANTICIPATE)
+  instruments     histogram of the instrument of every note
+  controls        share of the note tokens that are anticipated controls
+  REST density    REST tokens per event
+  lengths         distribution of the sequence lengths in tokens
+
+    python token_stats.py tokenized-events-pokemon_midis.txt
+    python token_stats.py tokenized-events-pokemon_midis --json stats.json -w 8
+"""
+import json
+import os
+from argparse import ArgumentParser
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from anticipation.config import *
+from anticipation.vocab import *
+
+import token_store
+
+CHUNK_BYTES = 16 << 20
+CHUNK_SEQUENCES = 8192
+
+# token type of each vocabulary range, from its first token
+TYPE_STARTS = [TIME_OFFSET, DUR_OFFSET, NOTE_OFFSET, REST, ATIME_OFFSET, ADUR_OFFSET, ANOTE_OFFSET,
+               SEPARATOR, AUTOREGRESS, ANTICIPATE, VOCAB_SIZE]
+TYPE_NAMES = ['time', 'duration', 'note', 'rest', 'control time', 'control duration', 'control note',
+              'separator', 'autoregress', 'anticipate', 'out of vocabulary']
+
+
+def count_tokens(tokens, lengths):
+    """
+    The statistics of a run of sequences.
+
+    Args:
+        tokens (np.ndarray): The tokens of the sequences, back to back
+        lengths (np.ndarray): The length of each sequence
+
+    Returns:
+        dict: Arrays of counts, to be merged with merge_stats
+    """
+    kinds = np.searchsorted(TYPE_STARTS, tokens, side='right') - 1
+    kinds[kinds < 0] = len(TYPE_NAMES) - 1  # negative tokens are out of vocabulary too
+    notes = tokens[kinds == TYPE_NAMES.index('note')]
+    controls = tokens[kinds == TYPE_NAMES.index('control note')]
+    return {
+        'types': np.bincount(kinds, minlength=len(TYPE_NAMES)),
+        'instruments': np.bincount((notes - NOTE_OFFSET) // MAX_PITCH, minlength=MAX_INSTR),
+        'control_instruments': np.bincount((controls - ANOTE_OFFSET) // MAX_PITCH, minlength=MAX_INSTR),
+        'lengths': np.bincount(lengths),
+    }
+
+
+def merge_stats(a, b):
+    """Sum two sets of counts; histograms of different sizes are padded."""
+    merged = {}
+    for key in a:
+        x, y = a[key], b[key]
+        if len(x) < len(y):
+            x, y = y, x
+        x = x.copy()
+        x[:len(y)] += y
+        merged[key] = x
+    return merged
+
+
+def text_chunks(path, chunk_bytes=CHUNK_BYTES):
+    """Split a text file into (start, end) byte ranges that begin and end on line boundaries."""
+    size = os.path.getsize(path)
+    bounds = [0]
+    with open(path, 'rb') as f:
+        while bounds[-1] < size:
+            f.seek(min(bounds[-1] + chunk_bytes, size))
+            f.readline()
+            bounds.append(min(f.tell(), size))
+    return list(zip(bounds[:-1], bounds[1:]))
+
+
+def text_chunk_stats(path, start, end):
+    with open(path, 'rb') as f:
+        f.seek(start)
+        lines = f.read(end - start).splitlines()
+    lines = [line for line in lines if line.strip()]
+    tokens = np.array(b' '.join(lines).split(), dtype=np.int64)
+    lengths = np.array([len(line.split()) for line in lines], dtype=np.int64)
+    return count_tokens(tokens, lengths)
+
+
+def store_chunk_stats(prefix, start, end):
+    tokens_path, offsets_path, meta_path = token_store.store_paths(prefix)
+    with open(meta_path) as f:
+        dtype = np.dtype(json.load(f)['dtype'])
+    offsets = np.load(offsets_path, mmap_mode='r')
+    tokens = np.memmap(tokens_path, dtype=dtype, mode='r')
+    return count_tokens(np.asarray(tokens[offsets[start]:offsets[end]], dtype=np.int64),
+                        np.diff(offsets[start:end+1]))
+
+
+def store_prefix(path):
+    """The token store prefix of path, or None if it is not part of a token store."""
+    for suffix in ('.tokens.bin', '.offsets.npy', '.json', ''):
+        if path.endswith(suffix):
+            prefix = path[:len(path) - len(suffix)]
+            if token_store.store_exists(prefix):
+                return prefix
+    return None
+
+
+def file_stats(path, workers=None, chunk_bytes=CHUNK_BYTES, chunk_sequences=CHUNK_SEQUENCES):
+    """
+    Statistics of a tokenized-events text file or a token store.
+
+    Returns:
+        dict: Counts as returned by count_tokens, summed over the file
+    """
+    prefix = store_prefix(path)
+    if prefix is not None:
+        count = len(np.load(token_store.store_paths(prefix)[1], mmap_mode='r')) - 1
+        ranges = [(prefix, start, min(start + chunk_sequences, count)) for start in range(0, count, chunk_sequences)]
+        fn = store_chunk_stats
+    else:
+        ranges = [(path, start, end) for start, end in text_chunks(path, chunk_bytes)]
+        fn = text_chunk_stats
+
+    stats = count_tokens(np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64))
+    with ProcessPoolExecutor(max_workers=workers or os.cpu_count()) as executor:
+        for chunk in executor.map(fn, *zip(*ranges)) if ranges else []:
+            stats = merge_stats(stats, chunk)
+    return stats
+
+
+def summarize(stats):
+    """Derived figures (ratios, length percentiles) as a JSON-friendly dict."""
+    types = dict(zip(TYPE_NAMES, stats['types'].tolist()))
+    events, controls = types['note'] + types['rest'], types['control note']
+    lengths = stats['lengths']
+    sequences = int(lengths.sum())
+
+    def percentile(q):
+        return int(np.searchsorted(np.cumsum(lengths), q * sequences)) if sequences else None
+
+    return {
+        'sequences': sequences,
+        'tokens': int(stats['types'].sum()),
+        'token_types': types,
+        'events': events,
+        'controls': controls,
+        'control_ratio': controls / max(events + controls, 1),
+        'rest_per_event': types['rest'] / max(events, 1),
+        'instruments': {i: int(n) for i, n in enumerate(stats['instruments']) if n},
+        'control_instruments': {i: int(n) for i, n in enumerate(stats['control_instruments']) if n},
+        'length': {
+            'min': int(np.flatnonzero(lengths)[0]) if sequences else None,
+            'mean': float((np.arange(len(lengths)) * lengths).sum() / sequences) if sequences else None,
+            'p50': percentile(.5),
+            'p95': percentile(.95),
+            'max': len(lengths) - 1 if sequences else None,
+        },
+    }
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser(description='streams corpus statistics out of tokenized training data')
+    parser.add_argument('files', nargs='+', help='tokenized-events-*.txt files or token store prefixes')
+    parser.add_argument('-w', '--workers', type=int, default=None, help='number of worker processes')
+    parser.add_argument('--chunk-mb', type=float, default=CHUNK_BYTES / 2**20, help='MB of text per task')
+    parser.add_argument('--json', help='also write the statistics to this file')
+    args = parser.parse_args()
+
+    summaries = {}
+    for path in args.files:
+        summary = summaries[path] = summarize(file_stats(path, args.workers, int(args.chunk_mb * 2**20)))
+        length = summary['length']
+        print(f"{path}: {summary['sequences']} sequences, {summary['tokens']} tokens")
+        print(f"  => lengths: min {length['min']}, mean {length['mean'] or 0:.1f}, p50 {length['p50']}, "
+              f"p95 {length['p95']}, max {length['max']}")
+        print(f"  => {summary['events']} events, {summary['controls']} anticipated controls "
+              f"({100*summary['control_ratio']:.1f}% of notes are controls)")
+        print(f"  => {summary['token_types']['rest']} REST tokens ({summary['rest_per_event']:.3f} per event)")
+        print('  => token types: ' + ', '.join(f'{name} {count}' for name, count in summary['token_types'].items()
+                                               if count))
+        print('  => instruments (events): ' + ', '.join(f'{i}: {n}' for i, n in summary['instruments'].items()))
+        print('  => instruments (controls): ' + ', '.join(f'{i}: {n}'
+                                                        for i, n in summary['control_instruments'].items()))
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(summaries, f, indent=1)
+        print(f'Saved {args.json}')
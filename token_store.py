@@ -0,0 +1,283 @@
+"""
+Packed, memory-mapped storage for tokenized training sequences.
+
+A store is three files sharing a prefix:
+
+    <prefix>.tokens.bin   every sequence back to back (uint16, or uint32 for
+                          vocabularies above 65536 tokens)
+    <prefix>.offsets.npy  int64 start of each sequence, plus the total length
+    <prefix>.json         dtype and counts
+
+convert() builds a store from a tokenized-events-*.txt file in one streaming
+pass; TokenStoreDataset memory-maps it so DataLoader workers share the page
+cache instead of receiving pickled Python lists.
+"""
+import json
+import os
+from argparse import ArgumentParser
+
+import numpy as np
+import torch
+from torch.utils.data import Dataset
+
+from anticipation.vocab import VOCAB_SIZE
+
+from augment import random_transpose_tokens
+
+PAD_TOKEN = 50256
+IGNORE_INDEX = -100  # label value skipped by the loss
+
+
+def store_paths(prefix):
+    return f'{prefix}.tokens.bin', f'{prefix}.offsets.npy', f'{prefix}.json'
+
+
+def store_exists(prefix):
+    return all(os.path.exists(p) for p in store_paths(prefix))
+
+
+def store_is_current(prefix, token_file):
+    """True if the store exists and was built after token_file last changed."""
+    return store_exists(prefix) and os.path.getmtime(store_paths(prefix)[2]) >= os.path.getmtime(token_file)
+
+
+def convert(token_file, prefix, vocab_size=VOCAB_SIZE):
+    """
+    Pack a tokenized-events text file into a token store. Sequences that are
+    too short to train on or that contain tokens outside the vocabulary are
+    dropped.
+
+    Returns:
+        dict: The store metadata
+    """
+    dtype = np.dtype('<u2') if vocab_size <= 2**16 else np.dtype('<u4')
+    tokens_path, offsets_path, meta_path = store_paths(prefix)
+
+    # written under temporary names and renamed into place, the metadata last,
+    # so a process opening the store never maps a half-written one
+    tmp = f'.tmp{os.getpid()}'
+    offsets = [0]
+    rejected = 0
+    with open(token_file) as f, open(tokens_path + tmp, 'wb') as out:
+        for line in f:
+            tokens = np.array(line.split(), dtype=np.int64)
+            if len(tokens) <= 1 or tokens.min() < 0 or tokens.max() >= vocab_size:
+                rejected += 1
+                continue
+            out.write(tokens.astype(dtype).tobytes())
+            offsets.append(offsets[-1] + len(tokens))
+
+    with open(offsets_path + tmp, 'wb') as out:
+        np.save(out, np.array(offsets, dtype=np.int64))
+    meta = {
+        'dtype': dtype.str,
+        'sequences': len(offsets) - 1,
+        'tokens': offsets[-1],
+        'rejected': rejected,
+        'vocab_size': vocab_size,
+        'source': os.path.abspath(token_file),
+    }
+    with open(meta_path + tmp, 'w') as f:
+        json.dump(meta, f, indent=1)
+
+    for path in (tokens_path, offsets_path, meta_path):
+        os.replace(path + tmp, path)
+    return meta
+
+
+class TokenStoreDataset(Dataset):
+    """
+    Memory-mapped view of the sequences [start, stop) of a token store (or
+    of the given sorted indices), truncated to max_length and padded with
+    PAD_TOKEN.
+
+    The memory map is opened lazily in each process, so pickling the dataset
+    into DataLoader workers only ships the path and the indices.
+    """
+
+    def __init__(self, prefix, start=0, stop=None, max_length=1024, pitch_shift=False, indices=None):
+        self.prefix = prefix
+        self.max_length = max_length
+        self.pitch_shift = pitch_shift
+
+        _, offsets_path, meta_path = store_paths(prefix)
+        with open(meta_path) as f:
+            self.meta = json.load(f)
+        self.offsets = np.load(offsets_path, mmap_mode='r')
+
+        count = self.meta['sequences']
+        stop = count if stop is None else min(stop, count)
+        self.indices = np.arange(start, max(start, stop)) if indices is None else np.asarray(indices, dtype=np.int64)
+        self._tokens = None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_tokens'] = None
+        state['offsets'] = None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.offsets = np.load(store_paths(self.prefix)[1], mmap_mode='r')
+
+    @property
+    def tokens(self):
+        if self._tokens is None:
+            self._tokens = np.memmap(store_paths(self.prefix)[0], dtype=np.dtype(self.meta['dtype']), mode='r')
+        return self._tokens
+
+    def __len__(self):
+        return len(self.indices)
+
+    def sequence(self, i):
+        """The raw stored tokens of sample i, without truncation or padding."""
+        seq = self.indices[i]
+        return self.tokens[self.offsets[seq]:self.offsets[seq + 1]]
+
+    def validate(self, max_token_id):
+        """
+        Drop every sequence holding a token >= max_token_id (e.g. the model's
+        embedding size), in one vectorized pass over the memory map.
+
+        Returns:
+            dict: Counts of checked and rejected sequences and the ids of the
+                  rejected ones
+        """
+        checked = len(self.indices)
+        if PAD_TOKEN >= max_token_id:
+            raise ValueError(f"pad token {PAD_TOKEN} is outside the model vocabulary ({max_token_id})")
+
+        if checked:
+            begin = int(self.offsets[self.indices[0]])
+            end = int(self.offsets[self.indices[-1] + 1])
+            starts = np.asarray(self.offsets[self.indices], dtype=np.int64) - begin
+            # only the first max_length tokens are ever fed to the model
+            ends = np.minimum(np.asarray(self.offsets[self.indices + 1], dtype=np.int64) - begin,
+                              starts + self.max_length)
+            window = self.tokens[begin:end]
+            # interleave starts and ends: even slots reduce over [start, end)
+            bounds = np.ravel(np.column_stack([starts, ends]))
+            if bounds[-1] == len(window):
+                bounds = bounds[:-1]
+            maxima = np.maximum.reduceat(window, bounds)[0::2]
+            bad = maxima >= max_token_id
+        else:
+            bad = np.zeros(0, dtype=bool)
+
+        rejected = self.indices[bad]
+        self.indices = self.indices[~bad]
+        return {'checked': checked, 'rejected': len(rejected), 'rejected_ids': rejected.tolist()}
+
+    def __getitem__(self, i):
+        tokens = self.sequence(i)[:self.max_length].astype(np.int64)
+        if self.pitch_shift:
+            tokens = random_transpose_tokens(tokens)[0]
+
+        input_ids = torch.full((self.max_length,), PAD_TOKEN, dtype=torch.long)
+        input_ids[:len(tokens)] = torch.from_numpy(tokens)
+        labels = input_ids.clone()
+        labels[len(tokens):] = IGNORE_INDEX  # never learn to predict padding
+        return {"input_ids": input_ids, "labels": labels}
+
+    def lengths(self):
+        """Number of tokens each sample contributes after truncation."""
+        return np.minimum(np.diff(self.offsets)[self.indices], self.max_length)
+
+    def padding_efficiency(self):
+        """Fraction of the max_length slots of each sample holding real tokens."""
+        return float(self.lengths().sum()) / max(len(self) * self.max_length, 1)
+
+
+class PackedTokenDataset(Dataset):
+    """
+    Packs the sequences of a TokenStoreDataset into full max_length blocks.
+
+    Each sequence goes into the first block with room left (sequences are
+    never split, so every block still opens on a global control token).
+    Position ids restart at each sequence, and the first token of every
+    sequence as well as the padding at the end of a block are masked out of
+    the loss. The attention is still causal over the whole block: with the
+    default (eager or sdpa) attention, later sequences attend to the earlier
+    ones in their block.
+    """
+
+    def __init__(self, base):
+        self.base = base
+        self.max_length = base.max_length
+
+        lengths = base.lengths()
+        blocks, space = [], []  # space left in each block that is not full yet
+        for i, length in enumerate(lengths):
+            # first fit: the earliest open block with enough room
+            for j, (b, left) in enumerate(space):
+                if length <= left:
+                    blocks[b].append(i)
+                    space[j] = (b, left - length)
+                    if left == length:
+                        del space[j]
+                    break
+            else:
+                blocks.append([i])
+                if length < self.max_length:
+                    space.append((len(blocks) - 1, self.max_length - length))
+
+        self.blocks = blocks
+        self.real_tokens = int(lengths.sum())
+
+    def __len__(self):
+        return len(self.blocks)
+
+    def efficiency(self):
+        """Fraction of the block slots holding real tokens."""
+        return self.real_tokens / max(len(self) * self.max_length, 1)
+
+    def __getitem__(self, b):
+        input_ids = torch.full((self.max_length,), PAD_TOKEN, dtype=torch.long)
+        labels = torch.full((self.max_length,), IGNORE_INDEX, dtype=torch.long)
+        position_ids = torch.zeros(self.max_length, dtype=torch.long)
+
+        used = 0
+        for i in self.blocks[b]:
+            tokens = self.base.sequence(i)[:self.max_length].astype(np.int64)
+            if self.base.pitch_shift:
+                tokens = random_transpose_tokens(tokens)[0]
+            end = used + len(tokens)
+            input_ids[used:end] = torch.from_numpy(tokens)
+            labels[used+1:end] = input_ids[used+1:end]
+            position_ids[used:end] = torch.arange(len(tokens))
+            used = end
+
+        return {"input_ids": input_ids, "labels": labels, "position_ids": position_ids}
+
+
+def split_store(prefix, train_ratio=0.8, max_length=1024, pitch_shift=False, seed=42):
+    """
+    Train/valid datasets over a token store: a seeded random train_ratio of
+    the sequences train, the rest validate (each split kept in store order).
+    Validation is never pitch-shifted.
+    """
+    _, _, meta_path = store_paths(prefix)
+    with open(meta_path) as f:
+        count = json.load(f)['sequences']
+    if count == 0:
+        raise ValueError("No valid tokenized data found!")
+
+    # shuffled as the text-file loader did: a song-ordered file would
+    # otherwise validate on its last songs only
+    order = np.random.default_rng(seed).permutation(count)
+    split_idx = int(count * train_ratio)
+    return (TokenStoreDataset(prefix, max_length=max_length, pitch_shift=pitch_shift,
+                              indices=np.sort(order[:split_idx])),
+            TokenStoreDataset(prefix, max_length=max_length, indices=np.sort(order[split_idx:])))
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser(description='packs a tokenized-events file into a memory-mapped token store')
+    parser.add_argument('token_file', help='tokenized-events-*.txt file')
+    parser.add_argument('prefix', nargs='?', help='output prefix (defaults to the input without .txt)')
+    args = parser.parse_args()
+
+    prefix = args.prefix or os.path.splitext(args.token_file)[0]
+    meta = convert(args.token_file, prefix)
+    print(f"Packed {meta['sequences']} sequences ({meta['tokens']} tokens, {meta['dtype']}) into {prefix}.*")
+    print(f"  => Rejected {meta['rejected']} sequences (too short or out-of-vocabulary tokens)")
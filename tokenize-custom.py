@@ -1,23 +1,39 @@
 import os
+import sys
 from argparse import ArgumentParser
+from functools import partial
 from multiprocessing import Pool, RLock
 from glob import glob
 
 from tqdm import tqdm
 
 from anticipation.config import *
-from anticipation.tokenize import tokenize, tokenize_ia
+from anticipation.tokenize import tokenize_ia
+
+from amt_tokenize import merge_shards, shard_files, sources_path, tokenize, tokenize_compounds
+from compound_format import BINARY_SUFFIX, TEXT_SUFFIX, compound_files, load_compounds
+from instrumentation import RunReport, add_report_arguments, finish
+
+
+def retokenize(item, augment_factor):
+    """Tokenize the compound of a report item again, discarding the output (for profiling)."""
+    compounds = [(name, compound) for name, compound in load_compounds(item['path']) if name == item['file']]
+    with open(os.devnull, 'w') as outfile:
+        tokenize_compounds(compounds, outfile, augment_factor)
+
 
 def main(args):
+    report = RunReport('tokenize', args.report)
     encoding = 'interarrival' if args.interarrival else 'arrival'
     print('Tokenizing Custom MIDI Dataset')
     print(f'  encoding type: {encoding}')
 
-    # Specific splits for my dataset structure
-    split_names = ['pokemon_midis_transposed']
+    # The first split trains and is the only one augmented; songs are kept in
+    # their original key, finetune_amt_oneFile.py pitch-shifts them on the fly
+    split_names = args.split or ['pokemon_midis']
     print(f'  train split: {split_names[0]}')
-    # print(f'  validation split: {split_names[2]}')
-    # print(f'  test split: {split_names[1]}')
+    for s in split_names[1:]:
+        print(f'  other split: {s}')
 
     print('Tokenization parameters:')
     print(f'  anticipation interval = {DELTA}s')
@@ -27,16 +43,53 @@ def main(args):
     print(f'  min track events = {MIN_TRACK_EVENTS}')
 
     split_paths = [os.path.join(args.datadir, s) for s in split_names]
-    files = [glob(f'{p}/*.compound.txt') for p in split_paths]
+    if args.interarrival:
+        # anticipation's interarrival tokenizer only reads the text format
+        files = [glob(f'{p}/*{TEXT_SUFFIX}') for p in split_paths]
+        for p, split_files in zip(split_paths, files):
+            if not split_files and glob(f'{p}/*{BINARY_SUFFIX}'):
+                sys.exit(f'{p} only has {BINARY_SUFFIX} compounds, which -i cannot read: '
+                         f'run midi-preprocess.py --format text on it first')
+    else:
+        # a song with both a binary and a text compound is tokenized once, from the binary
+        files = [compound_files(p) for p in split_paths]
+    for p, split_files in zip(split_paths, files):
+        if not split_files:
+            sys.exit(f'No compound files found in {p}: run midi-preprocess.py on it first')
     outputs = [os.path.join(args.datadir, f'tokenized-events-{s}.txt') for s in split_names]
 
     # Augmentation settings
-    augment = [args.augment if s == 'pokemon_midis_transposed' else 1 for s in split_names]
+    augment = [args.augment if i == 0 else 1 for i in range(len(split_names))]
+
+    # Every split is cut into shards tokenized by separate workers, each into
+    # its own file; the shards are then concatenated in order
+    workers = args.workers or PREPROC_WORKERS
+    tasks = []  # (files, shard output, augment factor, split index)
+    for i, (split_files, output) in enumerate(zip(files, outputs)):
+        for k, shard in enumerate(shard_files(split_files, args.shards or workers)):
+            tasks.append((shard, f'{output}.shard{k}', augment[i], i))
+    print(f'  {len(tasks)} shards over {workers} workers')
+
+    # per-compound records are only available for the arrival-time tokenizer
+    func = tokenize_ia if args.interarrival else partial(tokenize, with_records=True)
+    with report.timer('tokenize'), \
+            Pool(processes=workers, initargs=(RLock(),), initializer=tqdm.set_lock) as pool:
+        results = pool.starmap(func, [(shard, shard_output, factor, idx)
+                                      for idx, (shard, shard_output, factor, _) in enumerate(tasks)])
+    with report.timer('merge'):
+        for i, output in enumerate(outputs):
+            shard_outputs = [task[1] for task in tasks if task[3] == i]
+            merge_shards(shard_outputs, output)
+            if not args.interarrival:
+                merge_shards([sources_path(shard) for shard in shard_outputs], sources_path(output))
+    if not args.interarrival:
+        results, records = zip(*results)
+        for record in (record for split in records for record in split):
+            report.add(record)
+            report.discard('inexpressible sequence', record['inexpressible'])
+    report.count('bytes_read', sum(os.path.getsize(f) for split in files for f in split))
+    report.count('bytes_written', sum(os.path.getsize(f) for f in outputs))
 
-    func = tokenize_ia if args.interarrival else tokenize
-    with Pool(processes=PREPROC_WORKERS, initargs=(RLock(),), initializer=tqdm.set_lock) as pool:
-        results = pool.starmap(func, zip(files, outputs, augment, range(len(split_names))))
-    
     seq_count, rest_count, too_short, too_long, too_manyinstr, discarded_seqs, truncations \
             = (sum(x) for x in zip(*results))
     rest_ratio = round(100*float(rest_count)/(seq_count*M),2)
@@ -46,6 +99,8 @@ def main(args):
 
     print('Tokenization complete.')
     print(f'  => Processed {seq_count} sequences')
+    for i, s in enumerate(split_names):
+        print(f'      - {sum(r[0] for r, task in zip(results, tasks) if task[3] == i)} in {outputs[i]}')
     print(f'  => Inserted {rest_count} REST tokens ({rest_ratio}% of events)')
     print(f'  => Discarded {too_short+too_long+too_manyinstr} sequences for being out of bounds')
     print(f'      - {too_short} too short')
@@ -53,15 +108,25 @@ def main(args):
     print(f'      - {too_manyinstr} too many instruments')
     print(f'  => Discarded {discarded_seqs} sequences for other reasons')
     print(f'  => Truncated {truncations} {trunc_type} times ({trunc_ratio}% of {trunc_type}s)')
-    print('Remember to shuffle the training split!')
+    print('Remember to shuffle the training split! (shuffle_tokens.py)')
+    finish(report, args, partial(retokenize, augment_factor=args.augment))
 
 if __name__ == '__main__':
     parser = ArgumentParser(description='Tokenizes a custom MIDI dataset')
     parser.add_argument('datadir', help='Directory containing preprocessed MIDI to tokenize')
+    parser.add_argument('-s', '--split', action='append',
+                        help='Subdirectory of datadir holding a split, repeatable; the first one is the '
+                             'augmented training split (defaults to pokemon_midis)')
     parser.add_argument('-k', '--augment', type=int, default=1,
                         help='Dataset augmentation factor (multiple of 10)')
     parser.add_argument('-i', '--interarrival',
                         action='store_true',
-                        help='Request interarrival-time encoding (defaults to arrival-time encoding)')
+                        help='Request interarrival-time encoding (defaults to arrival-time encoding); '
+                             'reads only text compounds (midi-preprocess.py --format text)')
+    parser.add_argument('-w', '--workers', type=int, default=None,
+                        help=f'Worker processes (defaults to PREPROC_WORKERS = {PREPROC_WORKERS})')
+    parser.add_argument('--shards', type=int, default=None,
+                        help='Shards per split (defaults to the number of workers)')
+    add_report_arguments(parser)
 
     main(parser.parse_args())
@@ -1,88 +1,248 @@
 import os
 import shutil
-import mido
+import struct
+from argparse import ArgumentParser
+from concurrent.futures import ProcessPoolExecutor
+
+from instrumentation import RunReport, add_report_arguments, finish, timed_call
 
 # Configuration variables - modify these paths as needed
 INPUT_DIR = "./pokemon_midis"  # Directory containing original MIDI files
 OUTPUT_DIR = "./pokemon_midis_transposed"  # Directory where transposed files will be saved
+TRANSPOSITIONS = range(12)  # Semitone offsets to generate (+0 is a plain copy)
+
+# Number of data bytes following each channel status (indexed by status >> 4)
+_DATA_BYTES = {0x8: 2, 0x9: 2, 0xA: 2, 0xB: 2, 0xC: 1, 0xD: 1, 0xE: 2}
+
+
+def _read_varlen(data, pos):
+    value = 0
+    while True:
+        byte = data[pos]
+        pos += 1
+        value = (value << 7) | (byte & 0x7F)
+        if not byte & 0x80:
+            return value, pos
+
+
+def find_note_bytes(data):
+    """
+    Walk the raw bytes of a Standard MIDI File and locate every note number
+    belonging to a note_on or note_off message.
+
+    Args:
+        data (bytes): Contents of a .mid file
+
+    Returns:
+        list: Byte offsets into data of the note number of each note message
+    """
+    if data[:4] != b'MThd':
+        raise ValueError("not a Standard MIDI File (missing MThd header)")
+
+    header_length = struct.unpack('>I', data[4:8])[0]
+    pos = 8 + header_length
+    positions = []
+
+    while pos + 8 <= len(data):
+        chunk_type = data[pos:pos+4]
+        chunk_length = struct.unpack('>I', data[pos+4:pos+8])[0]
+        pos += 8
+        end = pos + chunk_length
+        if end > len(data):
+            raise ValueError(f"chunk at byte {pos-8} runs past the end of the file")
+
+        # Only MTrk chunks carry events, anything else is skipped untouched
+        if chunk_type != b'MTrk':
+            pos = end
+            continue
+
+        status = None
+        while pos < end:
+            _, pos = _read_varlen(data, pos)  # delta time
+            byte = data[pos]
+
+            if byte == 0xFF:  # meta event: FF <type> <len> <data>
+                length, pos = _read_varlen(data, pos + 2)
+                pos += length
+            elif byte in (0xF0, 0xF7):  # sysex: F0/F7 <len> <data>
+                length, pos = _read_varlen(data, pos + 1)
+                pos += length
+            else:
+                if byte & 0x80:
+                    status = byte
+                    pos += 1
+                elif status is None:
+                    raise ValueError(f"running status without a previous status byte at {pos}")
+
+                kind = status >> 4
+                if kind not in _DATA_BYTES:
+                    raise ValueError(f"unexpected status byte {status:#x} at {pos}")
+                # note_off (0x8n) and note_on (0x9n): first data byte is the note
+                if kind == 0x8 or kind == 0x9:
+                    positions.append(pos)
+                pos += _DATA_BYTES[kind]
+
+        pos = end
+
+    return positions
+
+
+def transpose_midi_bytes(data, offsets=TRANSPOSITIONS):
+    """
+    Transpose a MIDI file held in memory to several keys at once. The file is
+    parsed a single time and the note bytes are patched in place for every
+    offset, so all other bytes (running status, meta events, ...) are kept
+    exactly as in the source.
+
+    Notes that would leave the valid MIDI range (0-127) are left untouched,
+    matching the behaviour of the original mido based transposer.
+
+    Args:
+        data (bytes): Contents of a .mid file
+        offsets (iterable): Semitone offsets to generate
+
+    Returns:
+        dict: Mapping of offset to the transposed file contents (bytes)
+    """
+    positions = find_note_bytes(data)
+    notes = [data[p] for p in positions]
+
+    results = {}
+    for offset in offsets:
+        if offset == 0:
+            results[offset] = bytes(data)
+            continue
 
-def transpose_midi_files(input_dir=INPUT_DIR, output_dir=OUTPUT_DIR):
+        buffer = bytearray(data)
+        for pos, note in zip(positions, notes):
+            new_note = note + offset
+            if 0 <= new_note <= 127:
+                buffer[pos] = new_note
+        results[offset] = bytes(buffer)
+
+    return results
+
+
+def _output_paths(midi_file, output_dir, offsets):
+    file_name, file_ext = os.path.splitext(midi_file)
+    return {i: os.path.join(output_dir, f"{file_name}+{i}{file_ext}") for i in offsets}
+
+
+def is_up_to_date(file_path, output_paths):
+    """Return True if every output exists and is no older than file_path."""
+    source_mtime = os.path.getmtime(file_path)
+    for output_file in output_paths:
+        if not os.path.exists(output_file) or os.path.getmtime(output_file) < source_mtime:
+            return False
+    return True
+
+
+def transpose_midi_file(file_path, output_dir, offsets=TRANSPOSITIONS, skip_up_to_date=False):
+    """
+    Write every transposition of a single MIDI file to output_dir.
+
+    Returns:
+        tuple: (file name, status, message) with status one of
+               'created', 'skipped' or 'error'
+    """
+    midi_file = os.path.basename(file_path)
+    outputs = _output_paths(midi_file, output_dir, offsets)
+
+    if skip_up_to_date and is_up_to_date(file_path, outputs.values()):
+        return midi_file, 'skipped', None
+
+    try:
+        with open(file_path, 'rb') as f:
+            data = f.read()
+        transposed = transpose_midi_bytes(data, [i for i in offsets if i != 0])
+    except Exception as e:
+        return midi_file, 'error', str(e)
+
+    try:
+        for i, output_file in outputs.items():
+            # written under a temporary name and renamed into place, so an
+            # interrupted write never leaves an output that looks up to date
+            tmp = f'{output_file}.tmp{os.getpid()}'
+            try:
+                if i == 0:
+                    # Make a copy with +0 (original key)
+                    shutil.copy2(file_path, tmp)
+                else:
+                    with open(tmp, 'wb') as f:
+                        f.write(transposed[i])
+                os.replace(tmp, output_file)
+            except BaseException:
+                if os.path.exists(tmp):
+                    os.remove(tmp)
+                raise
+    except OSError as e:
+        return midi_file, 'error', str(e)
+
+    return midi_file, 'created', None
+
+
+def transpose_midi_files(input_dir=INPUT_DIR, output_dir=OUTPUT_DIR, workers=None, skip_up_to_date=False,
+                         report=None):
     """
     Transposes all MIDI files in input_dir to all 12 keys,
     saving the results in output_dir with appropriate naming.
+
+    Files are spread across a process pool; with skip_up_to_date set, files
+    whose transpositions already exist and are newer than the source are
+    left alone. Per-file timings are added to report (a RunReport) if given.
     """
+    report = report or RunReport('transpose')
     # Create output directory if it doesn't exist
     if not os.path.exists(output_dir):
         os.makedirs(output_dir)
         print(f"Created output directory: {output_dir}")
-    
+
     # Get list of MIDI files in input directory
     if not os.path.exists(input_dir):
         print(f"Error: Input directory '{input_dir}' does not exist")
         return
-        
+
     midi_files = [f for f in os.listdir(input_dir) if f.lower().endswith('.mid') or f.lower().endswith('.midi')]
-    
+
     if not midi_files:
         print(f"No MIDI files found in {input_dir}")
         return
-    
-    print(f"Found {len(midi_files)} MIDI files. Beginning transposition...")
-    
-    # Process each MIDI file
-    for midi_file in midi_files:
-        file_path = os.path.join(input_dir, midi_file)
-        file_name, file_ext = os.path.splitext(midi_file)
-        
-        print(f"Processing {midi_file}...")
-        
-        # Make a copy with +0 (original key)
-        output_file = os.path.join(output_dir, f"{file_name}+0{file_ext}")
-        shutil.copy2(file_path, output_file)
-        
-        # Process all other transpositions (1-11 semitones up)
-        for i in range(1, 12):
-            try:
-                # Load the MIDI file
-                midi_data = mido.MidiFile(file_path)
-                
-                # Create a new MIDI file for the transposed version
-                transposed_midi = mido.MidiFile(ticks_per_beat=midi_data.ticks_per_beat)
-                
-                # Process each track
-                for track in midi_data.tracks:
-                    new_track = mido.MidiTrack()
-                    transposed_midi.tracks.append(new_track)
-                    
-                    # Process each message in the track
-                    for msg in track:
-                        # Clone the message
-                        new_msg = msg.copy()
-                        
-                        # Transpose note_on and note_off messages
-                        if msg.type == 'note_on' or msg.type == 'note_off':
-                            # Apply transposition, keeping notes in valid MIDI range (0-127)
-                            new_note = msg.note + i
-                            if 0 <= new_note <= 127:
-                                new_msg.note = new_note
-                        
-                        # Add the message to the new track
-                        new_track.append(new_msg)
-                
-                # Save the transposed MIDI file
-                output_file = os.path.join(output_dir, f"{file_name}+{i}{file_ext}")
-                transposed_midi.save(output_file)
-                
-                print(f"  Created {file_name}+{i}{file_ext}")
-                
-            except Exception as e:
-                print(f"Error processing {midi_file} at transposition +{i}: {str(e)}")
-    
-    print("Transposition complete!")
+
+    workers = workers or os.cpu_count()
+    print(f"Found {len(midi_files)} MIDI files. Beginning transposition with {workers} workers...")
+
+    file_paths = [os.path.join(input_dir, f) for f in sorted(midi_files)]
+    counts = {'created': 0, 'skipped': 0, 'error': 0}
+    with report.timer('transpose'), ProcessPoolExecutor(max_workers=workers) as executor:
+        results = executor.map(timed_call, [transpose_midi_file] * len(file_paths), file_paths,
+                               [output_dir] * len(file_paths),
+                               [TRANSPOSITIONS] * len(file_paths),
+                               [skip_up_to_date] * len(file_paths))
+        for file_path, ((midi_file, status, message), record) in zip(file_paths, results):
+            counts[status] += 1
+            report.count(status)
+            report.add({'file': midi_file, 'path': file_path, 'status': status,
+                        'reason': 'unreadable MIDI' if status == 'error' else None, 'message': message,
+                        **record})
+            if status == 'created':
+                print(f"  Created {len(TRANSPOSITIONS)} transpositions of {midi_file}")
+            elif status == 'error':
+                print(f"Error processing {midi_file}: {message}")
+
+    print(f"Transposition complete! ({counts['created']} transposed, "
+          f"{counts['skipped']} up to date, {counts['error']} failed)")
 
 if __name__ == "__main__":
-    # You can run the script directly with the configured paths
-    transpose_midi_files()
-    
-    # Alternatively, you can still override the paths when calling the function:
-    # transpose_midi_files("/custom/input/path", "/custom/output/path")
\ No newline at end of file
+    parser = ArgumentParser(description='Transposes a directory of MIDI files to all 12 keys')
+    parser.add_argument('input_dir', nargs='?', default=INPUT_DIR, help='directory containing the original MIDI files')
+    parser.add_argument('output_dir', nargs='?', default=OUTPUT_DIR, help='directory for the transposed files')
+    parser.add_argument('-w', '--workers', type=int, default=None, help='number of worker processes (defaults to all cores)')
+    parser.add_argument('--skip-up-to-date', action='store_true',
+                        help='skip files whose transpositions are already newer than the source')
+    add_report_arguments(parser)
+    args = parser.parse_args()
+
+    report = RunReport('transpose', args.report)
+    transpose_midi_files(args.input_dir, args.output_dir, workers=args.workers, skip_up_to_date=args.skip_up_to_date,
+                         report=report)
+    finish(report, args, lambda item: transpose_midi_file(item['path'], args.output_dir))
@@ -1,13 +1,9 @@
-from anticipation.config import MAX_INSTR
-from anticipation.vocab import CONTROL_OFFSET, NOTE_OFFSET
+import numpy as np
 
-with open('./tokenized-events-pokemon_midis_transposed.txt') as f:
-    lines = f.readlines()
-tokens = []
-for line in lines[1:]:
-    tokens.append([int(i)-CONTROL_OFFSET if int(i)>=CONTROL_OFFSET else int(i) for i in line.split(" ")[1:]])
+from token_stats import file_stats
 
-instruments = set()
-for tokenLine in tokens:
-    instruments.update([(i-NOTE_OFFSET)//MAX_INSTR for i in tokenLine[2::3]])
-print(instruments)
\ No newline at end of file
+if __name__ == '__main__':
+    # Streams the file in chunks (see token_stats.py for the full statistics)
+    stats = file_stats('./tokenized-events-pokemon_midis_transposed.txt')
+    instruments = set(np.flatnonzero(stats['instruments'] + stats['control_instruments']).tolist())
+    print(instruments)